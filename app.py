@@ -2,8 +2,12 @@ import json
 import plotly.graph_objs as go
 from dash import dcc, html, Dash
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from scripts.deployment.reference_function import *
-from scripts.deployment.find_similar_postal_area import apply_input
+from scripts.deployment.profiling import profiled, register_profile_route
+from scripts.deployment.area_api import register_area_api
+from scripts.deployment.recommend_api import register_recommend_api, get_recommendation
+from scripts.deployment.admission import Overloaded
 
 print("Loading data...")
 name_geojson = "./data/geographic/finland_2019_p4_utf8_simp_wid.geojson"
@@ -141,6 +145,9 @@ app.index_string = '''
     </html>
     '''
 server = app.server  # Required by Heroku
+register_profile_route(server)
+register_area_api(server)
+register_recommend_api(server)
 
 app.layout = html.Div(
     children=[
@@ -283,24 +290,21 @@ def robots_dot_txt():
                State('selection_radio', 'value'), State(
                    "analysis_info", "children"),
                State("stitching-tabs", "value"), State("counter", "className")])
+@profiled
 def change_focus(button_click, map_click, income, age, location, occupation, household_size,
                  selection_radio, analysis_old, tab_old, button_counter):
     if button_click is None:
         button_click = 0
     if int(button_counter) + 1 == button_click:
-        if income is None or income <= 0:
-            income = 10000
-        if 0 < age < 120:
-            age = round(age)
-        else:
-            age = 22
-        if (location is None) or (location == "") or (location not in list(paavo_df['Postal code'])):
-            location = "00930"
-        if occupation not in list_of_jobs:
-            occupation = "Student"
-        if household_size not in list_of_household_type:
-            household_size = 1
-        prediction = apply_input(income, age, location, occupation, household_size, selection_radio)
+        income, age, location, occupation, household_size, selection_radio = sanitize_input(
+            income, age, location, occupation, household_size, selection_radio)
+        try:
+            # Never the answer computed for another user (see 'get_recommendation')
+            prediction, _ = get_recommendation(income, age, location, occupation, household_size, selection_radio,
+                                               fallback=False)
+        except Overloaded:
+            busy = html.H1("The service is busy right now, please try again in a moment.")
+            return [busy], "result-tab", str(int(button_counter) + 1)
         # This should return a postal code ↑↑↑↑↑↑
         if prediction is None:
             prediction = "00120"
@@ -314,7 +318,19 @@ def change_focus(button_click, map_click, income, age, location, occupation, hou
         return analysis_old, tab_old, button_counter
 
 
+@app.callback(Output('location', 'options'), [Input('location', 'search_value')], [State('location', 'value')])
+def update_location_options(search_value, location):
+    if not search_value or not search_value.strip():
+        raise PreventUpdate
+    codes = search_locations(search_value)
+    # Keep the selected location among the options, otherwise the dropdown loses its label
+    if location not in codes:
+        codes.append(location)
+    return get_location_options(codes)
+
+
 @app.callback(Output('side_info', 'children'), [Input('main_plot', 'hoverData')])
+@profiled
 def return_side_analysis(hover_point):
     try:
         pc = hover_point['points'][0]['location']
@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import OrderedDict
+
+# In-process single-flight and admission control for expensive computations (the recommendations).
+# - identical requests that arrive while one of them is being computed wait for that result
+#   instead of computing it again (single flight)
+# - at most MAX_CONCURRENT computations run at the same time, and at most MAX_QUEUED wait for their turn;
+#   when the queue is full, a recent answer for a similar request is returned, or the request is rejected
+# - recent answers are kept in a small LRU cache, since the data do not change while the app is running
+MAX_CONCURRENT = int(os.environ.get("KODIMPI_MAX_CONCURRENT", "2"))
+MAX_QUEUED = int(os.environ.get("KODIMPI_MAX_QUEUED", "8"))
+CACHE_SIZE = int(os.environ.get("KODIMPI_CACHE_SIZE", "512"))
+
+
+class Overloaded(Exception):
+    """Raised when a request is rejected because too many requests are waiting"""
+    pass
+
+
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+_flights = {}
+_cache = OrderedDict()
+_fallbacks = OrderedDict()
+metrics = {'requests': 0, 'computed': 0, 'cached': 0, 'coalesced': 0, 'degraded': 0, 'rejected': 0,
+           'errors': 0, 'running': 0, 'queued': 0, 'max_queued': 0}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _remember(store, key, value):
+    store[key] = value
+    store.move_to_end(key)
+    if len(store) > CACHE_SIZE:
+        store.popitem(last=False)
+
+
+def run_once(key, compute, fallback_key=None):
+    """
+    Return compute() for the request identified by 'key', sharing the computation
+    with identical concurrent requests and limiting the number of concurrent computations.
+    :param key: hashable, the normalized request; requests with the same key get the same answer
+    :param compute: function without arguments that computes the answer
+    :param fallback_key: hashable, identifies similar requests whose answer can be returned
+            instead when the server is overloaded (e.g. same location); None to always reject
+    :return: tuple of the answer and a bool, true if the answer is the one of a similar request
+            (the server is overloaded, see 'fallback_key')
+    :raise Overloaded: if the queue is full and there is no fallback answer
+    """
+    with _lock:
+        metrics['requests'] += 1
+        if key in _cache:
+            metrics['cached'] += 1
+            _cache.move_to_end(key)
+            return _cache[key], False
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            if metrics['running'] >= MAX_CONCURRENT and metrics['queued'] >= MAX_QUEUED:
+                if fallback_key is not None and fallback_key in _fallbacks:
+                    metrics['degraded'] += 1
+                    return _fallbacks[fallback_key], True
+                metrics['rejected'] += 1
+                raise Overloaded()
+            flight = _flights[key] = _Flight()
+            metrics['queued'] += 1
+            metrics['max_queued'] = max(metrics['max_queued'], metrics['queued'])
+        else:
+            metrics['coalesced'] += 1
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, False
+
+    try:
+        with _slots:
+            with _lock:
+                metrics['queued'] -= 1
+                metrics['running'] += 1
+            try:
+                flight.result = compute()
+            finally:
+                with _lock:
+                    metrics['running'] -= 1
+        with _lock:
+            metrics['computed'] += 1
+            _remember(_cache, key, flight.result)
+            if fallback_key is not None:
+                _remember(_fallbacks, fallback_key, flight.result)
+        return flight.result, False
+    except Exception as e:
+        with _lock:
+            metrics['errors'] += 1
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def get_metrics():
+    """
+    :return: a copy of the counters: number of 'requests', answers 'computed', served from the 'cached'
+            answers, 'coalesced' with a running identical request, 'degraded' to the answer of a similar
+            request, 'rejected' and 'errors', plus the current number of 'running' and 'queued' computations
+    """
+    with _lock:
+        return dict(metrics)
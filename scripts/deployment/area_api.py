@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import numpy as np
+import orjson
+from flask import Response, request
+from scripts.deployment.reference_function import paavo_df, traffic_df, zip_name_dict, zip_tax_dict
+
+# Read-only JSON API over the facts of each postal code area:
+#   GET /api/area/<code>                one area
+#   GET /api/area?codes=00100,02150     several areas, as an object where the keys are the postal codes
+#   GET /api/area                       all the areas
+# The bodies are serialized and compressed once at startup; the responses carry a strong ETag
+# and Cache-Control, so that a CDN or a reverse proxy can serve most of the requests.
+CACHE_CONTROL = "public, max-age=3600, stale-while-revalidate=86400"
+MAX_CODES = 200
+
+area_columns = {'sell_price': 'Sell price',
+                'rent_price_with_ara': 'Rent price with ARA',
+                'rent_price_without_ara': 'Rent price without ARA',
+                'trend_near_future': 'Trend near future',
+                'trend_from_2018': 'Trend from 2018',
+                'forest': 'Forest',
+                'water': 'Water',
+                'lat': 'Lat',
+                'lon': 'Lon'}
+transport_columns = ['Bus', 'Train', 'Tram', 'Metro', 'Ferry']
+
+
+def get_area_record(row, transport):
+    """
+    Collect the facts of one area in a dictionary ready to be serialized.
+    Prices equal to 0 mean that there is no data, so they become None (null).
+    :param row: dictionary, one row of 'paavo_df'
+    :param transport: dictionary, the number of stations for each public transportation type
+    :return: dictionary
+    """
+    code = row['Postal code']
+    record = {'postal_code': code, 'name': zip_name_dict[code], 'tax': zip_tax_dict.get(code)}
+    for key, column in area_columns.items():
+        value = float(row[column])
+        record[key] = None if np.isnan(value) or (value == 0 and 'price' in key) else value
+    record['transportation'] = {key.lower(): int(value) for key, value in transport.items()}
+    return record
+
+
+def make_entry(body):
+    """
+    :param body: bytes, the JSON body
+    :return: dictionary with the plain body, the gzip-compressed body and their strong ETags
+    """
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    return {'body': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0),
+            'etag': digest, 'etag_gzip': digest + '-gz'}
+
+
+def build_area_store():
+    """
+    Serialize every area with orjson and compress it.
+    :return: dictionary where the keys are postal codes (and '*' for all the areas together)
+            and the values are the entries built by 'make_entry'
+    """
+    transport = traffic_df.set_index('Postal code')[transport_columns].to_dict(orient='index')
+    bodies = {}
+    for row in paavo_df[['Postal code'] + list(area_columns.values())].to_dict(orient='records'):
+        code = row['Postal code']
+        bodies[code] = orjson.dumps(get_area_record(row, transport.get(code, dict.fromkeys(transport_columns, 0))))
+    store = {code: make_entry(body) for code, body in bodies.items()}
+    store['*'] = make_entry(join_bodies(bodies, bodies.keys()))
+    return store
+
+
+def join_bodies(bodies, codes):
+    """
+    Concatenate the serialized areas into one JSON object, without parsing them again.
+    :param bodies: dictionary of postal codes and JSON bodies
+    :param codes: list of postal codes (null is returned for unknown codes)
+    :return: bytes, the JSON body
+    """
+    return b'{' + b','.join(orjson.dumps(code) + b':' + bodies.get(code, b'null') for code in codes) + b'}'
+
+
+def send_entry(entry):
+    """
+    Build the response for a store entry: 304 if the client already has it,
+    the gzip body if the client accepts it, otherwise the plain body.
+    :param entry: dictionary built by 'make_entry'
+    :return: flask Response
+    """
+    use_gzip = 'gzip' in request.accept_encodings
+    etag = entry['etag_gzip'] if use_gzip else entry['etag']
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry['gzip'] if use_gzip else entry['body'], mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def send_error(status, message):
+    return Response(orjson.dumps({'error': message}), status=status, mimetype='application/json')
+
+
+def register_area_api(server):
+    """
+    Add the /api/area routes to the Flask server of the Dash app.
+    :param server: the Flask server
+    :return: None
+    """
+    store = build_area_store()
+    bodies = {code: entry['body'] for code, entry in store.items() if code != '*'}
+
+    @server.route("/api/area/<code>")
+    def api_area(code):
+        if code not in bodies:
+            return send_error(404, f"Unknown postal code: {code}")
+        return send_entry(store[code])
+
+    @server.route("/api/area")
+    def api_areas():
+        codes = request.args.get('codes')
+        if codes is None:
+            return send_entry(store['*'])
+        codes = list(dict.fromkeys(code.strip() for code in codes.split(',') if code.strip()))
+        if len(codes) > MAX_CODES:
+            return send_error(400, f"Too many postal codes, at most {MAX_CODES} are allowed")
+        return send_entry(make_entry(join_bodies(bodies, codes)))
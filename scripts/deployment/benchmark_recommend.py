@@ -0,0 +1,84 @@
+"""
+Compare the throughput of the recommendation through the Dash callback ("Recommend" button)
+and through the JSON API /api/recommend. Every request has a different form, so that the answers
+are computed and not taken from the cache of 'admission'. Run from the root of the project:
+    python -m scripts.deployment.benchmark_recommend
+"""
+
+import contextlib
+import io
+import itertools
+import json
+import time
+import orjson
+from app import app
+
+locations = ['02150', '00100', '02100', '01300', '20100', '33100', '40100', '70100', '90100', '96100']
+occupations = ['Student', 'Education', 'Information and communication', 'Construction']
+counter = itertools.count()
+
+
+def next_form():
+    """Build a form that has not been sent yet (the income is different for every form)"""
+    i = next(counter)
+    return {'income': 20000 + i, 'age': 20 + i % 50, 'location': locations[i % len(locations)],
+            'occupation': occupations[i % len(occupations)], 'household_type': 1 + i % 4,
+            'selection_radio': ['whatever', 'change', 'nochange'][i % 3]}
+
+
+def dash_payload(n_clicks, form):
+    """Build the body that the browser sends to the change_focus callback"""
+    outputs = [{'id': 'analysis_info', 'property': 'children'}, {'id': 'stitching-tabs', 'property': 'value'},
+               {'id': 'counter', 'property': 'className'}]
+    state = [{'id': 'income', 'property': 'value', 'value': form['income']},
+             {'id': 'age', 'property': 'value', 'value': form['age']},
+             {'id': 'location', 'property': 'value', 'value': form['location']},
+             {'id': 'occupation', 'property': 'value', 'value': form['occupation']},
+             {'id': 'household_type', 'property': 'value', 'value': form['household_type']},
+             {'id': 'selection_radio', 'property': 'value', 'value': form['selection_radio']},
+             {'id': 'analysis_info', 'property': 'children', 'value': None},
+             {'id': 'stitching-tabs', 'property': 'value', 'value': 'canvas-tab'},
+             {'id': 'counter', 'property': 'className', 'value': str(n_clicks - 1)}]
+    return {'output': '..analysis_info.children...stitching-tabs.value...counter.className..',
+            'outputs': outputs,
+            'inputs': [{'id': 'button-stitch', 'property': 'n_clicks', 'value': n_clicks},
+                       {'id': 'main_plot', 'property': 'clickData', 'value': None}],
+            'changedPropIds': ['button-stitch.n_clicks'],
+            'state': state}
+
+
+def measure(name, n, send):
+    """Call 'send' n times and print the throughput"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        send(0)
+        start = time.perf_counter()
+        for i in range(n):
+            send(i + 1)
+        elapsed = time.perf_counter() - start
+    print(f"{name:<30} {n / elapsed:8.2f} requests/s  {1000 * elapsed / n:8.1f} ms/request")
+
+
+def main(n=20):
+    client = app.server.test_client()
+
+    def dash_request(i):
+        response = client.post('/_dash-update-component', data=json.dumps(dash_payload(1, next_form())),
+                               content_type='application/json')
+        assert response.status_code == 200
+
+    def api_request(i):
+        response = client.post('/api/recommend', data=orjson.dumps(next_form()), content_type='application/json')
+        assert response.status_code == 200
+
+    def api_batch_request(i):
+        response = client.post('/api/recommend', data=orjson.dumps([next_form() for _ in range(10)]),
+                               content_type='application/json')
+        assert response.status_code == 200
+
+    measure("Dash callback", n, dash_request)
+    measure("/api/recommend", n, api_request)
+    measure("/api/recommend (10 per call)", max(n // 10, 1), api_batch_request)
+
+
+if __name__ == '__main__':
+    main()
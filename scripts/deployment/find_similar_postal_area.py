@@ -1,8 +1,10 @@
+import os
 import pandas as pd
 import numpy as np
 import geopy.distance
 from pathlib import Path
 import heapq
+from scripts.deployment.location_search import build_trigram_index, search_trigram
 
 column_list = ['Postal code',
                'Area',
@@ -52,6 +54,13 @@ column_list = ['Postal code',
                'label'
                ]
 
+# The final data frame (KODIMPI_FINAL_DATAFRAME to read another file), read on the first call to 'dataframe'
+FINAL_DATAFRAME = Path(os.environ.get("KODIMPI_FINAL_DATAFRAME", "dataframes/final_dataframe.tsv"))
+final_df = None
+
+# Trigram index over the area names, built on the first search by 'find_place'
+place_index = None
+
 
 def get_distance(df, postalcode='00100'):
     """
@@ -77,12 +86,23 @@ def get_distance(df, postalcode='00100'):
 
 def dataframe():
     """
-    Open the data frame and return it.
+    Open the data frame and return it. The file is read only once,
+    then a copy of the data frame is returned, so callers can modify it.
+    :return: the data frame
+    """
+    global final_df
+    if final_df is None:
+        final_df = read_dataframe()
+    return final_df.copy()
+
+
+def read_dataframe():
+    """
+    Read the final data frame from file, with the correct data types.
     :return: the data frame
     """
     # Open sample
-    df = pd.read_csv(Path("dataframes/") / 'final_dataframe.tsv', sep='\t', skiprows=0, encoding='utf-8',
-                     dtype={'Postal code': object})
+    df = pd.read_csv(FINAL_DATAFRAME, sep='\t', skiprows=0, encoding='utf-8', dtype={'Postal code': object})
 
     # Correctly assign data types
     column_dic = dict.fromkeys(df.columns)
@@ -101,7 +121,22 @@ def dataframe():
     return df[column_list]
 
 
-def find_neighbor_of(df=None, weights=None, placename=None, postalcode=None):
+def find_place(placename, limit=10):
+    """
+    Find the areas whose name is the most similar to 'placename'. The search tolerates typos,
+    ignores the case and ä/ö/å, and also looks at the municipality in parentheses.
+    :param placename: str, the (partial) name of the area
+    :param limit: int, the maximum number of areas to return
+    :return: list of (postal code, area name, similarity score) tuples, the most similar first
+    """
+    global place_index
+    if place_index is None:
+        df = dataframe()
+        place_index = build_trigram_index(zip(df['Postal code'], df['Area']))
+    return search_trigram(place_index, placename, limit)
+
+
+def find_neighbor_of(df=None, weights=None, placename=None, postalcode=None, top_k=None):
     """
     Return the postal code of the place that is most similar to 'placename' or 'postalcode',
     given the data frame 'df'. Also set the weight list to compute the distance in the feature
@@ -110,14 +145,20 @@ def find_neighbor_of(df=None, weights=None, placename=None, postalcode=None):
     :param weights: list, the weights for the distance calculation
     :param placename: str, the name (can be partial) of the starting area
     :param postalcode: str, the postal code of the starting area
-    :return: str, a postal code
+    :param top_k: int, if given, return the 'top_k' most similar places instead of only the best one
+    :return: str, a postal code, or a list of (postal code, distance) tuples if 'top_k' is given
     """
 
     if placename is None and postalcode is None:
         raise Exception
     elif placename is not None:
-        myrow = df.loc[df['Area'].str.contains(placename)]
-        myrow = myrow.values
+        # Take the most similar name among the places in the data frame
+        codes = set(df['Postal code'])
+        matches = [code for code, _, _ in find_place(placename, limit=50) if code in codes]
+        if len(matches) == 0:
+            raise Exception
+        myrow = df.loc[df['Postal code'] == matches[0]]
+        myrow = myrow.values[0]
     else:
         myrow = df.loc[df['Postal code'].str.contains(postalcode)]
         myrow = myrow.values[0]
@@ -127,13 +168,15 @@ def find_neighbor_of(df=None, weights=None, placename=None, postalcode=None):
     s = np.multiply(myrow[3:]-df.iloc[:, 3:].to_numpy(), weights, dtype=np.float32, casting='unsafe')
 
     dist = zip(df['Postal code'], np.linalg.norm(s, axis=1))
-    dist = heapq.nsmallest(10, dist, key=lambda x: x[1])
+    dist = heapq.nsmallest(max(10, (top_k or 0) + 1), dist, key=lambda x: x[1])
 
     # print(len(dist))
     # Print the first 10 suggestions
     for k, v in dist:
         print("\t".join(df[df['Postal code'] == k][['Postal code', 'Area']].values[0]) + "\t" + str(v))
 
+    if top_k is not None:
+        return [(str(k), float(v)) for k, v in dist[1:top_k + 1]]
     return str(dist[1][0])
 
 
@@ -157,7 +200,7 @@ def get_cluster_of(postalcode=""):
         raise Exception
 
 
-def apply_input(income, age, location, occupation, household_type, selection_radio):
+def apply_input(income, age, location, occupation, household_type, selection_radio, top_k=None):
     """
     Take the input from the UI and build an ideal place by modifying the current 'location'
     and boosting the values of Average income, Average age, Job places, Average household size
@@ -171,6 +214,7 @@ def apply_input(income, age, location, occupation, household_type, selection_rad
             be converted to 5.
     :param selection_radio: str, when equal to "change" the suggestion will be further away than 100 km,
             when equal to "nochange" the suggestion will be closer than 100 km.
+    :param top_k: int, if given, return the 'top_k' best suggestions with their distances
     :return: call the function 'find_neighbor_of' which return the suggested postal code
     """
     print(income)
@@ -293,7 +337,7 @@ def apply_input(income, age, location, occupation, household_type, selection_rad
                 else df[df['Postal code'] == location][col].values[0]
 
     df.reset_index(inplace=True)
-    return find_neighbor_of(df=df, weights=weights, postalcode=location)
+    return find_neighbor_of(df=df, weights=weights, postalcode=location, top_k=top_k)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import unicodedata
+from bisect import bisect_left
+import numpy as np
+
+
+def normalize(text):
+    """
+    Normalize a postal code or an area name for searching: lower case, ä/ö/å (and other accents)
+    folded to plain letters, punctuation replaced with spaces, no extra spaces.
+    :param text: str, the text to normalize
+    :return: str, the normalized text
+    """
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def build_prefix_index(names):
+    """
+    Build a prefix index over postal codes and area names, as two sorted arrays:
+    the search keys and the postal code each key points to.
+    Each postal code is indexed by the code itself, by the full area name
+    and by every word of the area name (e.g. "Etu-Töölö" is found with "töölö" too).
+    :param names: dictionary where the keys are postal codes and the values are area names
+    :return: dictionary with the sorted 'keys' and the corresponding 'codes'
+    """
+    entries = set()
+    for code, name in names.items():
+        entries.add((code, code))
+        name = normalize(name)
+        entries.add((name, code))
+        for i, char in enumerate(name):
+            if i > 0 and char != " " and name[i - 1] == " ":
+                entries.add((name[i:], code))
+    entries = sorted(entries)
+    return {'keys': [key for key, _ in entries], 'codes': [code for _, code in entries]}
+
+
+def search_prefix(index, query, limit=10):
+    """
+    Find the postal codes whose code, name or any word of the name starts with 'query'.
+    :param index: the dictionary returned by 'build_prefix_index'
+    :param query: str, the (partial) text typed by the user
+    :param limit: int, the maximum number of postal codes to return
+    :return: list of at most 'limit' postal codes, without duplicates (none for an empty or blank query)
+    """
+    query = normalize(query)
+    if not query:
+        # Every key starts with the empty string
+        return []
+    keys = index['keys']
+    found = []
+    i = bisect_left(keys, query)
+    while i < len(keys) and len(found) < limit and keys[i].startswith(query):
+        code = index['codes'][i]
+        if code not in found:
+            found.append(code)
+        i += 1
+    return found
+
+
+def trigrams(text):
+    """
+    :param text: str, the text to split
+    :return: set of the character trigrams of the normalized text, padded with spaces
+    """
+    text = "  " + normalize(text) + " "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def build_trigram_index(places):
+    """
+    Build a trigram inverted index over area names, for typo tolerant searches.
+    The names are used as they are, so the municipality in parentheses is indexed too
+    (e.g. "Otaniemi (Espoo)").
+    :param places: iterable of (postal code, area name) pairs
+    :return: dictionary with the 'codes' and 'names' of the places, the number of trigrams
+            of each name ('sizes') and the 'postings', where each trigram points to
+            the array of positions of the names that contain it
+    """
+    codes, names, sizes = [], [], []
+    postings = {}
+    for i, (code, name) in enumerate(places):
+        grams = trigrams(name)
+        codes.append(code)
+        names.append(name)
+        sizes.append(len(grams))
+        for gram in grams:
+            postings.setdefault(gram, []).append(i)
+    return {'codes': codes,
+            'names': names,
+            'sizes': np.array(sizes, dtype=np.float64),
+            'postings': {gram: np.array(rows, dtype=np.int32) for gram, rows in postings.items()}}
+
+
+def search_trigram(index, query, limit=10):
+    """
+    Rank the places by trigram similarity (Dice coefficient) between 'query' and their name.
+    :param index: the dictionary returned by 'build_trigram_index'
+    :param query: str, the (partial, possibly misspelled) name to find
+    :param limit: int, the maximum number of places to return
+    :return: list of (postal code, area name, score) tuples, the best first; the score is between 0 and 1
+    """
+    grams = trigrams(query)
+    shared = np.zeros(len(index['codes']))
+    for gram in grams:
+        rows = index['postings'].get(gram)
+        if rows is not None:
+            shared[rows] += 1
+    scores = 2 * shared / (len(grams) + index['sizes'])
+
+    candidates = np.flatnonzero(shared)
+    if len(candidates) > limit:
+        candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+    candidates = sorted(candidates, key=lambda i: (-scores[i], i))
+    return [(index['codes'][i], index['names'][i], float(scores[i])) for i in candidates]
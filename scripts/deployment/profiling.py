@@ -0,0 +1,120 @@
+import cProfile
+import functools
+import itertools
+import os
+import threading
+import time
+from pathlib import Path
+
+# Opt-in sampling profiler for the Dash callbacks.
+# KODIMPI_PROFILE_EVERY=N profiles 1 in N calls of each wrapped callback (0 or unset: disabled)
+# KODIMPI_PROFILE_DIR is the folder where the .pstats files are written
+# KODIMPI_PROFILE_KEEP is the number of most recent files kept in that folder
+PROFILE_EVERY = int(os.environ.get("KODIMPI_PROFILE_EVERY", "0") or 0)
+PROFILE_DIR = Path(os.environ.get("KODIMPI_PROFILE_DIR", "/tmp/kodimpi_profiles"))
+PROFILE_KEEP = int(os.environ.get("KODIMPI_PROFILE_KEEP", "50") or 50)
+
+# cProfile cannot run two profilers at the same time in one process
+_profiler_lock = threading.Lock()
+
+
+def profiling_enabled():
+    return PROFILE_EVERY > 0
+
+
+def profiled(func):
+    """
+    Decorator: profile one call out of PROFILE_EVERY calls of 'func' with cProfile
+    and save the statistics in PROFILE_DIR. When profiling is disabled the function
+    is returned unchanged, so there is no overhead at all.
+    :param func: the function (Dash callback) to profile
+    :return: the wrapped function
+    """
+    if not profiling_enabled():
+        return func
+
+    counter = itertools.count(1)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if next(counter) % PROFILE_EVERY != 0 or not _profiler_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            wall_ms = (time.perf_counter() - start) * 1000
+            _profiler_lock.release()
+            save_profile(profiler, func.__name__, wall_ms)
+
+    return wrapper
+
+
+def save_profile(profiler, name, wall_ms):
+    """
+    Dump the statistics of 'profiler' as a .pstats file and remove the oldest files,
+    so that at most PROFILE_KEEP files are kept.
+    The wall time is stored in the file name: <timestamp>_<name>_<wall time in ms>ms.pstats
+    :param profiler: a cProfile.Profile that has been run
+    :param name: str, the name of the profiled function
+    :param wall_ms: float, the wall time of the call in milliseconds
+    :return: None
+    """
+    if not os.path.exists(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    timestamp = time.strftime("%Y%m%d-%H%M%S") + f"{time.time() % 1:.6f}"[1:]
+    profiler.dump_stats(PROFILE_DIR / f"{timestamp}_{name}_{wall_ms:.1f}ms.pstats")
+
+    for old in list_profiles()[PROFILE_KEEP:]:
+        try:
+            os.remove(PROFILE_DIR / old['file'])
+        except OSError:
+            pass
+
+
+def list_profiles():
+    """
+    List the saved profiles, the most recent first.
+    :return: list of dictionaries with keys 'file', 'callback', 'time', 'wall_ms'
+    """
+    if not os.path.exists(PROFILE_DIR):
+        return []
+    profiles = []
+    for file in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not file.endswith("ms.pstats"):
+            continue
+        timestamp, rest = file.split("_", 1)
+        name, wall = rest[:-len("ms.pstats")].rsplit("_", 1)
+        profiles.append({'file': file, 'callback': name, 'time': timestamp, 'wall_ms': float(wall)})
+    return profiles
+
+
+def register_profile_route(server):
+    """
+    Add the route /debug/profile to the Flask server, listing the recent profiles
+    with their wall times. The route is only added when profiling is enabled.
+    Single files can be downloaded from /debug/profile/<file> and opened with
+    `python -m pstats <file>` or snakeviz.
+    :param server: the Flask server of the Dash app
+    :return: None
+    """
+    if not profiling_enabled():
+        return
+
+    from flask import abort, send_from_directory
+
+    @server.route("/debug/profile")
+    def debug_profile_list():
+        rows = "".join(f"<tr><td>{p['time']}</td><td>{p['callback']}</td><td>{p['wall_ms']:.1f}</td>"
+                       f"<td><a href=\"/debug/profile/{p['file']}\">{p['file']}</a></td></tr>"
+                       for p in list_profiles())
+        return (f"<h1>Profiles (1 in {PROFILE_EVERY} calls)</h1><table>"
+                "<tr><th>Time</th><th>Callback</th><th>Wall time (ms)</th><th>File</th></tr>"
+                f"{rows}</table>")
+
+    @server.route("/debug/profile/<file>")
+    def debug_profile_file(file):
+        if file not in [p['file'] for p in list_profiles()]:
+            abort(404)
+        return send_from_directory(PROFILE_DIR.resolve(), file, as_attachment=True)
@@ -0,0 +1,100 @@
+import orjson
+from flask import Response, request
+from scripts.deployment.reference_function import sanitize_input, radar_value, zip_name_dict
+from scripts.deployment.find_similar_postal_area import apply_input
+from scripts.deployment.admission import run_once, get_metrics, Overloaded
+
+# JSON recommendation API. It takes the same fields as the form of the app:
+#   POST /api/recommend  {"income": 30000, "age": 30, "location": "02150", "occupation": "Education",
+#                         "household_type": 2, "selection_radio": "nochange", "top_k": 5}
+# or a JSON array of such objects, and answers with the same recommendation as the "Recommend" button,
+# without building the Dash components of the analysis tab. When the server is overloaded, the answer may be
+# the recommendation computed for another request from the same location, with "degraded": true.
+MAX_BATCH = 50
+MAX_TOP_K = 20
+radar_categories = ['Education', 'Services', 'Public Transportation', 'Average Income', 'Population Density']
+
+
+def get_recommendation(income, age, location, occupation, household_type, selection_radio, top_k=None,
+                       fallback=True):
+    """
+    Call 'apply_input' with already sanitized inputs. Concurrent identical requests share one computation,
+    the number of concurrent computations is limited, and recent answers are reused (see 'admission').
+    When the server is overloaded, the last answer for the same location may be returned instead, if 'fallback'.
+    It was computed for another income, age, occupation and household, so the app does not use it:
+    the app cannot tell the user that the answer is not theirs.
+    :param fallback: bool, if false raise Overloaded instead of returning the answer for the same location
+    :return: the result of 'apply_input', and a bool, true if it is the answer for the same location
+    :raise Overloaded: if the server is overloaded and there is no answer to fall back to
+    """
+    key = (round(income), age, location, occupation, household_type, selection_radio, top_k)
+    return run_once(key,
+                    lambda: apply_input(income, age, location, occupation, household_type, selection_radio, top_k),
+                    fallback_key=(location, selection_radio, top_k) if fallback else None)
+
+
+def recommend(query):
+    """
+    Compute the recommendation for one request.
+    :param query: dictionary with the fields of the form ('income', 'age', 'location', 'occupation',
+            'household_type', 'selection_radio') and optionally 'top_k', the number of alternatives
+    :return: dictionary ready to be serialized
+    """
+    income, age, location, occupation, household_type, selection_radio = sanitize_input(
+        query.get('income'), query.get('age'), query.get('location'), query.get('occupation'),
+        query.get('household_type'), query.get('selection_radio'))
+    top_k = query.get('top_k')
+    top_k = min(max(top_k, 1), MAX_TOP_K) if isinstance(top_k, int) and not isinstance(top_k, bool) else 1
+
+    neighbors, degraded = get_recommendation(income, age, location, occupation, household_type, selection_radio,
+                                             top_k)
+    prediction = neighbors[0][0] if len(neighbors) > 0 else "00120"
+    return {
+        'input': {'income': income, 'age': age, 'location': location, 'occupation': occupation,
+                  'household_type': household_type, 'selection_radio': selection_radio},
+        'degraded': degraded,
+        'postal_code': prediction,
+        'name': zip_name_dict[prediction],
+        'alternatives': [{'postal_code': code, 'name': zip_name_dict[code], 'distance': distance}
+                         for code, distance in neighbors],
+        'radar': {'categories': radar_categories,
+                  'current': radar_value(location),
+                  'recommended': radar_value(prediction)}
+    }
+
+
+def send_json(data, status=200):
+    return Response(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY), status=status,
+                    mimetype='application/json')
+
+
+def register_recommend_api(server):
+    """
+    Add the route /api/recommend to the Flask server of the Dash app.
+    :param server: the Flask server
+    :return: None
+    """
+    @server.route("/api/recommend", methods=['POST'])
+    def api_recommend():
+        try:
+            queries = orjson.loads(request.get_data())
+        except orjson.JSONDecodeError:
+            return send_json({'error': "The body is not valid JSON"}, 400)
+
+        if not isinstance(queries, (dict, list)) or (isinstance(queries, list) and
+                                                     not all(isinstance(q, dict) for q in queries)):
+            return send_json({'error': "The body must be an object or an array of objects"}, 400)
+        if isinstance(queries, list) and len(queries) > MAX_BATCH:
+            return send_json({'error': f"Too many requests in one call, at most {MAX_BATCH} are allowed"}, 400)
+        try:
+            if isinstance(queries, dict):
+                return send_json(recommend(queries))
+            return send_json([recommend(q) for q in queries])
+        except Overloaded:
+            response = send_json({'error': "The service is busy, please try again later"}, 503)
+            response.headers['Retry-After'] = '1'
+            return response
+
+    @server.route("/api/recommend/metrics")
+    def api_recommend_metrics():
+        return send_json(get_metrics())
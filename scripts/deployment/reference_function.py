@@ -1,11 +1,13 @@
 import numpy as np
 import pandas as pd
 from dash import html
+from scripts.deployment.location_search import build_prefix_index, search_prefix
+from scripts.deployment.find_similar_postal_area import find_place, FINAL_DATAFRAME
 # import requests
 # from toolkits import *
 
 # Requires UTF-8, Tab-seperated, name of postal code column = 'Postal code'
-paavo_df = pd.read_table("./dataframes/final_dataframe.tsv",
+paavo_df = pd.read_table(FINAL_DATAFRAME,
                          dtype={"Postal code": object})  # The dtype CANNOT be removed!
 traffic_df = pd.read_csv("./data/transportation/final_transportation.tsv",
                          sep="\t", dtype={"Postal code": object})
@@ -38,13 +40,66 @@ list_of_jobs = ['Student',
                 'Extraterritorial organisations and bodies'
                 ]
 list_of_household_type = [1, 2, 3, 4, "5 or more"]
-location_dropdown = [{'label': i + ", " + zip_name_dict[i],
-                      'value': i} for i in paavo_df['Postal code']]
+# Only a few locations are sent with the layout, the others are searched with 'search_locations'
+location_index = build_prefix_index(zip_name_dict)
+default_locations = ['02150', '00100', '02100', '01300', '20100', '33100', '40100', '70100', '90100', '96100']
 occupation_dropdown = [{'label': i, 'value': i} for i in list_of_jobs]
 household_type_dropdown = [{'label': i, 'value': i}
                            for i in list_of_household_type]
 
 
+def get_location_options(codes):
+    """
+    Build the options of the location dropdown for the given postal codes.
+    :param codes: list of postal codes
+    :return: list of dictionaries with 'label' ("code, name") and 'value' (code)
+    """
+    return [{'label': i + ", " + zip_name_dict[i], 'value': i} for i in codes if i in zip_name_dict]
+
+
+def search_locations(search_value, limit=20):
+    """
+    Find the postal codes whose code or area name starts with the text typed in the location dropdown.
+    If there are not enough of them, add the most similar area names (so that typos are tolerated),
+    with the trigram index of 'find_place' that is also used by the recommendations.
+    :param search_value: str, the text typed by the user
+    :param limit: int, the maximum number of postal codes to return
+    :return: list of postal codes
+    """
+    codes = search_prefix(location_index, search_value, limit)
+    if len(codes) < limit:
+        for code, _, score in find_place(search_value, limit):
+            if score >= 0.3 and code not in codes and len(codes) < limit:
+                codes.append(code)
+    return codes
+
+
+location_dropdown = get_location_options(default_locations)
+
+
+def sanitize_input(income, age, location, occupation, household_size, selection_radio):
+    """
+    Replace the missing or invalid inputs of the form with the default values.
+    :return: tuple (income, age, location, occupation, household_size, selection_radio)
+    """
+    # bool is a subclass of int, but true or false is not a number in the form
+    if not isinstance(income, (int, float)) or isinstance(income, bool) or income <= 0:
+        income = 10000
+    if isinstance(age, (int, float)) and not isinstance(age, bool) and 0 < age < 120:
+        age = round(age)
+    else:
+        age = 22
+    if (location is None) or (location == "") or (location not in zip_name_dict):
+        location = "00930"
+    if occupation not in list_of_jobs:
+        occupation = "Student"
+    if household_size not in list_of_household_type:
+        household_size = 1
+    if selection_radio not in ['change', 'nochange', 'whatever']:
+        selection_radio = 'whatever'
+    return income, age, location, occupation, household_size, selection_radio
+
+
 def get_attribute(postalcode="02150", column=None):
     """
     Read from the data frame: find the value of the given column for the given postal code.
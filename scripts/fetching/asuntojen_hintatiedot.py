@@ -1,6 +1,7 @@
 # Get data from asuntojen.hintatiedot.fi
 # -*- coding: utf-8 -*- #
 
+import io
 import os
 import glob
 import re
@@ -8,9 +9,15 @@ import time
 import requests
 import numpy as np
 import pandas as pd
-from tabulate import tabulate
-from bs4 import BeautifulSoup
 from pathlib import Path
+from scripts.fetching.html_table import read_table
+from concurrent.futures import ProcessPoolExecutor
+from scripts.fetching.http_pool import make_session, fetch, RateLimiter, run_concurrently
+from scripts.fetching.crawl_journal import JOURNAL_PATH, open_journal, record_attempt, start_new_crawl, \
+    codes_to_fetch, print_summary, get_hashes
+from scripts.fetching.price_store import average_prices
+from scripts.fetching.raw_archive import ARCHIVE_PATH, store_object, read_object, content_hash, open_manifest, \
+    record_page, latest_pages
 
 # Sales in the last 12 months
 sales_url = u'https://asuntojen.hintatiedot.fi/haku/?search=1&l=0&c=&cr=1&ps='
@@ -20,6 +27,9 @@ end_sales = '&pc=0&nc=0&amin=&amax='
 rent_url = u'https://asuntojen.hintatiedot.fi/haku/vuokratiedot?c=&ps='
 end_rent = '&renderType=renderTypeTable'
 
+# Changes found by `refresh_prices`
+CHANGELOG_PATH = Path('data/house_price/') / 'changelog.tsv'
+
 # Read postal codes list (saved from 2017)
 to_open = Path("data/geographic/") / 'postalcodes.tsv'
 pc_list = pd.read_csv(to_open, sep='\t', encoding='utf-8',
@@ -31,64 +41,251 @@ pc_list = pd.read_csv(to_open, sep='\t', encoding='utf-8',
 # pd.DataFrame({'Postal code': pc_list}).to_csv(Path("data/geographic/") / 'postalcodes.tsv', index=False)
 
 
-def get_one_postalcode(ps='00100', onSale=True):
+def query_url(ps='00100', onSale=True):
+    """
+    :param ps: the postal code to query
+    :param onSale: bool, if true the url of the sales, if false the url of the rents
+    :return: str, the url of the query
+    """
+    ps = re.sub('[^0-9]+', '', ps)[:5]
+    if onSale:
+        return sales_url + ps + end_sales
+    else:
+        return rent_url + ps + end_rent
+
+
+def parse_table(content, show=False):
+    """
+    Extract the table 'mainTable' from a page of asuntojen.hintatiedot.fi
+    :param content: bytes, the html page
+    :param show: bool, if true print the table
+    :return: a data frame (empty if the page has no table)
+    """
+    df = read_table(content, table_id='mainTable')
+    if show:
+        from tabulate import tabulate
+        print(tabulate(df, headers='keys', tablefmt='psql'))
+    return df
+
+
+def get_one_postalcode(ps='00100', onSale=True, retries=3, show=True):
     """
     Perform the query on one postal code.
     QUERY TESTED: 13.11.2019
     :param ps: the postal code to query.
     :param onSale: bool, if true do the query sales, if false do the query on rents
-    :return: a data frame
+    :param retries: int, how many times the query is repeated after an error
+    :param show: bool, if true print the table
+    :return: a data frame (empty if the query failed)
     """
     ps = re.sub('[^0-9]+', '', ps)[:5]
-    df_list = [pd.DataFrame()]
-    try:
-        if onSale:
-            res = requests.get(sales_url + ps + end_sales)
-        else:
-            res = requests.get(rent_url + ps + end_rent)
-        soup = BeautifulSoup(res.content, 'lxml')
-        soup = soup.find("table", {"id": "mainTable"})
-        if soup is not None:
-            df_list = pd.read_html(str(soup))
-            print(tabulate(df_list[0], headers='keys', tablefmt='psql'))
-    except requests.ConnectionError as e:
-        print("OOPS!! Connection Error. Make sure you are connected to Internet. Technical Details given below.\n")
-        print(str(e))
-        time.sleep(5)
-        get_one_postalcode(ps=ps, onSale=onSale)
-    except requests.Timeout as e:
-        print("OOPS!! Timeout Error")
-        print(str(e))
+    for _ in range(retries + 1):
+        try:
+            res = requests.get(query_url(ps, onSale), timeout=(10, 60))
+            return parse_table(res.content, show)
+        except requests.ConnectionError as e:
+            print("OOPS!! Connection Error. Make sure you are connected to Internet. Technical Details given below.\n")
+            print(str(e))
+        except requests.Timeout as e:
+            print("OOPS!! Timeout Error")
+            print(str(e))
+        except requests.RequestException as e:
+            print("OOPS!! General Error")
+            print(str(e))
+        except KeyboardInterrupt:
+            print("Someone closed the program")
+            break
         time.sleep(5)
-        get_one_postalcode(ps=ps, onSale=onSale)
-    except requests.RequestException as e:
-        print("OOPS!! General Error")
-        print(str(e))
-        time.sleep(5)
-        get_one_postalcode(ps=ps, onSale=onSale)
-    except KeyboardInterrupt:
-        print("Someone closed the program")
-    return df_list[0]
+    return pd.DataFrame()
 
 
-def all_queries_to_tsv(onSale=True, pc_list=pc_list):
+def all_queries_to_tsv(onSale=True, pc_list=pc_list, housing_folder=None, max_workers=8, rate=4.0, backoff=1.0,
+                       journal=JOURNAL_PATH, new_crawl=False, max_attempts=3, archive=ARCHIVE_PATH, and_clean=False,
+                       retry_failed=False):
     """
-    Call `get_one_postalcode` on all the known postal codes and save a .tsv file for each postal code
+    Query all the known postal codes concurrently and save a .tsv file for each postal code
     in the folder 'asuntojen_hintatiedot_sale' or 'asuntojen_hintatiedot_rent'.
+    The queries share one pool of keep-alive connections, at most 'rate' requests per second
+    are sent to the server, and failed queries are retried a few times with a random backoff.
+    The postal codes that still fail are not saved.
+    Every attempt is recorded in the crawl journal (see 'crawl_journal'): when the function is called again,
+    the postal codes already downloaded are skipped (unless their file is missing), and the failed ones
+    are tried again until they have been tried 'max_attempts' times.
+    The raw pages are kept in the archive (see 'raw_archive'), so that the tables can be rebuilt
+    with `reparse_from_archive` without downloading them again.
+    A file is written only when the table is different from the last one saved for the same postal code,
+    and the page is not even parsed when it is the same as the last one downloaded.
     :param: onSales, bool, if true collect the query on sales, if false do it on rents
+    :param pc_list: list of strings, the postal codes to query
+    :param housing_folder: str, the folder where to save the files (by default the one of sales or rents)
+    :param max_workers: int, the number of concurrent queries
+    :param rate: float, the maximum number of requests per second
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :param journal: the path of the crawl journal
+    :param new_crawl: bool, if true download again also the postal codes of 'pc_list' already done in the journal
+    :param max_attempts: int, the maximum number of attempts for each postal code
+    :param archive: the folder of the archive of the raw pages, or None to not keep them
+    :param and_clean: bool, if true also clean the tables, as `clean(andSave=True)`
+    :param retry_failed: bool, if true try again the postal codes of 'pc_list' given up after 'max_attempts'
+    :return: list of the postal codes that could not be downloaded
+    """
+    filename = 'sale' if onSale else 'rent'
+    if housing_folder is None:
+        housing_folder = 'data/house_price/asuntojen_hintatiedot_' + filename
+    if not os.path.exists(housing_folder):
+        os.makedirs(housing_folder)
+
+    conn = open_journal(journal)
+    previous_pages = get_hashes(conn, filename)
+    # The tables saved in the other mode (cleaned or not) are always written again
+    previous_tables = get_hashes(conn, filename, output=True, cleaned=and_clean)
+    if new_crawl:
+        start_new_crawl(conn, filename, pc_list)
+    elif retry_failed:
+        start_new_crawl(conn, filename, pc_list, failed_only=True)
+    todo = codes_to_fetch(conn, filename, pc_list, max_attempts, folder=housing_folder)
+    print(str(len(pc_list) - len(todo)) + ' postal codes already done or given up, ' + str(len(todo)) + ' to download')
+
+    manifest = open_manifest(archive) if archive is not None else None
+    session = make_session(pool_size=max_workers)
+    limiter = RateLimiter(rate)
+
+    def query_and_save(pc):
+        res = fetch(session, query_url(pc, onSale), limiter=limiter, backoff=backoff, timeout=(10, 60))
+        res.raise_for_status()
+        sha = store_object(archive, res.content) if archive is not None else content_hash(res.content)
+        path = os.path.join(housing_folder, str(pc) + '.tsv')
+        if sha == previous_pages.get(pc) and pc in previous_tables and os.path.exists(path):
+            return res.status_code, sha, len(res.content), previous_tables[pc]
+        data = table_to_tsv(parse_table(res.content), onSale, and_clean).encode('utf-8')
+        table_hash = content_hash(data)
+        if table_hash != previous_tables.get(pc) or not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return res.status_code, sha, len(res.content), table_hash
+
+    failed = []
+    for done, (pc, result, error) in enumerate(run_concurrently(query_and_save, todo, max_workers), start=1):
+        if error is None:
+            record_attempt(conn, filename, pc, 'done', http_status=result[0], content_hash=result[1],
+                           output_hash=result[3], cleaned=and_clean)
+            if manifest is not None:
+                record_page(manifest, filename, pc, result[1], result[2])
+        else:
+            print('Could not download ' + str(pc) + ': ' + str(error))
+            http_status = error.response.status_code if getattr(error, 'response', None) is not None else None
+            record_attempt(conn, filename, pc, 'failed', http_status=http_status, error=str(error))
+            failed.append(pc)
+        if done % 100 == 0:
+            print(str(done) + ' / ' + str(len(todo)) + ' postal codes done')
+    session.close()
+
+    if manifest is not None:
+        manifest.close()
+
+    print_summary(conn, filename)
+    conn.close()
+    return failed
+
+
+def table_to_tsv(df, onSale=True, and_clean=False):
+    """
+    :param df: the table of one postal code, as returned by `parse_table`
+    :param onSale: bool, if true the table is of sales, if false of rents
+    :param and_clean: bool, if true also clean the table
+    :return: str, the content of the .tsv file; when cleaned, the same as saving the table
+            and then calling `clean(andSave=True)`
+    """
+    if and_clean and not df.empty:
+        df = pd.read_csv(io.StringIO(df.to_csv(sep='\t', index=False)), sep='\t')
+        df = clean_sale(df) if onSale else clean_rent(df)
+    return df.to_csv(sep='\t', index=False)
+
+
+def reparse_one(job):
+    """
+    Rebuild the file of one postal code from its archived page (see `reparse_from_archive`)
+    :param job: tuple (archive folder, hash of the page, path of the .tsv file, onSale, and_clean)
     :return: None
     """
+    archive, sha, path, onSale, and_clean = job
+    with open(path, 'wb') as f:
+        f.write(table_to_tsv(parse_table(read_object(archive, sha)), onSale, and_clean).encode('utf-8'))
+
+
+def refresh_prices(onSale=True, pc_list=pc_list, housing_folder=None, journal=JOURNAL_PATH, changelog=CHANGELOG_PATH,
+                   **kwargs):
+    """
+    Download again the pages of all the postal codes, and rewrite only the cleaned tables that changed
+    since the last download. The changes are appended to the changelog, a .tsv file with the columns
+    'date', 'source', 'postal_code', 'change' ('new' or 'changed'), 'old_hash' and 'new_hash'
+    (the hashes of the tables saved).
+    :param onSale: bool, if true refresh the sales, if false the rents
+    :param pc_list: list of strings, the postal codes to query
+    :param housing_folder: str, the folder of the files (by default the one of sales or rents)
+    :param journal: the path of the crawl journal
+    :param changelog: the path of the changelog, or None to not write it
+    :param kwargs: other arguments for `all_queries_to_tsv` (e.g. rate, max_workers)
+    :return: tuple (list of the postal codes whose table changed, list of the postal codes that failed)
+    """
     filename = 'sale' if onSale else 'rent'
-    housing_folder = 'data/house_price/asuntojen_hintatiedot_' + filename
+    conn = open_journal(journal)
+    # Only the tables that were cleaned can be compared with the new ones
+    before = get_hashes(conn, filename, output=True, cleaned=True)
+    conn.close()
+    failed = all_queries_to_tsv(onSale=onSale, pc_list=pc_list, housing_folder=housing_folder, journal=journal,
+                                new_crawl=True, and_clean=True, **kwargs)
+    conn = open_journal(journal)
+    after = get_hashes(conn, filename, output=True, cleaned=True)
+    conn.close()
+
+    changed = sorted(pc for pc in set(pc_list) if pc in after and after[pc] != before.get(pc))
+    if changelog is not None and changed:
+        new_file = not os.path.exists(changelog)
+        today = time.strftime('%Y-%m-%d')
+        with open(changelog, 'a', encoding='utf-8') as f:
+            if new_file:
+                f.write('date\tsource\tpostal_code\tchange\told_hash\tnew_hash\n')
+            for pc in changed:
+                f.write('\t'.join([today, filename, pc, 'changed' if pc in before else 'new',
+                                   before.get(pc, ''), after[pc]]) + '\n')
+    print(str(len(changed)) + ' postal codes changed, ' + str(len(failed)) + ' failed')
+    return changed, failed
+
+
+def reparse_from_archive(onSale=True, housing_folder=None, archive=ARCHIVE_PATH, fetch_date=None, and_clean=True,
+                         processes=None):
+    """
+    Rebuild the .tsv file of each postal code from the last page saved in the archive, without the network
+    (e.g. after changing `parse_table`, `clean_sale` or `clean_rent`). The pages are parsed in parallel processes.
+    :param onSale: bool, if true rebuild the sales, if false the rents
+    :param housing_folder: str, the folder where to save the files (by default the one of sales or rents)
+    :param archive: the folder of the archive
+    :param fetch_date: str 'YYYY-MM-DD' or None, use the pages downloaded on or before this date (by default the last)
+    :param and_clean: bool, if true also clean the tables, as `clean(andSave=True)`
+    :param processes: int or None, the number of processes (by default the number of CPUs)
+    :return: list of the postal codes that could not be rebuilt
+    """
+    filename = 'sale' if onSale else 'rent'
+    if housing_folder is None:
+        housing_folder = 'data/house_price/asuntojen_hintatiedot_' + filename
     if not os.path.exists(housing_folder):
         os.makedirs(housing_folder)
 
-    for pc in pc_list:
-        df = get_one_postalcode(ps=pc, onSale=onSale)
-        file = str(pc) + '.tsv'
-        df.to_csv(os.path.join(housing_folder, file),
-                  sep='\t', index=False, encoding='utf-8')
-    return None
+    manifest = open_manifest(archive)
+    pages = latest_pages(manifest, filename, fetch_date)
+    manifest.close()
+    print('Parsing ' + str(len(pages)) + ' archived pages')
+
+    jobs = [(archive, sha, os.path.join(housing_folder, str(pc) + '.tsv'), onSale, and_clean)
+            for pc, sha in sorted(pages.items())]
+    failed = []
+    for job, _, error in run_concurrently(reparse_one, jobs, processes, executor=ProcessPoolExecutor):
+        if error is not None:
+            pc = Path(job[2]).stem
+            print('Could not parse ' + pc + ': ' + str(error))
+            failed.append(pc)
+    return sorted(failed)
 
 
 def clean_sale(df):
@@ -152,7 +349,8 @@ def clean_rent(df):
 def clean(onSale=True, andSave=False):
     """
     Read all the files collected from asuntojen hintatiedot and saved in the folder 'asuntojen_hintatiedot_sale'
-    or 'asuntojen_hintatiedot_rent' (missing files are downloaded by calling `all_queries_to_tsv`) into data frames,
+    or 'asuntojen_hintatiedot_rent' (missing and unreadable files are downloaded again by calling
+    `all_queries_to_tsv`, also the postal codes given up by previous crawls) into data frames,
     clean the data frames, and return a dictionary of data frames, where the postal code is the key.
     :param: onSales, bool, if true read and clean the sales, if false read and clean the rents
     :param: andSave, bool, if true save the data frames by overwriting the original .tsv files
@@ -169,14 +367,16 @@ def clean(onSale=True, andSave=False):
         all_queries_to_tsv(onSale=onSale)
         file_list = glob.glob(housing_folder + '/*.tsv')
 
-    # Extract back the postal codes
-    codes = sorted({(re.sub('[^0-9]+', '', y))[:5] for y in file_list})
+    # Extract back the postal codes from the names of the files
+    codes = sorted({Path(y).stem[:5] for y in file_list})
 
     if len(file_list) < len(pc_list):
         print('Folder has incomplete data!\n Doing the webscraping on missing values...')
-        missing = list(set(pc_list) - set(codes))
+        missing = sorted(set(pc_list) - set(codes))
         print(missing)
-        all_queries_to_tsv(onSale=onSale, pc_list=missing)
+        all_queries_to_tsv(onSale=onSale, pc_list=missing, retry_failed=True)
+        file_list = glob.glob(housing_folder + '/*.tsv')
+        codes = sorted({Path(y).stem[:5] for y in file_list})
 
     # Build a dictionary of DataFrames:
     # to each postal code, it is associated one DataFrame
@@ -184,27 +384,28 @@ def clean(onSale=True, andSave=False):
 
     # Fill one DataFrame per postalcode
     for file in file_list:
-        for code in codes:
-            if code in file:
-                try:
-                    # Read the file
-                    df_dic[code] = pd.read_csv(file, sep='\t', skiprows=0)
-                except:
-                    all_queries_to_tsv(onSale=onSale, pc_list=[code])
-                    df_dic[code] = pd.read_csv(file, sep='\t', skiprows=0)
-                if onSale:
-                    df_dic[code] = clean_sale(df_dic[code])
-                else:
-                    df_dic[code] = clean_rent(df_dic[code])
+        code = Path(file).stem[:5]
+        try:
+            # Read the file
+            df_dic[code] = pd.read_csv(file, sep='\t', skiprows=0)
+        except:
+            # The journal marks the postal code as done: without its file it is downloaded again
+            os.remove(file)
+            all_queries_to_tsv(onSale=onSale, pc_list=[code], retry_failed=True)
+            df_dic[code] = pd.read_csv(file, sep='\t', skiprows=0)
+        if onSale:
+            df_dic[code] = clean_sale(df_dic[code])
+        else:
+            df_dic[code] = clean_rent(df_dic[code])
 
-                # Save dataframe to file
-                if (andSave):
-                    print('Save postalcode: ' + str(code))
-                    df_folder = 'data/house_price/asuntojen_hintatiedot_' + filename
-                    if not os.path.exists(df_folder):
-                        os.makedirs(df_folder)
-                    df_dic[code].to_csv(Path(
-                        df_folder) / (str(code)[:5] + '.tsv'), sep='\t', index=False, encoding='utf-8')
+        # Save dataframe to file
+        if (andSave):
+            print('Save postalcode: ' + str(code))
+            df_folder = 'data/house_price/asuntojen_hintatiedot_' + filename
+            if not os.path.exists(df_folder):
+                os.makedirs(df_folder)
+            df_dic[code].to_csv(Path(
+                df_folder) / (str(code)[:5] + '.tsv'), sep='\t', index=False, encoding='utf-8')
 
     return df_dic
 
@@ -225,16 +426,11 @@ def sold_avg(df):
 def list_sold(pc_list=pc_list):
     """
     Build the list of average selling prices per square meter, for each postal code
+    (from the price store, see `price_store.average_prices`)
     :param pc_list: list of strings, where each string is a postal code
     :return: list of floats, with np.nan
     """
-    avg_price_list = []
-    for y in pc_list:
-        filename = str(y)[:5] + '.tsv'
-        df = pd.read_csv(Path('data/house_price/asuntojen_hintatiedot_sale') /
-                         filename, sep='\t', encoding='iso-8859-1')
-        avg_price_list.append(sold_avg(df))
-    return avg_price_list
+    return list(average_prices(pc_list)['Sell price'])
 
 
 def rent_avg(df, withARA=True):
@@ -281,19 +477,13 @@ def rent_avg(df, withARA=True):
 def list_rent(pc_list=pc_list):
     """
     Build the list of average selling prices per square meter, for each postal code
+    (from the price store, see `price_store.average_prices`)
     :param pc_list: list of strings, where each string is a postal code
     :return: tuple of 2 lists of floats, with np.nan; the first list includes ARA,
             the second list does not include ARA
     """
-    avg_ARA_price_list = []
-    avg_noARA_price_list = []
-    for y in pc_list:
-        filename = str(y)[:5] + '.tsv'
-        df = pd.read_csv(Path('data/house_price/asuntojen_hintatiedot_rent') /
-                         filename, sep='\t', encoding='iso-8859-1')
-        avg_ARA_price_list.append(rent_avg(df, withARA=True))
-        avg_noARA_price_list.append(rent_avg(df, withARA=False))
-    return avg_ARA_price_list, avg_noARA_price_list
+    prices = average_prices(pc_list)
+    return list(prices['Rent price with ARA']), list(prices['Rent price without ARA'])
 
 
 if __name__ == '__main__':
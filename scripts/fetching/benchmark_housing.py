@@ -0,0 +1,47 @@
+"""
+Measure the wall-clock time of the full 2005-2017 build of `fetch_paavo_housing`, without the network:
+the 65 tables of the quarters are synthetic (random prices for random postal codes, a third of them hidden)
+and are read from a temporary PxWeb cache in 'offline' mode. Run from the root of the project:
+    python -m scripts.fetching.benchmark_housing [max_workers ...]
+"""
+
+import contextlib
+import io
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from scripts.fetching import fetch_from_paavo, paavo_queries, pxweb_cache
+
+postal_code_file = 'data/geographic/postalcodes.tsv'
+density_file = 'data/demographic/density.tsv'
+
+
+def fill_cache(cache, seed=0):
+    """Save a synthetic table for each quarter in the cache"""
+    codes = pd.read_csv(postal_code_file, sep='\t')['Postal code'].astype(int).to_numpy()
+    rng = np.random.default_rng(seed)
+    for year in range(2005, 2018):
+        for quarter in range(5):
+            sub = np.sort(rng.choice(codes, 1700, replace=False))
+            mean = rng.integers(800, 6000, len(sub)).astype(object)
+            mean[rng.uniform(size=len(sub)) < 0.35] = '.'
+            df = pd.DataFrame({'Postal code': sub, 'Mean': mean, 'Number': rng.integers(1, 60, len(sub))})
+            pxweb_cache.store(paavo_queries.housing_url, fetch_from_paavo.housing_quarter_query(year, quarter),
+                              df.to_csv(index=False).encode('iso-8859-1'), cache=cache)
+
+
+def main(workers=(1, 4)):
+    with tempfile.TemporaryDirectory() as folder:
+        fill_cache(folder)
+        pxweb_cache.CACHE_PATH, pxweb_cache.MODE = folder, 'offline'
+        for max_workers in workers:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fetch_from_paavo.fetch_paavo_housing(folder, postal_code_file, density_file, int(max_workers))
+            print(f"max_workers={max_workers}: {time.perf_counter() - start:6.2f} s")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or (1, 4))
@@ -0,0 +1,84 @@
+"""
+Compare the time and the memory to read several years of a Paavo table from the PxWeb API
+as one .csv table per year (the old way, one call per year) and as one JSON-stat2 cube (one call).
+The responses are rebuilt from the tables saved in data/paavo/paavo_raw. Run from the root of the project:
+    python -m scripts.fetching.benchmark_jsonstat [name of the table, e.g. Population_structure]
+"""
+
+import glob
+import io
+import json
+import re
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scripts.fetching.jsonstat import decode
+
+paavo_raw = 'data/paavo/paavo_raw/'
+
+
+def load_responses(name):
+    """
+    :param name: str, the name of the table without the year
+    :return: dictionary of the years and the .csv responses, and the equivalent JSON-stat2 response (bytes)
+    """
+    files = sorted(glob.glob(paavo_raw + name + '_[0-9][0-9][0-9][0-9].csv'))
+    csv_responses = {f[-8:-4]: open(f, 'rb').read() for f in files}
+
+    # Cube postal code x variable x year, the variables without the year in their name
+    frames = {}
+    for year, content in csv_responses.items():
+        df = pd.read_csv(io.BytesIO(content), encoding='iso-8859-1', dtype=str).set_index('Postal code area')
+        df.index = df.index.str[:5]
+        df.columns = [re.sub(r', \d{4} \(', ' (', c) for c in df.columns]
+        frames[year] = df
+    codes = sorted(set().union(*[df.index for df in frames.values()]))
+    variables = list(dict.fromkeys(c for df in frames.values() for c in df.columns))
+    years = list(frames)
+    cube = np.stack([frames[y].reindex(index=codes, columns=variables).to_numpy() for y in years], axis=-1)
+    values = [None if v is None or v != v or v in ['..', '.'] else float(v) for v in cube.ravel()]
+    doc = {'version': '2.0', 'class': 'dataset', 'id': ['Postinumeroalue', 'Tiedot', 'Vuosi'],
+           'size': [len(codes), len(variables), len(years)],
+           'dimension': {'Postinumeroalue': {'category': {'index': {c: i for i, c in enumerate(codes)}}},
+                         'Tiedot': {'category': {'index': {v: i for i, v in enumerate(variables)}}},
+                         'Vuosi': {'category': {'index': {y: i for i, y in enumerate(years)}}}},
+           'value': values}
+    return csv_responses, json.dumps(doc).encode('utf-8')
+
+
+def read_csv_responses(csv_responses):
+    """The old way: one data frame per year"""
+    return {year: pd.read_csv(io.BytesIO(content), sep=',', encoding='iso-8859-1')
+            for year, content in csv_responses.items()}
+
+
+def read_jsonstat_response(content):
+    return decode(json.loads(content))
+
+
+def measure(name, read, data, repeat=5):
+    """Read 'repeat' times and print the time per read and the peak of the memory allocated by Python"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        read(data)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    read(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<32} {1000 * elapsed:8.1f} ms  peak {peak / 2 ** 20:7.2f} MiB")
+
+
+def main(name='Population_structure'):
+    csv_responses, jsonstat_response = load_responses(name)
+    cube = read_jsonstat_response(jsonstat_response)
+    print(name + ': ' + str(cube) + ', ' + str(sum(len(c) for c in csv_responses.values()) // 1024) +
+          ' kB of .csv, ' + str(len(jsonstat_response) // 1024) + ' kB of JSON-stat2')
+    measure(str(len(csv_responses)) + ' x .csv + pd.read_csv', read_csv_responses, csv_responses)
+    measure('1 x JSON-stat2 + decode', read_jsonstat_response, jsonstat_response)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,73 @@
+"""
+Compare the time to extract the table of the pages of asuntojen.hintatiedot.fi with BeautifulSoup and pd.read_html
+(the old way) and with the streaming lxml extractor 'html_table.read_table'. Run from the root of the project:
+    python -m scripts.fetching.benchmark_parser [folder with .html pages ...]
+By default the corpus is made of the test fixtures, and of pages rebuilt from the saved tables of sales
+(with the same number of rows and columns as the real pages).
+"""
+
+import glob
+import html
+import io
+import os
+import sys
+import time
+import pandas as pd
+from bs4 import BeautifulSoup
+from scripts.fetching.html_table import read_table
+
+fixtures = 'tests/fixtures/asuntojen_hintatiedot'
+
+
+def parse_with_read_html(content):
+    """The old parser of `asuntojen_hintatiedot.parse_table`"""
+    soup = BeautifulSoup(content, 'lxml')
+    soup = soup.find("table", {"id": "mainTable"})
+    if soup is None:
+        return pd.DataFrame()
+    return pd.read_html(io.StringIO(str(soup)))[0]
+
+
+def page_from_tsv(file):
+    """Rebuild the html page of a saved table"""
+    df = pd.read_csv(file, sep='\t', dtype=str, keep_default_na=False)
+    head = ''.join('<th>' + html.escape(c) + '</th>' for c in df.columns)
+    rows = ''.join('<tr>' + ''.join('<td>' + html.escape(v) + '</td>' for v in row) + '</tr>\n'
+                   for row in df.itertuples(index=False))
+    return ('<html><head><meta charset="utf-8"></head><body><table id="mainTable"><thead><tr>' + head +
+            '</tr></thead><tbody>\n' + rows + '</tbody></table></body></html>').encode('utf-8')
+
+
+def load_corpus(folders, n_tsv=500):
+    """
+    :param folders: list of folders with .html pages
+    :param n_tsv: int, the number of pages rebuilt from the saved tables of sales
+    :return: list of bytes
+    """
+    pages = [open(f, 'rb').read() for folder in folders for f in sorted(glob.glob(os.path.join(folder, '*.html')))]
+    tsv_files = sorted(glob.glob('data/house_price/asuntojen_hintatiedot_sale/*.tsv'))[:n_tsv]
+    return pages + [page_from_tsv(f) for f in tsv_files]
+
+
+def measure(name, parse, pages, repeat=3):
+    """Parse all the pages 'repeat' times and print the throughput"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            parse(page)
+    elapsed = time.perf_counter() - start
+    n = repeat * len(pages)
+    print(f"{name:<30} {n / elapsed:8.1f} pages/s  {1000 * elapsed / n:8.3f} ms/page")
+
+
+def main(folders=None):
+    pages = load_corpus(folders or [fixtures])
+    print(str(len(pages)) + ' pages, ' + str(sum(len(p) for p in pages) // 1024) + ' kB')
+    for page in pages:
+        pd.testing.assert_frame_equal(read_table(page), parse_with_read_html(page))
+    measure("BeautifulSoup + read_html", parse_with_read_html, pages)
+    measure("lxml read_table", read_table, pages)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
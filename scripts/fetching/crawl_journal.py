@@ -0,0 +1,167 @@
+# Journal of the scraping jobs, stored in SQLite, so that an interrupted crawl can be resumed
+# -*- coding: utf-8 -*- #
+
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+JOURNAL_PATH = Path('data/house_price/') / 'crawl_journal.sqlite'
+
+
+def open_journal(path=JOURNAL_PATH):
+    """
+    Open (or create) the crawl journal. For each kind of job ('sale' or 'rent') and each postal code
+    it keeps the status ('done' or 'failed'), the number of attempts, the last HTTP status,
+    the hash of the last content downloaded, the hash of the last table saved from it,
+    whether that table was cleaned, and the time of the last attempt.
+    :param path: the path of the SQLite file
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(str(path))
+    conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                        kind TEXT NOT NULL,
+                        postal_code TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        http_status INTEGER,
+                        content_hash TEXT,
+                        error TEXT,
+                        updated_at TEXT,
+                        output_hash TEXT,
+                        cleaned INTEGER,
+                        PRIMARY KEY (kind, postal_code))""")
+    # Journals created before the columns 'output_hash' and 'cleaned' were added
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+    for column, column_type in [('output_hash', 'TEXT'), ('cleaned', 'INTEGER')]:
+        if column not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN " + column + " " + column_type)
+    conn.commit()
+    return conn
+
+
+def record_attempt(conn, kind, postal_code, status, http_status=None, content_hash=None, error=None,
+                   output_hash=None, cleaned=None):
+    """
+    Record the result of one attempt. The attempts are counted, and the hashes
+    of a failed attempt do not overwrite the hashes of the last successful one.
+    :param conn: the journal
+    :param kind: str, 'sale' or 'rent'
+    :param postal_code: str
+    :param status: str, 'done' or 'failed'
+    :param http_status: int or None, the HTTP status of the response
+    :param content_hash: str or None, the hash of the content
+    :param error: str or None, the error message
+    :param output_hash: str or None, the hash of the table saved
+    :param cleaned: bool or None, if the table saved was cleaned
+    :return: None
+    """
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute("""INSERT INTO jobs (kind, postal_code, status, attempts, http_status, content_hash, error, updated_at,
+                                      output_hash, cleaned)
+                    VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (kind, postal_code) DO UPDATE SET
+                        status = excluded.status,
+                        attempts = attempts + 1,
+                        http_status = excluded.http_status,
+                        content_hash = COALESCE(excluded.content_hash, content_hash),
+                        error = excluded.error,
+                        updated_at = excluded.updated_at,
+                        output_hash = COALESCE(excluded.output_hash, output_hash),
+                        cleaned = COALESCE(excluded.cleaned, cleaned)""",
+                 (kind, postal_code, status, http_status, content_hash, error, now, output_hash,
+                  None if cleaned is None else int(cleaned)))
+    conn.commit()
+
+
+def start_new_crawl(conn, kind, codes=None, failed_only=False):
+    """
+    Mark the jobs of 'kind' as to do again, keeping their last content hash.
+    :param conn: the journal
+    :param kind: str, 'sale' or 'rent'
+    :param codes: list of postal codes, or None for all the jobs of 'kind'
+    :param failed_only: bool, if true only the failed jobs (also the ones given up after 'max_attempts')
+    :return: None
+    """
+    query = "UPDATE jobs SET status = 'pending', attempts = 0, error = NULL WHERE kind = ?"
+    if failed_only:
+        query += " AND status = 'failed'"
+    if codes is None:
+        conn.execute(query, (kind,))
+    else:
+        conn.executemany(query + " AND postal_code = ?", [(kind, str(code)) for code in codes])
+    conn.commit()
+
+
+def codes_to_fetch(conn, kind, codes, max_attempts=3, folder=None):
+    """
+    Select the postal codes that still have to be downloaded: the ones never tried,
+    the failed ones that have been tried less than 'max_attempts' times,
+    and the done ones whose file is missing in 'folder' (e.g. deleted because it could not be read).
+    :param conn: the journal
+    :param kind: str, 'sale' or 'rent'
+    :param codes: list of postal codes
+    :param max_attempts: int, the maximum number of attempts for a postal code
+    :param folder: str or None, the folder of the files <postal code>.tsv (None to not check them)
+    :return: list of postal codes, in the same order as 'codes'
+    """
+    jobs = dict(((code, (status, attempts)) for code, status, attempts in
+                 conn.execute("SELECT postal_code, status, attempts FROM jobs WHERE kind = ?", (kind,))))
+    todo = []
+    for code in codes:
+        status, attempts = jobs.get(code, ('pending', 0))
+        if status == 'done':
+            if folder is not None and not os.path.exists(os.path.join(folder, str(code) + '.tsv')):
+                todo.append(code)
+        elif attempts < max_attempts:
+            todo.append(code)
+    return todo
+
+
+def get_hashes(conn, kind, output=False, cleaned=None):
+    """
+    :param conn: the journal
+    :param kind: str, 'sale' or 'rent'
+    :param output: bool, if true the hashes of the tables saved, if false the hashes of the contents downloaded
+    :param cleaned: bool or None, with 'output', only the tables saved cleaned (true) or not cleaned (false)
+    :return: dictionary of postal codes and the hash of their last downloaded content (or saved table)
+    """
+    column = 'output_hash' if output else 'content_hash'
+    query = "SELECT postal_code, " + column + " FROM jobs WHERE kind = ? AND " + column + " IS NOT NULL"
+    if cleaned is None:
+        return dict(conn.execute(query, (kind,)))
+    return dict(conn.execute(query + " AND cleaned = ?", (kind, int(cleaned))))
+
+
+def summary(conn, kind=None):
+    """
+    Summarize the journal.
+    :param conn: the journal
+    :param kind: str or None, 'sale' or 'rent' (None for both)
+    :return: dictionary where the keys are the kinds, and the values are dictionaries with
+            the number of jobs per status ('done', 'failed', 'pending') and the list of 'failed_codes'
+            as (postal code, attempts, last HTTP status, last error) tuples
+    """
+    kinds = [kind] if kind is not None else [k for (k,) in conn.execute("SELECT DISTINCT kind FROM jobs")]
+    report = {}
+    for k in kinds:
+        counts = {'done': 0, 'failed': 0, 'pending': 0}
+        counts.update(conn.execute("SELECT status, COUNT(*) FROM jobs WHERE kind = ? GROUP BY status", (k,)))
+        counts['failed_codes'] = conn.execute("""SELECT postal_code, attempts, http_status, error FROM jobs
+                                                 WHERE kind = ? AND status = 'failed' ORDER BY postal_code""",
+                                              (k,)).fetchall()
+        report[k] = counts
+    return report
+
+
+def print_summary(conn, kind=None):
+    """Print the summary of the journal"""
+    for k, counts in summary(conn, kind).items():
+        print(k + ': ' + str(counts['done']) + ' done, ' + str(counts['failed']) + ' failed, ' +
+              str(counts['pending']) + ' pending')
+        for code, attempts, http_status, error in counts['failed_codes']:
+            print('\t' + code + '\tattempts: ' + str(attempts) + '\tHTTP ' + str(http_status) + '\t' + str(error))
+
+
+if __name__ == '__main__':
+    print_summary(open_journal())
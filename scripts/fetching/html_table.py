@@ -0,0 +1,136 @@
+# Fast extraction of one html table into a data frame, with the same result as pd.read_html
+# -*- coding: utf-8 -*- #
+
+import io
+import re
+import pandas as pd
+from lxml import etree
+from pandas.io.parsers import TextParser
+
+whitespace = re.compile(r'[\r\n]+|\s{2,}')
+
+
+def cell_text(cell):
+    """
+    :param cell: the td or th element
+    :return: str, its text with the extra whitespace removed, as in pd.read_html
+    """
+    return whitespace.sub(' ', ''.join(cell.itertext()).strip())
+
+
+def expand_spans(rows):
+    """
+    Expand the cells with colspan or rowspan into repeated cells, as in pd.read_html.
+    :param rows: list of rows, where each row is a list of (text, rowspan, colspan) tuples
+    :return: list of rows, where each row is a list of str
+    """
+    all_texts = []
+    remainder = []  # (column index, text, rows left) of the cells spanning from the rows above
+    for row in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for text, rowspan, colspan in row:
+            while remainder and remainder[0][0] <= index:
+                prev_i, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append((prev_i, prev_text, prev_rowspan - 1))
+                index += 1
+            texts.extend([text] * colspan)
+            if rowspan > 1:
+                next_remainder.extend((index + i, text, rowspan - 1) for i in range(colspan))
+            index += colspan
+        for prev_i, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_i, prev_text, prev_rowspan - 1))
+        all_texts.append(texts)
+        remainder = next_remainder
+    # Rows made only by cells spanning from above
+    while remainder:
+        next_remainder = []
+        texts = []
+        for prev_i, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_i, prev_text, prev_rowspan - 1))
+        all_texts.append(texts)
+        remainder = next_remainder
+    return all_texts
+
+
+def span(cell, attribute):
+    value = cell.get(attribute, '1')
+    return int(value) if value.isdigit() and int(value) > 0 else 1
+
+
+def read_table(content, table_id='mainTable', encoding='utf-8'):
+    """
+    Extract the table with the given id from an html page, streaming through the page with lxml:
+    the rows are collected while the page is being parsed, and the parsing stops at the end of the table.
+    The result is the same data frame as pd.read_html(page, attrs={'id': table_id})[0]:
+    the header is the thead (a MultiIndex when it has more than one row, or the first rows made only of th
+    when there is no thead), the cells with colspan and rowspan are repeated,
+    and the columns are typed in the same way (with ',' as thousands separator).
+    :param content: bytes, the html page
+    :param table_id: str, the id of the table
+    :param encoding: str, the encoding of the page
+    :return: a data frame (empty if the page has no such table)
+    """
+    sections = {'thead': [], 'tbody': [], 'table': [], 'tfoot': []}
+    found = False
+    try:
+        for event, element in etree.iterparse(io.BytesIO(content), events=('start', 'end'), html=True,
+                                              encoding=encoding, tag=('table', 'tr')):
+            if element.tag == 'table':
+                if element.get('id') != table_id:
+                    continue
+                if event == 'end':
+                    break
+                found = True
+            elif event == 'end' and found:
+                section = next((a.tag for a in element.iterancestors() if a.tag in sections), 'table')
+                cells = [cell for cell in element if cell.tag in ('td', 'th')]
+                sections[section].append(([(cell_text(c), span(c, 'rowspan'), span(c, 'colspan')) for c in cells],
+                                          all(c.tag == 'th' for c in cells)))
+                element.clear()
+    except etree.XMLSyntaxError:
+        # Empty page
+        pass
+    if not found:
+        return pd.DataFrame()
+
+    # As in pd.read_html, the rows in tbody come before the rows directly in the table
+    head, body, foot = sections['thead'], sections['tbody'] + sections['table'], sections['tfoot']
+    if not head:
+        # The table has no thead: the first rows made only of th are the header
+        while body and body[0][1]:
+            head.append(body.pop(0))
+    return to_frame(*(expand_spans([cells for cells, _ in rows]) for rows in [head, body, foot]))
+
+
+def to_frame(head, body, foot):
+    """
+    Build the data frame from the texts of the cells, as pd.read_html does.
+    :param head: list of header rows
+    :param body: list of rows
+    :param foot: list of footer rows
+    :return: the data frame
+    """
+    header = None
+    if head:
+        body = head + body
+        if len(head) == 1:
+            header = 0
+        else:
+            # Ignore the header rows without text
+            header = [i for i, row in enumerate(head) if any(text for text in row)]
+    body = body + foot
+    if not body:
+        return pd.DataFrame()
+    # Fill the rows that are shorter than the others
+    width = max(len(row) for row in body)
+    body = [row + [''] * (width - len(row)) for row in body]
+    with TextParser(body, header=header, thousands=',', decimal='.', skiprows=0) as parser:
+        return parser.read()
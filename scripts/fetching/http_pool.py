@@ -0,0 +1,138 @@
+# Shared HTTP engine for the scrapers: pooled keep-alive connections,
+# a polite per-host rate limit, bounded retries with jittered backoff, and timeouts.
+# -*- coding: utf-8 -*- #
+
+import random
+import threading
+from collections import deque
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = 'Kodimpi data fetcher (https://github.com/xiaoxiaobt/Reaktor-Data-Science-project)'
+
+# HTTP status codes worth retrying: rate limited or temporary server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+    Allow at most 'rate' requests per second to each host, shared by all the threads.
+    Requests to a host are spaced evenly, 1 / rate seconds apart.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        if self.interval == 0.0:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RequestBudget:
+    """
+    Allow at most 'max_requests' requests in any window of 'period' seconds, shared by all the threads,
+    as the APIs that limit the number of queries per time window (e.g. PxWeb: 30 queries per 10 seconds).
+    Unlike RateLimiter, the requests can be sent in bursts as long as the budget is not used up.
+    """
+
+    def __init__(self, max_requests, period):
+        self.max_requests = max_requests
+        self.period = period
+        self.lock = threading.Lock()
+        self.sent = deque()
+
+    def wait(self, url=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.sent and self.sent[0] <= now - self.period:
+                    self.sent.popleft()
+                if len(self.sent) < self.max_requests:
+                    self.sent.append(now)
+                    return
+                delay = self.sent[0] + self.period - now
+            time.sleep(delay)
+
+
+def make_session(pool_size=8):
+    """
+    Build a requests.Session whose connection pool can keep 'pool_size' connections alive,
+    so that the worker threads reuse connections instead of opening a new one per request.
+    :param pool_size: int, the number of connections kept per host
+    :return: the session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def fetch(session, url, method='GET', limiter=None, retries=4, backoff=1.0, timeout=(10, 60), **kwargs):
+    """
+    Perform one HTTP request, retrying on connection errors, timeouts and 429/5xx responses.
+    Before each retry it sleeps a random time between 0 and backoff * 2^attempt seconds (full jitter),
+    or the time asked by the server in the Retry-After header.
+    :param session: the requests.Session to use
+    :param url: str, the url
+    :param method: str, the HTTP method
+    :param limiter: RateLimiter or None
+    :param retries: int, the maximum number of retries after the first attempt
+    :param backoff: float, the base of the backoff in seconds
+    :param timeout: the connect and read timeouts in seconds, as for requests
+    :param kwargs: other arguments for session.request (e.g. json=query)
+    :return: the last response received (its status code can still be an error)
+    :raise requests.RequestException: if the last attempt failed without a response
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait(url)
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = float(retry_after)
+            print('HTTP ' + str(response.status_code) + ' from ' + url + ', retrying')
+            # Give the connection back to the pool (with stream=True the body is not read)
+            response.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            print('OOPS!! ' + type(e).__name__ + ' from ' + url + ', retrying')
+        time.sleep(delay)
+
+
+def run_concurrently(function, items, max_workers=8, executor=ThreadPoolExecutor):
+    """
+    Call 'function' on each item in a thread pool, and yield (item, result, error) as soon as each call is done.
+    'error' is None if the call succeeded, otherwise it is the exception and 'result' is None.
+    :param function: function taking one item
+    :param items: iterable of items
+    :param max_workers: int, the maximum number of concurrent calls
+    :param executor: the class of the pool (ProcessPoolExecutor for functions that need the CPU,
+            in that case 'function' and the items must be picklable)
+    :return: generator of (item, result, error) tuples, in order of completion
+    """
+    with executor(max_workers=max_workers) as pool:
+        futures = {pool.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
@@ -0,0 +1,162 @@
+# Reader of the JSON-stat responses of the PxWeb API ("format": "json-stat" for version 1, "json-stat2" for version 2).
+# A JSON-stat dataset is a cube: the values are listed in row-major order of the dimensions
+# (e.g. postal code x variable x year), so they are decoded directly into an N-dimensional NumPy array,
+# with the codes and the labels of the categories of each axis.
+# -*- coding: utf-8 -*- #
+
+import copy
+import numpy as np
+import pandas as pd
+
+
+class Cube:
+    """
+    N-dimensional array with labelled axes.
+    'dimensions' are the ids of the axes (e.g. ['Postinumeroalue', 'Tiedot', 'Vuosi']), 'codes' and 'labels'
+    map each id to the codes and to the labels of its categories, in the order of the axis, and 'values' is
+    the float64 array of shape (len(codes[d]) for d in dimensions), with NaN for the missing values.
+    'status' maps the flat positions of the missing values to their symbol ('..' protected, '.' no data).
+    """
+
+    def __init__(self, dimensions, codes, labels, values, status=None):
+        self.dimensions = list(dimensions)
+        self.codes = codes
+        self.labels = labels
+        self.values = values
+        self.status = status or {}
+
+    def __repr__(self):
+        return 'Cube(' + ' x '.join(d + ' (' + str(len(self.codes[d])) + ')' for d in self.dimensions) + ')'
+
+    def axis(self, dimension):
+        return self.dimensions.index(dimension)
+
+    def select(self, **selection):
+        """
+        :param selection: for some dimensions, the code or the list of codes to keep
+                (a single code removes the dimension)
+        :return: Cube
+        """
+        values = self.values
+        dimensions, codes, labels = [], {}, {}
+        index = []
+        for d in self.dimensions:
+            if d not in selection:
+                index.append(slice(None))
+            elif isinstance(selection[d], (list, tuple)):
+                index.append([self.codes[d].index(c) for c in selection[d]])
+            else:
+                index.append(self.codes[d].index(selection[d]))
+                continue
+            dimensions.append(d)
+            positions = range(len(self.codes[d])) if index[-1] == slice(None) else index[-1]
+            codes[d] = [self.codes[d][i] for i in positions]
+            labels[d] = [self.labels[d][i] for i in positions]
+        # Index the axes one at a time, so that lists of codes select a sub-cube (not pairs of positions)
+        for i, ix in reversed(list(enumerate(index))):
+            values = values[(slice(None),) * i + (ix,)]
+        return Cube(dimensions, codes, labels, values)
+
+    def to_frame(self, index, use_labels=False):
+        """
+        :param index: list of the dimensions in the rows, the others are in the columns
+        :param use_labels: bool, if true use the labels of the categories instead of their codes
+        :return: data frame (with a MultiIndex if there are several dimensions in the rows or in the columns)
+        """
+        names = self.labels if use_labels else self.codes
+        columns = [d for d in self.dimensions if d not in index]
+        order = [self.axis(d) for d in index + columns]
+        n_rows = int(np.prod([len(self.codes[d]) for d in index]))
+        values = self.values.transpose(order).reshape(n_rows, -1)
+
+        def make_index(dims):
+            if len(dims) == 1:
+                return pd.Index(names[dims[0]], name=dims[0])
+            return pd.MultiIndex.from_product([names[d] for d in dims], names=dims)
+
+        return pd.DataFrame(values, index=make_index(index), columns=make_index(columns) if columns else None)
+
+
+def category_codes(dimension, size):
+    """
+    :param dimension: dictionary, one dimension of a JSON-stat dataset
+    :param size: int, the number of categories
+    :return: list of the codes of the categories, in the order of the axis
+    """
+    category = dimension.get('category', {})
+    index = category.get('index')
+    if index is None:
+        # Optional when there is only one category
+        index = list(category.get('label', {}).keys())
+    if isinstance(index, dict):
+        codes = [None] * size
+        for code, position in index.items():
+            codes[position] = code
+        return codes
+    return list(index)
+
+
+def decode(doc):
+    """
+    Decode a JSON-stat dataset of version 1 (as returned by PxWeb for "json-stat") or 2 ("json-stat2").
+    :param doc: dictionary, the parsed JSON
+    :return: Cube
+    """
+    if doc.get('class') == 'dataset' or ('value' in doc and 'id' in doc):
+        # Version 2: the ids and the sizes are at the top level
+        dataset = doc
+        ids, sizes = doc['id'], doc['size']
+    else:
+        # Version 1: a bundle of datasets, the first one is used ('dataset' for PxWeb)
+        dataset = doc['dataset'] if 'dataset' in doc else next(iter(doc.values()))
+        ids, sizes = dataset['dimension']['id'], dataset['dimension']['size']
+
+    codes, labels = {}, {}
+    for d, size in zip(ids, sizes):
+        dimension = dataset['dimension'][d]
+        codes[d] = category_codes(dimension, size)
+        label = dimension.get('category', {}).get('label', {})
+        labels[d] = [label.get(c, c) for c in codes[d]]
+
+    value = dataset['value']
+    if isinstance(value, dict):
+        # Sparse values: {position: value}
+        values = np.full(int(np.prod(sizes)), np.nan)
+        positions = np.fromiter((int(k) for k in value.keys()), dtype=np.int64, count=len(value))
+        values[positions] = np.array(list(value.values()), dtype=np.float64)
+    else:
+        values = np.array(value, dtype=np.float64)
+
+    return Cube(ids, codes, labels, values.reshape(sizes), decode_status(dataset.get('status'), len(values)))
+
+
+def decode_status(status, n):
+    """
+    :param status: the status of a JSON-stat dataset: None, a string for all the values,
+            a list with one string per value, or a dictionary {position: string}
+    :param n: int, the number of values
+    :return: dictionary {position: string}
+    """
+    if not status:
+        return {}
+    if isinstance(status, str):
+        status = [status] * n
+    if isinstance(status, list):
+        return {i: s for i, s in enumerate(status) if s}
+    return {int(k): s for k, s in status.items()}
+
+
+def with_selection(query, response_format='json-stat2', **selection):
+    """
+    Copy a PxWeb query, selecting several values of some variables, to get them in one call.
+    :param query: dictionary, the PxWeb query
+    :param response_format: str, the format of the response
+    :param selection: for some variables (e.g. Vuosi=['2015', '2016']), the list of values to select
+    :return: dictionary, the new query
+    """
+    query = copy.deepcopy(query)
+    query['query'] = [q for q in query['query'] if q['code'] not in selection] + \
+                     [{"code": code, "selection": {"filter": "item", "values": [str(v) for v in values]}}
+                      for code, values in selection.items()]
+    query['response'] = {"format": response_format}
+    return query
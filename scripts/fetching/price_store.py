@@ -0,0 +1,243 @@
+# Consolidated store of the data collected from asuntojen.hintatiedot.fi:
+# all the sales and all the rent tables in two Parquet files, with a 'Postal code' column and typed columns,
+# instead of 2 x 3026 small .tsv files
+# -*- coding: utf-8 -*- #
+
+import glob
+import os
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+sale_folder = Path('data/house_price/asuntojen_hintatiedot_sale')
+rent_folder = Path('data/house_price/asuntojen_hintatiedot_rent')
+store_folder = Path('data/house_price/price_store')
+
+# Numeric columns of the tables; all the other columns are kept as strings
+sale_numeric = ['m2', 'Vh', 'm21', 'Rv']
+rent_numeric = ['Keskivuokra ARA-vuokra', 'Keskivuokra Vapaarah. vanhat', 'Keskivuokra Vapaarah. uudet',
+                'Kuukausivuokra ARA-vuokra', 'Kuukausivuokra Vapaarah. vanhat', 'Kuukausivuokra Vapaarah. uudet']
+
+
+def read_folder(folder, codes=None):
+    """
+    Read the .tsv files of a folder into one data frame, with the postal code (the name of the file)
+    in the first column 'Postal code'. All the columns are read as strings.
+    :param folder: the folder with one .tsv file per postal code
+    :param codes: list of the postal codes to read, or None to read all the files
+    :return: the data frame, sorted by postal code
+    """
+    if codes is None:
+        files = sorted(glob.glob(os.path.join(str(folder), '*.tsv')))
+    else:
+        files = [os.path.join(str(folder), str(c)[:5] + '.tsv') for c in sorted(codes)]
+    frames = []
+    for file in files:
+        df = pd.read_csv(file, sep='\t', dtype=str, encoding='utf-8')
+        df.insert(0, 'Postal code', Path(file).stem[:5])
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def type_columns(df, numeric):
+    """
+    Convert the columns in 'numeric' to numbers ('-' and other placeholders become NaN),
+    as integers when no value is missing, and the other columns to strings.
+    :param df: the data frame
+    :param numeric: list of the numeric columns
+    :return: the data frame
+    """
+    for c in df.columns:
+        if c in numeric:
+            values = pd.to_numeric(df[c], errors='coerce')
+            if values.notna().all() and (values == values.round()).all():
+                values = values.astype(np.int64)
+            df[c] = values
+        else:
+            df[c] = df[c].astype(object).where(df[c].notna(), None)
+    return df
+
+
+def build_price_store(sale_folder=sale_folder, rent_folder=rent_folder, store_folder=store_folder):
+    """
+    Read the .tsv files of sales and rents, and write them as 'sales.parquet' and 'rents.parquet'.
+    The rent tables lose the row left by the second header line of the web page ('Unnamed: 0_level_1'),
+    so a postal code without data has no rows.
+    :param sale_folder: the folder of the sales, one .tsv file per postal code
+    :param rent_folder: the folder of the rents, one .tsv file per postal code
+    :param store_folder: the folder where to save the two files
+    :return: None
+    """
+    build_store_file('sales', sale_folder, store_folder)
+    build_store_file('rents', rent_folder, store_folder)
+
+
+def build_store_file(name, folder, store_folder=store_folder):
+    """
+    Read the .tsv files of sales or rents, and write them as one file of the store.
+    :param name: str, 'sales' or 'rents'
+    :param folder: the folder of the sales or of the rents, one .tsv file per postal code
+    :param store_folder: the folder of the store
+    :return: None
+    """
+    if not os.path.exists(store_folder):
+        os.makedirs(store_folder)
+    if name == 'sales':
+        df = type_columns(read_folder(folder), sale_numeric)
+    else:
+        df = type_columns(read_rents(folder), rent_numeric)
+    df.to_parquet(Path(store_folder) / (name + '.parquet'), index=False)
+    print('Saved ' + str(len(df)) + (' sales' if name == 'sales' else ' rows of rent tables'))
+
+
+def is_stale(path, folder):
+    """
+    :param path: the path of one file of the store
+    :param folder: the folder of the .tsv files it is built from
+    :return: bool, true if a .tsv file was written (or a file added or removed) after the file of the store
+    """
+    if not os.path.exists(folder):
+        return False
+    built = os.stat(path).st_mtime
+    if os.stat(folder).st_mtime > built:
+        return True
+    with os.scandir(folder) as entries:
+        return any(entry.name.endswith('.tsv') and entry.stat().st_mtime > built for entry in entries)
+
+
+def read_rents(folder, codes=None):
+    """Read the rent tables, without the row left by the second header line of the web page"""
+    rents = read_folder(folder, codes)
+    return rents[~rents['Unnamed'].str.startswith('Unnamed', na=False)].reset_index(drop=True)
+
+
+def update_price_store(sale_codes=(), rent_codes=(), sale_folder=sale_folder, rent_folder=rent_folder,
+                       store_folder=store_folder):
+    """
+    Replace in the store only the postal codes whose .tsv files changed (see `refresh_prices`),
+    or build the whole store if it does not exist.
+    :param sale_codes: list of the postal codes whose sales changed
+    :param rent_codes: list of the postal codes whose rents changed
+    :param sale_folder: the folder of the sales, one .tsv file per postal code
+    :param rent_folder: the folder of the rents, one .tsv file per postal code
+    :param store_folder: the folder of the store
+    :return: None
+    """
+    if not (Path(store_folder) / 'sales.parquet').exists() or not (Path(store_folder) / 'rents.parquet').exists():
+        build_price_store(sale_folder, rent_folder, store_folder)
+        return
+    if len(sale_codes) > 0:
+        replace_codes('sales', sale_codes, read_folder(sale_folder, sale_codes), sale_numeric, store_folder)
+    if len(rent_codes) > 0:
+        replace_codes('rents', rent_codes, read_rents(rent_folder, rent_codes), rent_numeric, store_folder)
+
+
+def replace_codes(name, codes, new_rows, numeric, store_folder=store_folder):
+    """
+    Replace the rows of some postal codes in one file of the store.
+    :param name: str, 'sales' or 'rents'
+    :param codes: list of postal codes
+    :param new_rows: data frame with the new rows of the postal codes (read as strings)
+    :param numeric: list of the numeric columns
+    :param store_folder: the folder of the store
+    :return: None
+    """
+    path = Path(store_folder) / (name + '.parquet')
+    df = pd.read_parquet(path)
+    df = df[~df['Postal code'].isin([str(c)[:5] for c in codes])]
+    df = pd.concat([df, type_columns(new_rows, numeric)], ignore_index=True)
+    df = type_columns(df.sort_values('Postal code', kind='stable').reset_index(drop=True), numeric)
+    df.to_parquet(path, index=False)
+    print('Updated ' + str(len(codes)) + ' postal codes in ' + name)
+
+
+def load(name, codes=None, store_folder=store_folder, folder=None):
+    """
+    Read one file of the store, building it first if it does not exist or if the .tsv files changed since
+    (e.g. written again by `all_queries_to_tsv`, `clean(andSave=True)` or `reparse_from_archive`).
+    :param name: str, 'sales' or 'rents'
+    :param codes: list of postal codes to read, or None to read all of them
+    :param store_folder: the folder of the store
+    :param folder: the folder of the .tsv files (by default the one of sales or rents)
+    :return: data frame
+    """
+    if folder is None:
+        folder = sale_folder if name == 'sales' else rent_folder
+    path = Path(store_folder) / (name + '.parquet')
+    if not path.exists():
+        print('Price store not found!\n Building it from the .tsv files...')
+        build_store_file(name, folder, store_folder)
+    elif is_stale(path, folder):
+        print('Price store older than the .tsv files!\n Building it again...')
+        build_store_file(name, folder, store_folder)
+    filters = None if codes is None else [('Postal code', 'in', [str(c)[:5] for c in codes])]
+    return pd.read_parquet(path, filters=filters)
+
+
+def load_sales(codes=None, store_folder=store_folder, sale_folder=sale_folder):
+    """
+    :param codes: list of postal codes to read, or None to read all of them
+    :param store_folder: the folder of the store
+    :param sale_folder: the folder of the .tsv files of the sales
+    :return: data frame of the sales, one row per apartment sold, with the columns of the web page
+            ('Kaupunginosa', 'Huoneisto', 'Talot', 'm2', 'Vh', 'm21', 'Rv', ...) and 'Postal code'
+    """
+    return load('sales', codes, store_folder, sale_folder)
+
+
+def load_rents(codes=None, store_folder=store_folder, rent_folder=rent_folder):
+    """
+    :param codes: list of postal codes to read, or None to read all of them
+    :param store_folder: the folder of the store
+    :param rent_folder: the folder of the .tsv files of the rents
+    :return: data frame of the rent tables, with 'Postal code', the row label 'Unnamed'
+            ('1h', '2h', '3h+', 'Kaikki' or 'Lkm') and the average rents per square meter and per month
+    """
+    return load('rents', codes, store_folder, rent_folder)
+
+
+def average_prices(codes, store_folder=store_folder):
+    """
+    Compute in one pass over the store, for each postal code:
+    - 'Sell price': the average selling price per square meter (as `sold_avg`)
+    - 'Rent price with ARA': the average rent per square meter, weighted by the number of apartments,
+      of ARA, old and new private apartments (as `rent_avg(withARA=True)`)
+    - 'Rent price without ARA': the same, of old and new private apartments only (as `rent_avg(withARA=False)`)
+    A missing price ('-') counts as 0 apartments at 0 €, and an average equal to 0 is NaN.
+    :param codes: list of postal codes
+    :return: data frame with one row per postal code, in the same order as 'codes'
+    """
+    codes = [str(c)[:5] for c in codes]
+    sales = load_sales(codes, store_folder=store_folder)
+    sell = sales.groupby('Postal code')['m21'].mean()
+
+    cols = ['Keskivuokra ARA-vuokra', 'Keskivuokra Vapaarah. vanhat', 'Keskivuokra Vapaarah. uudet']
+    rents = load_rents(codes, store_folder=store_folder)
+    rents = rents[rents['Unnamed'].isin(['Kaikki', 'Lkm'])]
+    rents = rents.set_index(['Postal code', 'Unnamed'])[cols].fillna(0.0).unstack('Unnamed')
+    # Only the postal codes with both the prices and the numbers of apartments
+    rents = rents[rents.notna().all(axis=1)]
+    price = [rents[(c, 'Kaikki')] for c in cols]
+    lkm = [rents[(c, 'Lkm')].astype(np.int64) for c in cols]
+    # The sums are done in the same order as in `rent_avg`, to get the same floats
+    private_sum = price[1] * lkm[1] + price[2] * lkm[2]
+    ara_sum = price[0] * lkm[0] + price[1] * lkm[1] + price[2] * lkm[2]
+    private = (private_sum / (lkm[1] + lkm[2])).where(private_sum != 0.0)
+    ara = (ara_sum / (lkm[0] + lkm[1] + lkm[2])).where(ara_sum != 0.0)
+
+    return pd.DataFrame({'Sell price': sell.reindex(codes).values,
+                         'Rent price with ARA': ara.reindex(codes).values,
+                         'Rent price without ARA': private.reindex(codes).values}, dtype=np.float64)
+
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    read_folder(sale_folder)
+    read_folder(rent_folder)
+    print('Reading the .tsv files: ' + str(round(time.perf_counter() - start, 2)) + ' s')
+    build_price_store()
+    start = time.perf_counter()
+    load_sales()
+    load_rents()
+    print('Reading the price store: ' + str(round(time.perf_counter() - start, 3)) + ' s')
@@ -0,0 +1,151 @@
+# Cache on disk of the tables downloaded from the PxWeb API, so that the data pipeline can be run again
+# without downloading the same tables. An entry is keyed by the url and the query (canonical JSON),
+# compressed with gzip, with the extension of the format of the response:
+#   <cache>/ab/abcdef....csv.gz   (.json.gz for "json-stat" and "json-stat2", .px.gz, ...)
+# The modes of the cache are:
+#   'use'      read the entries younger than the TTL, download and save the others (default)
+#   'refresh'  always download, and replace the entries
+#   'offline'  only read the cache, whatever the age of the entries; a missing entry raises CacheMiss
+#   'off'      neither read nor write the cache
+# The default mode can be set with the environment variable PXWEB_CACHE_MODE (e.g. PXWEB_CACHE_MODE=offline)
+# or by changing MODE.
+# -*- coding: utf-8 -*- #
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+CACHE_PATH = Path('data/paavo/') / 'pxweb_cache'
+MODES = ['use', 'refresh', 'offline', 'off']
+
+# Defaults of the module, read when the functions are called
+MODE = os.environ.get('PXWEB_CACHE_MODE', 'use')
+# Maximum age of an entry in seconds, None for no limit
+TTL = None
+
+
+class CacheMiss(LookupError):
+    """Raised in 'offline' mode when a table is not in the cache"""
+
+
+def cache_key(url, query):
+    """
+    :param url: str, the url of the table
+    :param query: dictionary, the PxWeb query
+    :return: str, the sha256 of the url and of the query in canonical JSON (sorted keys, no spaces)
+    """
+    canonical = json.dumps(query, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256((url + '\n' + canonical).encode('utf-8')).hexdigest()
+
+
+def response_extension(query):
+    """
+    :param query: dictionary, the PxWeb query
+    :return: str, the extension of the files in the format of the response ('csv' by default, 'json' for JSON-stat)
+    """
+    response_format = str(query.get('response', {}).get('format', 'csv')).lower()
+    return 'json' if response_format.startswith('json') else response_format
+
+
+def entry_path(url, query, cache=None):
+    key = cache_key(url, query)
+    return Path(cache or CACHE_PATH) / key[:2] / (key + '.' + response_extension(query) + '.gz')
+
+
+def lookup(url, query, mode=None, ttl=None, cache=None):
+    """
+    Find the entry of a table that can be used instead of downloading it.
+    :param url: str, the url of the table
+    :param query: dictionary, the PxWeb query
+    :param mode: str, one of MODES (by default MODE)
+    :param ttl: float, the maximum age of the entry in seconds (by default TTL), ignored in 'offline' mode
+    :param cache: the folder of the cache (by default CACHE_PATH)
+    :return: the path of the entry, or None if the table must be downloaded
+    :raise CacheMiss: in 'offline' mode, if the table is not in the cache
+    """
+    mode = mode or MODE
+    ttl = TTL if ttl is None else ttl
+    if mode not in MODES:
+        raise ValueError('Unknown cache mode ' + str(mode) + ', expected one of ' + str(MODES))
+    if mode in ['refresh', 'off']:
+        return None
+    path = entry_path(url, query, cache)
+    if not path.exists():
+        if mode == 'offline':
+            raise CacheMiss('No cached table for ' + url + ' (no entry ' + str(path) + ')')
+        return None
+    if mode == 'use' and ttl is not None and time.time() - path.stat().st_mtime > ttl:
+        return None
+    return path
+
+
+def read(path):
+    """
+    :param path: the path of an entry, as returned by `lookup`
+    :return: bytes, the table
+    """
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+def copy_to(path, destination_file):
+    """Decompress an entry into a file"""
+    with gzip.open(path, 'rb') as source, open(destination_file, 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+
+
+def store(url, query, content, mode=None, cache=None):
+    """
+    Save a table downloaded from the API (nothing is done in 'off' mode).
+    The entry is written under a temporary name and then renamed, so that it is never seen half written.
+    :param url: str, the url of the table
+    :param query: dictionary, the PxWeb query
+    :param content: bytes, the table, or the path of a file with the table
+    :param mode: str, one of MODES (by default MODE)
+    :param cache: the folder of the cache (by default CACHE_PATH)
+    :return: None
+    """
+    if (mode or MODE) == 'off':
+        return
+    path = entry_path(url, query, cache)
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = path.with_name(path.name + '.' + str(os.getpid()) + '.' + str(time.monotonic_ns()) + '.tmp')
+    with gzip.open(tmp, 'wb', compresslevel=6) as f:
+        if isinstance(content, bytes):
+            f.write(content)
+        else:
+            with open(content, 'rb') as source:
+                shutil.copyfileobj(source, f)
+    os.replace(tmp, path)
+
+
+def tee(url, query, chunks, mode=None, cache=None):
+    """
+    Save a table while it is downloaded: yield the chunks again, and write them to the cache.
+    The entry is renamed into place only when all the chunks have been read (nothing is done in 'off' mode).
+    :param url: str, the url of the table
+    :param query: dictionary, the PxWeb query
+    :param chunks: iterable of bytes, the table
+    :param mode: str, one of MODES (by default MODE)
+    :param cache: the folder of the cache (by default CACHE_PATH)
+    :return: generator of bytes
+    """
+    if (mode or MODE) == 'off':
+        yield from chunks
+        return
+    path = entry_path(url, query, cache)
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = path.with_name(path.name + '.' + str(os.getpid()) + '.' + str(time.monotonic_ns()) + '.tmp')
+    try:
+        with gzip.open(tmp, 'wb', compresslevel=6) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
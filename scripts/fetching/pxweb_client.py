@@ -0,0 +1,162 @@
+# Client of the PxWeb API of Statistics Finland (the Paavo database):
+# the levels and the tables are listed and downloaded concurrently, over one pool of keep-alive connections,
+# without exceeding the number of queries allowed by the API, and the tables are streamed to disk.
+# -*- coding: utf-8 -*- #
+
+import io
+import os
+import time
+import pandas as pd
+from scripts.fetching.http_pool import make_session, fetch, RequestBudget, run_concurrently
+
+# url to the API
+MAIN_PAAVO_URL = 'http://pxnet2.stat.fi/PXWeb/api/v1/en/Postinumeroalueittainen_avoin_tieto/'
+
+# Limits of the API: at most 30 queries in any window of 10 seconds from the same address
+MAX_REQUESTS = 30
+PERIOD = 10
+
+# Query returning the whole table
+CSV_QUERY = {"query": [], "response": {"format": "csv"}}
+
+# Budget shared by all the queries of this process, unless another one is given
+budget = RequestBudget(MAX_REQUESTS, PERIOD)
+
+
+def table_file_name(text):
+    """
+    Name of the .csv file of a table, from its title in the listing
+    (e.g. "Paavo 1. Buildings and dwellings 2017" -> "Buildings_and_dwellings_2017.csv")
+    """
+    return str(text).split('. ')[-1].replace("'", "").replace(" ", "_") + '.csv'
+
+
+def list_items(session, url, budget=budget, backoff=1.0):
+    """
+    :param session: the requests.Session to use
+    :param url: str, the url of a database or of a level
+    :param budget: RequestBudget shared by the queries
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :return: list of dictionaries with the keys 'id', 'type' ('l' for a level, 't' for a table) and 'text'
+    """
+    response = fetch(session, url, limiter=budget, backoff=backoff)
+    response.raise_for_status()
+    return response.json()
+
+
+def list_tables(session, base_url=MAIN_PAAVO_URL, budget=budget, max_workers=4, backoff=1.0):
+    """
+    List the tables of all the levels of the database, the levels being listed concurrently.
+    :param session: the requests.Session to use
+    :param base_url: str, the url of the database (ending with '/')
+    :param budget: RequestBudget shared by the queries
+    :param max_workers: int, the number of concurrent queries
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :return: list of (url of the table, name of the .csv file), in the order of the listings
+    """
+    levels = [str(item['id']) for item in list_items(session, base_url, budget, backoff)]
+    listings = {}
+    for level, items, error in run_concurrently(lambda level: list_items(session, base_url + level, budget, backoff),
+                                                levels, max_workers):
+        if error is not None:
+            print('Could not list the level ' + level + ': ' + str(error))
+            continue
+        listings[level] = items
+    return [(base_url + level + '/' + str(item['id']), table_file_name(item['text']))
+            for level in levels if level in listings for item in listings[level]]
+
+
+def download_table(session, url, destination_file, query=CSV_QUERY, budget=budget, backoff=1.0, chunk_size=65536):
+    """
+    Download one table and stream it to a file. The file is written under a temporary name and then renamed,
+    so that an interrupted download never leaves a truncated table.
+    :param session: the requests.Session to use
+    :param url: str, the url of the table
+    :param destination_file: the path of the file
+    :param query: dictionary, the PxWeb query
+    :param budget: RequestBudget shared by the queries
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :param chunk_size: int, the size of the chunks written to disk
+    :return: int, the number of bytes written
+    :raise requests.HTTPError: if the table could not be downloaded
+    """
+    tmp = str(destination_file) + '.' + str(os.getpid()) + '.' + str(time.monotonic_ns()) + '.part'
+    with fetch(session, url, method='POST', limiter=budget, backoff=backoff, json=query, stream=True) as response:
+        response.raise_for_status()
+        size = 0
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp, destination_file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return size
+
+
+def download_all(destination_directory, base_url=MAIN_PAAVO_URL, max_workers=4, max_requests=MAX_REQUESTS,
+                 period=PERIOD, backoff=1.0):
+    """
+    Download all the tables of the database as .csv files in '<destination_directory>/paavo_raw'.
+    :param destination_directory: str, the folder
+    :param base_url: str, the url of the database (ending with '/')
+    :param max_workers: int, the number of concurrent queries
+    :param max_requests: int, the maximum number of queries in any window of 'period' seconds
+    :param period: float, in seconds
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :return: list of the names of the files that could not be downloaded
+    """
+    paavo_directory = os.path.join(destination_directory, 'paavo_raw')
+    if not os.path.exists(paavo_directory):
+        os.makedirs(paavo_directory)
+
+    session = make_session(pool_size=max_workers)
+    limiter = RequestBudget(max_requests, period)
+    tables = list_tables(session, base_url, limiter, max_workers, backoff)
+
+    def download(table):
+        url, file_name = table
+        return download_table(session, url, os.path.join(paavo_directory, file_name), budget=limiter, backoff=backoff)
+
+    failed = []
+    for (url, file_name), size, error in run_concurrently(download, tables, max_workers):
+        if error is None:
+            print('Downloaded ' + file_name + ' from ' + url)
+        else:
+            print('Could not download ' + file_name + ' from ' + url + ': ' + str(error))
+            failed.append(file_name)
+    session.close()
+    return failed
+
+
+def read_all(base_url=MAIN_PAAVO_URL, max_workers=4, max_requests=MAX_REQUESTS, period=PERIOD, backoff=1.0):
+    """
+    Download all the tables of the database into data frames.
+    :param base_url: str, the url of the database (ending with '/')
+    :param max_workers: int, the number of concurrent queries
+    :param max_requests: int, the maximum number of queries in any window of 'period' seconds
+    :param period: float, in seconds
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :return: dictionary with the names of the tables (without '.csv') as keys and the data frames as values,
+            in the order of the listings; the tables that could not be downloaded are missing
+    """
+    session = make_session(pool_size=max_workers)
+    limiter = RequestBudget(max_requests, period)
+    tables = list_tables(session, base_url, limiter, max_workers, backoff)
+
+    def read(table):
+        response = fetch(session, table[0], method='POST', limiter=limiter, backoff=backoff, json=CSV_QUERY)
+        response.raise_for_status()
+        return pd.read_csv(io.BytesIO(response.content), sep=',', encoding='iso-8859-1')
+
+    frames = {}
+    for (url, file_name), df, error in run_concurrently(read, tables, max_workers):
+        if error is not None:
+            print('Could not download from ' + url + ': ' + str(error))
+        elif not df.empty:
+            frames[file_name[:-len('.csv')]] = df
+    session.close()
+    names = [file_name[:-len('.csv')] for _, file_name in tables]
+    return {name: frames[name] for name in names if name in frames}
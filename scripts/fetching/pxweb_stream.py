@@ -0,0 +1,148 @@
+# Streaming reader of the .csv tables of the PxWeb API: the body of the response is parsed chunk by chunk
+# into an Arrow table with typed columns, instead of being kept whole in memory and parsed into strings.
+# While parsing:
+#   - the missing values '..' (protected data) and '.' (no data) become nulls, and the values are float64
+#   - the column 'Postal code area' (e.g. "00100 Helsinki Keskusta - Etu-Töölö (Helsinki )") is split into
+#     'Postal code' ("00100", null for the row of the whole country) and 'Area' ("Helsinki Keskusta - ...")
+# -*- coding: utf-8 -*- #
+
+import csv
+import gzip
+import io
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from scripts.fetching.http_pool import fetch
+from scripts.fetching.pxweb_client import CSV_QUERY, budget
+
+ENCODING = 'iso-8859-1'
+NULL_VALUES = ['..', '.']
+POSTAL_CODE_AREA = r'^(?P<code>\d{5})?\s*(?P<area>.*?)\s*$'
+
+
+class ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterable of bytes (e.g. `response.iter_content()`)"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def peek_line(self):
+        """
+        :return: bytes, the first line of the stream, which is still returned by the next reads
+        """
+        while b'\n' not in self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        return self.pending.split(b'\n', 1)[0]
+
+
+def split_postal_code(table):
+    """
+    Replace the first column ('Postal code area') by the columns 'Postal code' and 'Area'.
+    :param table: pyarrow.Table or pyarrow.RecordBatch
+    :return: pyarrow.Table
+    """
+    parts = pc.extract_regex(table.column(0), POSTAL_CODE_AREA)
+    code = parts.field('code')
+    code = pc.if_else(pc.equal(code, ''), pa.scalar(None, pa.string()), code)
+    columns = [code, parts.field('area')] + [table.column(i) for i in range(1, table.num_columns)]
+    return pa.Table.from_arrays(columns, names=['Postal code', 'Area'] + table.column_names[1:])
+
+
+def parse_stream(chunks, encoding=ENCODING, block_size=1 << 20):
+    """
+    Parse a .csv table of the PxWeb API, block by block.
+    :param chunks: iterable of bytes
+    :param encoding: str, the encoding of the table
+    :param block_size: int, the size of the blocks parsed at once, in bytes
+    :return: pyarrow.Table with 'Postal code', 'Area' and one float64 column per variable
+    """
+    stream = ChunkStream(chunks)
+    header = next(csv.reader([stream.peek_line().decode(encoding).rstrip('\r')]), [])
+    if len(header) == 0:
+        return pa.table({})
+    column_types = {name: pa.float64() for name in header[1:]}
+    column_types[header[0]] = pa.string()
+    reader = pa_csv.open_csv(stream,
+                             read_options=pa_csv.ReadOptions(encoding=encoding, block_size=block_size),
+                             convert_options=pa_csv.ConvertOptions(column_types=column_types,
+                                                                   null_values=NULL_VALUES,
+                                                                   strings_can_be_null=False))
+    batches = [split_postal_code(batch) for batch in reader]
+    if len(batches) == 0:
+        return split_postal_code(reader.schema.empty_table())
+    return pa.concat_tables(batches)
+
+
+def stream_table(session, url, query=CSV_QUERY, budget=budget, backoff=1.0, chunk_size=65536, tee=None):
+    """
+    Download a table and parse it while it is received.
+    :param session: the requests.Session to use
+    :param url: str, the url of the table
+    :param query: dictionary, the PxWeb query (in csv format)
+    :param budget: RequestBudget shared by the queries
+    :param backoff: float, the base of the random backoff between retries, in seconds
+    :param chunk_size: int, the size of the chunks read from the connection
+    :param tee: function taking the iterable of the chunks and yielding them again
+            (e.g. to save them, see `pxweb_cache.tee`), or None
+    :return: pyarrow.Table, see `parse_stream`
+    :raise requests.HTTPError: if the table could not be downloaded
+    """
+    with fetch(session, url, method='POST', limiter=budget, backoff=backoff, json=query, stream=True) as response:
+        response.raise_for_status()
+        chunks = response.iter_content(chunk_size=chunk_size)
+        return parse_stream(tee(chunks) if tee is not None else chunks)
+
+
+def read_file(path, chunk_size=65536):
+    """
+    Parse a .csv table saved on disk (compressed with gzip if the name ends with '.gz').
+    :param path: the path of the file
+    :param chunk_size: int, the size of the chunks read from the file
+    :return: pyarrow.Table, see `parse_stream`
+    """
+    with (gzip.open if str(path).endswith('.gz') else open)(path, 'rb') as f:
+        return parse_stream(iter(lambda: f.read(chunk_size), b''))
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import tracemalloc
+    import pandas as pd
+
+    file = sys.argv[1] if len(sys.argv) > 1 else 'data/paavo/paavo_raw/Workplace_structure_2016.csv'
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(file, 'rb') as f:
+        df = pd.read_csv(io.BytesIO(f.read()), sep=',', encoding=ENCODING)
+    elapsed, peak = time.perf_counter() - start, tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{'Whole body + pd.read_csv':<26} {elapsed:7.3f} s  peak {peak / 2 ** 20:6.2f} MiB (Python)  "
+          f"result {df.memory_usage(deep=True).sum() / 2 ** 20:6.2f} MiB")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = read_file(file)
+    elapsed, peak = time.perf_counter() - start, tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{'Streaming parse_stream':<26} {elapsed:7.3f} s  peak {peak / 2 ** 20:6.2f} MiB (Python) + "
+          f"{pa.default_memory_pool().max_memory() / 2 ** 20:6.2f} MiB (Arrow)  result {table.nbytes / 2 ** 20:6.2f} MiB")
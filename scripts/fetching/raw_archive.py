@@ -0,0 +1,105 @@
+# Archive of the raw pages downloaded by the scrapers, so that the tables can be parsed again without the network.
+# Each page is saved once, compressed with gzip, under the sha256 of its content (content addressed):
+#   <archive>/objects/ab/abcdef....html.gz
+# and the manifest <archive>/manifest.sqlite maps (source, postal code, fetch date) to the hash of the page.
+# -*- coding: utf-8 -*- #
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+ARCHIVE_PATH = Path('data/house_price/') / 'raw_archive'
+
+
+def content_hash(content):
+    """
+    :param content: bytes
+    :return: str, the sha256 of the content
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+def object_path(archive, sha):
+    return Path(archive) / 'objects' / sha[:2] / (sha + '.html.gz')
+
+
+def store_object(archive, content):
+    """
+    Save a page in the archive, unless a page with the same content is already there.
+    The file is written under a temporary name and then renamed, so that it is never seen half written.
+    :param archive: the folder of the archive
+    :param content: bytes, the page
+    :return: str, the hash of the page
+    """
+    sha = content_hash(content)
+    path = object_path(archive, sha)
+    if not path.exists():
+        os.makedirs(path.parent, exist_ok=True)
+        tmp = path.with_name(path.name + '.' + str(os.getpid()) + '.' + str(time.monotonic_ns()) + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=6))
+        os.replace(tmp, path)
+    return sha
+
+
+def read_object(archive, sha):
+    """
+    :param archive: the folder of the archive
+    :param sha: str, the hash of the page
+    :return: bytes, the page
+    """
+    with open(object_path(archive, sha), 'rb') as f:
+        return gzip.decompress(f.read())
+
+
+def open_manifest(archive=ARCHIVE_PATH):
+    """
+    Open (or create) the manifest of the archive.
+    :param archive: the folder of the archive
+    :return: sqlite3.Connection
+    """
+    os.makedirs(archive, exist_ok=True)
+    conn = sqlite3.connect(str(Path(archive) / 'manifest.sqlite'))
+    conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                        source TEXT NOT NULL,
+                        postal_code TEXT NOT NULL,
+                        fetch_date TEXT NOT NULL,
+                        sha256 TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        PRIMARY KEY (source, postal_code, fetch_date))""")
+    conn.commit()
+    return conn
+
+
+def record_page(conn, source, postal_code, sha, size, fetch_date=None):
+    """
+    Record in the manifest that the page of 'postal_code' downloaded on 'fetch_date' has hash 'sha'.
+    A second download on the same day replaces the first one.
+    :param conn: the manifest
+    :param source: str, 'sale' or 'rent'
+    :param postal_code: str
+    :param sha: str, the hash returned by `store_object`
+    :param size: int, the size of the page in bytes
+    :param fetch_date: str, 'YYYY-MM-DD' (today by default)
+    :return: None
+    """
+    fetch_date = fetch_date or time.strftime('%Y-%m-%d')
+    conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (source, postal_code, fetch_date, sha, size))
+    conn.commit()
+
+
+def latest_pages(conn, source, fetch_date=None):
+    """
+    :param conn: the manifest
+    :param source: str, 'sale' or 'rent'
+    :param fetch_date: str or None, take the last page downloaded on or before this date (by default the last one)
+    :return: dictionary of postal codes and the hash of their page
+    """
+    fetch_date = fetch_date or '9999-12-31'
+    return dict(conn.execute("""SELECT postal_code, sha256 FROM pages AS p
+                                WHERE source = ? AND fetch_date = (SELECT MAX(fetch_date) FROM pages
+                                    WHERE source = p.source AND postal_code = p.postal_code AND fetch_date <= ?)""",
+                             (source, fetch_date)))
@@ -1,9 +1,9 @@
 import pandas as pd
-import numpy as np
 from pathlib import Path
 
 # Using internal project modules
-from scripts.fetching.asuntojen_hintatiedot import list_sold, list_rent
+from scripts.fetching.asuntojen_hintatiedot import pc_list, refresh_prices
+from scripts.fetching.price_store import average_prices, update_price_store
 from scripts.modeling.coordinates import coordinates
 from scripts.modeling.yearly_dataframes import get_all_dataframes
 
@@ -35,11 +35,11 @@ def add_newest_attributes(df):
     population density, latitude and longitude coordinates, are added to each data frame.
     :return: the updated data frame
     """
-    print("Loading sales...")
-    sold_df = pd.DataFrame({'Sell price': list_sold()}, dtype=np.float64)
-    print("Loading rents...")
-    rentARA_df = pd.DataFrame({'Rent price with ARA': list_rent()[0]}, dtype=np.float64)
-    rentnoAra_df = pd.DataFrame({'Rent price without ARA': list_rent()[1]}, dtype=np.float64)
+    print("Loading sales and rents...")
+    prices = average_prices(pc_list)
+    sold_df = prices[['Sell price']]
+    rentARA_df = prices[['Rent price with ARA']]
+    rentnoAra_df = prices[['Rent price without ARA']]
 
     # Add bus stops
     # df['Bus stops'] = add_buses()
@@ -93,6 +93,41 @@ def add_newest_attributes(df):
     return df
 
 
+def update_prices(codes, filename='final_dataframe.tsv'):
+    """
+    Recompute the average selling prices and rents only for some postal codes,
+    and save them in the final data frame, as `add_newest_attributes` does (missing prices are 0).
+    :param codes: list of postal codes
+    :param filename: the name of the final data frame in the folder 'dataframes'
+    :return: the updated data frame
+    """
+    df = pd.read_csv(Path('dataframes/') / filename, sep='\t', dtype={'Postal code': object})
+    prices = average_prices(codes).fillna(0)
+    prices.index = [str(c)[:5] for c in codes]
+    rows = df['Postal code'].isin(prices.index)
+    for col in prices.columns:
+        df.loc[rows, col] = df.loc[rows, 'Postal code'].map(prices[col])
+    df.to_csv(Path('dataframes/') / filename, sep='\t', index=False, encoding='utf-8')
+    return df
+
+
+def refresh_final_dataframe():
+    """
+    Download again the sales and rents from asuntojen.hintatiedot.fi, and update the price store and the prices
+    in the final data frame only for the postal codes that changed (see `refresh_prices`).
+    :return: list of the postal codes updated
+    """
+    print("Refreshing sales...")
+    sale_codes, _ = refresh_prices(onSale=True)
+    print("Refreshing rents...")
+    rent_codes, _ = refresh_prices(onSale=False)
+    update_price_store(sale_codes, rent_codes)
+    codes = sorted(set(sale_codes) | set(rent_codes))
+    if len(codes) > 0:
+        update_prices(codes)
+    return codes
+
+
 def add_buses():
     """
     Open the file 'bus.tsv' from the folder 'data' and return the column to add to the data frame
@@ -0,0 +1,215 @@
+import math
+import numpy as np
+import pandas as pd
+
+# Distribution of the selling prices per square meter, per postal code, number of rooms and year of construction.
+# Each group keeps a t-digest, a small mergeable summary of the prices that gives approximate quantiles:
+# the digests of the postal codes can be merged into the ones of the 3-digit and 2-digit areas without
+# reading the transactions again.
+
+# Limits of the years of construction ('Rv')
+built_bins = [-np.inf, 1960, 1980, 2000, np.inf]
+built_labels = ['-1959', '1960-1979', '1980-1999', '2000-']
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning and Ertl, "Computing extremely accurate quantiles using t-digests").
+    The values are summarized by at most about 'compression' centroids (mean and weight); the centroids are
+    small near the extremes, so that the tails are accurate, and larger in the middle.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = []
+        self.buffered = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        """
+        Add values to the digest.
+        :param values: array of numbers (NaN are ignored)
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.buffer.append(values)
+        self.buffered += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self.buffered > 5 * self.compression:
+            self.compress()
+
+    def scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def scale_inverse(self, k):
+        return (math.sin(2 * math.pi * k / self.compression) + 1) / 2
+
+    def compress(self):
+        """Merge the buffered values into the centroids"""
+        if self.buffered == 0:
+            return
+        means = np.concatenate([self.means] + self.buffer)
+        weights = np.concatenate([self.weights] + [np.ones(len(b)) for b in self.buffer])
+        self.buffer, self.buffered = [], 0
+        self.set_centroids(means, weights)
+
+    def set_centroids(self, means, weights):
+        """
+        Merge the given centroids into at most about 'compression' centroids.
+        :param means: array of the means of the centroids
+        :param weights: array of their weights
+        :return: None
+        """
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+
+        new_means, new_weights = [], []
+        cumulative = 0.0
+        mean, weight = means[0], weights[0]
+        limit = self.scale_inverse(min(self.scale(0.0) + 1, self.compression / 4))
+        for m, w in zip(means[1:], weights[1:]):
+            if (cumulative + weight + w) / total <= limit:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                new_means.append(mean)
+                new_weights.append(weight)
+                cumulative += weight
+                limit = self.scale_inverse(min(self.scale(cumulative / total) + 1, self.compression / 4))
+                mean, weight = m, w
+        new_means.append(mean)
+        new_weights.append(weight)
+        self.means, self.weights = np.array(new_means), np.array(new_weights)
+
+    def merge(self, other):
+        """
+        :param other: TDigest
+        :return: a new TDigest summarizing the values of both
+        """
+        self.compress()
+        other.compress()
+        merged = TDigest(max(self.compression, other.compression))
+        if self.count() + other.count() > 0:
+            merged.set_centroids(np.concatenate([self.means, other.means]),
+                                 np.concatenate([self.weights, other.weights]))
+        merged.min, merged.max = min(self.min, other.min), max(self.max, other.max)
+        return merged
+
+    def count(self):
+        return self.weights.sum() + self.buffered
+
+    def mean(self):
+        self.compress()
+        return np.average(self.means, weights=self.weights) if len(self.means) > 0 else np.nan
+
+    def quantile(self, q):
+        """
+        :param q: float between 0 and 1
+        :return: the approximate q-quantile (NaN if the digest is empty)
+        """
+        self.compress()
+        if len(self.means) == 0:
+            return np.nan
+        if len(self.means) == 1:
+            return self.means[0]
+        target = q * self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        if target < centers[0]:
+            return self.min + (self.means[0] - self.min) * target / centers[0]
+        if target > centers[-1]:
+            tail = self.weights.sum() - centers[-1]
+            return self.means[-1] + (self.max - self.means[-1]) * (target - centers[-1]) / tail
+        return np.interp(target, centers, self.means)
+
+    def to_dict(self):
+        """:return: dictionary that can be saved as JSON, see `TDigest.from_dict`"""
+        self.compress()
+        return {'compression': self.compression, 'means': self.means.tolist(), 'weights': self.weights.tolist(),
+                'min': self.min, 'max': self.max}
+
+    @staticmethod
+    def from_dict(d):
+        digest = TDigest(d['compression'])
+        digest.means = np.array(d['means'], dtype=np.float64)
+        digest.weights = np.array(d['weights'], dtype=np.float64)
+        digest.min, digest.max = d['min'], d['max']
+        return digest
+
+
+def room_type(huoneisto):
+    """
+    Find the number of rooms from the description of the apartment ('Huoneisto', e.g. '2h, k, s', '3-4h+k',
+    'yksiö'), with the same categories as the rent tables.
+    :param huoneisto: pandas Series of str
+    :return: pandas Series of '1h', '2h', '3h+' or 'other' (e.g. parking places)
+    """
+    text = huoneisto.fillna('').str.lower()
+    rooms = pd.to_numeric(text.str.extract(r'^\s*(\d+)', expand=False), errors='coerce')
+    rooms = rooms.where(rooms.notna(), text.str.startswith('yksiö').map({True: 1.0, False: np.nan}))
+    rooms = rooms.where(rooms.notna(), text.str.startswith('kaksio').map({True: 2.0, False: np.nan}))
+    types = pd.Series('other', index=huoneisto.index)
+    types[rooms == 1] = '1h'
+    types[rooms == 2] = '2h'
+    types[rooms >= 3] = '3h+'
+    return types
+
+
+def build_digests(sales, compression=100):
+    """
+    Summarize the prices per square meter ('m21') of all the sales in one pass.
+    :param sales: data frame of the sales, as returned by `price_store.load_sales`
+    :param compression: int, the compression of the digests
+    :return: dictionary where the keys are (postal code, room type, years of construction)
+            and the values are TDigest
+    """
+    built = pd.cut(sales['Rv'], built_bins, right=False, labels=built_labels).astype(str)
+    groups = pd.DataFrame({'Postal code': sales['Postal code'].values,
+                           'Rooms': room_type(sales['Huoneisto']).values,
+                           'Built': built.values,
+                           'Price': sales['m21'].values})
+    digests = {}
+    for key, prices in groups.groupby(['Postal code', 'Rooms', 'Built'], sort=False)['Price']:
+        digests[key] = TDigest(compression)
+        digests[key].update(prices.values)
+    return digests
+
+
+def rollup(digests, digits=5, by_rooms=True, by_built=True):
+    """
+    Merge the digests into larger groups, without the transactions.
+    :param digests: dictionary returned by `build_digests` (or by `rollup`)
+    :param digits: int, the number of digits of the postal codes kept (5, 3 or 2)
+    :param by_rooms: bool, if false merge all the room types ('all')
+    :param by_built: bool, if false merge all the years of construction ('all')
+    :return: dictionary like 'digests'
+    """
+    merged = {}
+    for (code, rooms, built), digest in digests.items():
+        key = (code[:digits], rooms if by_rooms else 'all', built if by_built else 'all')
+        merged[key] = merged[key].merge(digest) if key in merged else digest
+    return merged
+
+
+def summary(digests):
+    """
+    :param digests: dictionary returned by `build_digests` or `rollup`
+    :return: data frame with the columns 'Postal code', 'Rooms', 'Built', 'Count', 'Mean', 'P10', 'Median', 'P90'
+    """
+    rows = [[code, rooms, built, int(d.count()), d.mean(), d.quantile(0.1), d.quantile(0.5), d.quantile(0.9)]
+            for (code, rooms, built), d in digests.items()]
+    df = pd.DataFrame(rows, columns=['Postal code', 'Rooms', 'Built', 'Count', 'Mean', 'P10', 'Median', 'P90'])
+    return df.sort_values(['Postal code', 'Rooms', 'Built']).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    from scripts.fetching.price_store import load_sales
+    all_digests = build_digests(load_sales())
+    print(summary(rollup(all_digests, digits=2, by_built=False)).to_string())
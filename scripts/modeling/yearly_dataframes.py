@@ -1,10 +1,46 @@
 # Collect data into data frames based on the year of the file
 import glob
+import hashlib
 import os
 import re
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import numpy as np
+from scripts.preprocessing.column_names import drop_duplicate_columns, normalize_columns
+from scripts.preprocessing.imputation import RuleImputer
+
+# Cache of the cleaned data frame of each raw file, keyed by the content of the file
+CLEAN_CACHE_PATH = Path('data/paavo/') / 'paavo_clean_cache'
+# To change when the cleaning of the files changes, so that the cache is not used anymore
+CLEAN_CACHE_VERSION = '3'
+# Columns removed from the yearly data frames
+DROPPED_COLUMNS = ['Postal code area', 'Postialue', 'Area_x', 'Area_y']
+
+# Replace missing values
+# RULES:
+#       1) if it's a rate/percentage/average/median, take the median of the column
+#       2) if it's a count, take the smallest positive value of the column
+#           and if it is greater than 15, take 15
+# MISSING VALUES COME FROM:
+#       (RA) -> Data on dwellings are protected if there is only one residential building in the area.
+#               Data on the average floor area of dwellings and type of house are protected if there is only one
+#               residential building or fewer than 30 dwellings in the area. Protected fields have the value "..".
+#               Data on free-time residences is not protected.
+#       (KO) -> Data on educational structure are confidential if the area contains fewer than 30 people aged 18 or over
+#       (HR) -> Data on income are confidential if the area contains fewer than 30 people aged 18 or over
+#       (TE) -> Data on size and stage in life of households are confidential if there are fewer than 30 households in the area.
+#       (TR) -> Data on the income of households are confidential if there are fewer than ten households in the area.
+#       (TP) -> Data on workplaces are protected if there are fewer than 10 workplaces in the area
+# SOURCE:
+#       https://www.stat.fi/static/media/uploads/tup/paavo/paavo_kuvaus_en.pdf
+PAAVO_RULES = [
+    (r'Average|average|median|Median|ratio|rate|income|purchasing power', 'median', None),
+    (r'', 'min', 15),
+]
+# Shared by all the calls of drop_and_replace: the strategies of the columns are kept for each header
+# (each process of read_clean_files has its own copy)
+PAAVO_IMPUTER = RuleImputer(PAAVO_RULES)
 
 
 def postalcode_and_area(df):
@@ -17,8 +53,7 @@ def postalcode_and_area(df):
     # Rename the first column
     df.rename(columns={df.columns[0]: "Postal code"}, inplace=True)
 
-    for c in df.columns:
-        drop_double_columns(df, c)
+    df = drop_duplicate_columns(df)
 
     # Duplicate the first column and add it as the second column
     # df.insert(1, 'Area', df['Postal code'])
@@ -39,50 +74,22 @@ def postalcode_and_area(df):
     return df
 
 
-def drop_double_columns(df, header_to_drop):
-    """
-    Drops duplicate columns whose header is 'header_to_drop' in a data frame.
-    :param df: the original data frame
-    :param header_to_drop: the column name
-    :return: None (the data frame is edited inplace)
-    """
-    col_list = df.columns.tolist()
-    to_drop = get_index_positions(col_list, header_to_drop)
-    if len(to_drop) > 1:
-        to_drop = to_drop[1:]
-        for i in to_drop:
-            col_list[i] = 'todrop'
-        df.columns = col_list
-        df.drop(columns=['todrop'], inplace=True)
-
-
 def clean_columns(df):
     """
-    This function cleans the last part of the name of the column,
-    by removing the pattern (AA), counts how many times each column appears,
-    and drop the duplicates by calling 'drop_double_columns'.
+    This function cleans the names of the columns in one pass (see 'normalize_columns'):
+    it removes the pattern (AA) and the year with its comma, keeps the first column of each name without (AA),
+    and drops the columns in DROPPED_COLUMNS.
     :param df: the dataframe to clean
     :return: the cleaned dataframe
     """
-    # Saving columns names
-    new_columns = {x: x for x in df.columns}
-    for key, value in new_columns.items():
-        # Removing pattern (AA) from the columns' names
-        new_columns[key] = re.sub('\([^)]{2}\)', '', value)
-
-    # The cleaned names become the new columns in the data frame
-    df.rename(columns=new_columns, inplace=True)
-
-    for c in df.columns:
-        drop_double_columns(df, c)
-
-    return df
+    return normalize_columns(df, drop=DROPPED_COLUMNS)
 
 
 def drop_and_replace(df):
     """
     This function deletes the row 0 (Finland), drops remaining duplicate columns,
-    and replaces missing values. Inline comments explain how missing/private values are handled.
+    and replaces missing values with PAAVO_IMPUTER. The comments of PAAVO_RULES explain
+    how missing/private values are handled.
     :param df: the data frame to clean
     :return: the cleaned data frame
     """
@@ -90,73 +97,20 @@ def drop_and_replace(df):
     df.drop(index=0, inplace=True)
 
     # Drop unnecessary columns that might have been copied until now
-    for c in df.columns:
-        drop_double_columns(df, c)
-
-    # Replace missing values
-    # RULES:
-    #       1) if it's a count, take the min of the column
-    #           and if the min is greater than 15, take 15
-    #       2) if it's a rate/percentage/average/median, take the median of the column
-    # MISSING VALUES COME FROM:
-    #       (RA) -> Data on dwellings are protected if there is only one residential building in the area.
-    #               Data on the average floor area of dwellings and type of house are protected if there is only one
-    #               residential building or fewer than 30 dwellings in the area. Protected fields have the value "..".
-    #               Data on free-time residences is not protected.
-    #       (KO) -> Data on educational structure are confidential if the area contains fewer than 30 people aged 18 or over
-    #       (HR) -> Data on income are confidential if the area contains fewer than 30 people aged 18 or over
-    #       (TE) -> Data on size and stage in life of households are confidential if there are fewer than 30 households in the area.
-    #       (TR) -> Data on the income of households are confidential if there are fewer than ten households in the area.
-    #       (TP) -> Data on workplaces are protected if there are fewer than 10 workplaces in the area
-    # SOURCE:
-    #       https://www.stat.fi/static/media/uploads/tup/paavo/paavo_kuvaus_en.pdf
-
-    df.replace({'..': np.nan, '.': np.nan}, inplace=True)
-    for col_name in df.columns:
-        if df[col_name].isna().sum() > 0:
-            filter_on_column = df[df[col_name].notna()]
-            if 'Average' in col_name or 'average' in col_name \
-            or 'median' in col_name or 'Median' in col_name \
-            or 'ratio' in col_name or 'rate' in col_name \
-            or 'income' in col_name or 'purchasing power' in col_name:
-                nonzero_minimum = filter_on_column[col_name].median()
-            else:
-                nonzero_minimum = filter_on_column[col_name][filter_on_column[col_name].astype('float') > 0].min()
-                nonzero_minimum = min(float(nonzero_minimum), 15)
+    df = drop_duplicate_columns(df)
 
-            df[col_name].fillna(nonzero_minimum, inplace=True)
+    # Replace missing values with the rules of PAAVO_IMPUTER
+    values = df.columns[1:]
+    df[values] = df[values].replace({'..': np.nan, '.': np.nan}).astype('float')
+    df, _ = PAAVO_IMPUTER.impute(df, values)
 
-    if sum(df.isna().sum()) > 0:
+    if df.isna().any().any():
         print("WARNING: There are still missing values!")
-        df.replace({None: 0}, inplace=True)
-        df.fillna(0, inplace=True)
+        df = df.fillna(0)
 
     return df
 
 
-def get_index_positions(list_of_elements, element):
-    """
-    Returns the indexes of all occurrences of the given 'element' in
-    the list of columns 'list_of_elements'.
-    :param list_of_elements: the list of the columns of the data frame
-    :param element: the name of the column to find
-    :return: list of indexes
-    """
-    index_pos_list = []
-    index_pos = 0
-    while True:
-        try:
-            # Search for item in list from index_pos to the end of list
-            index_pos = list_of_elements.index(element, index_pos)
-            # Add the index position in list
-            index_pos_list.append(index_pos)
-            index_pos += 1
-        except ValueError as _:
-            break
-
-    return index_pos_list
-
-
 def add_density(year, pclist):
     """
     Open the file 'density.tsv' in the folder 'data' and return
@@ -244,7 +198,7 @@ def data_format(df):
     return df
 
 
-def get_all_dataframes():
+def get_all_dataframes(max_workers=None):
     """
     This function loads all the files that have been downloaded
     as .csv files by calling `fetch_paavo("")` from `fetch_from_paavo.py`
@@ -253,59 +207,49 @@ def get_all_dataframes():
     This function assigns the data to the correct data frame according to the year,
     and calls drop_and_replace to clean the data frame.
     The latest postal codes (from 2017) are taken into account.
+    :param max_workers: int, the number of processes cleaning the files that are not in the cache
+            (by default the number of processors)
     :return: df_dic, a dictionary where the keys are the years
             and the values are the corresponding data frames, and
             common_columns, a list of common columns as found by 'get_common_columns'
     """
     # Read all the files with the data
-    file_list = glob.glob("data/paavo/paavo_raw/*.csv")
+    # (sorted, so that the order of the columns does not depend on the file system)
+    file_list = sorted(glob.glob("data/paavo/paavo_raw/*.csv"))
 
     # Create a sorted list of the years: remove A-Öa-ö_.,:; /()\\-
     years_list = sorted({re.sub('[\D]+', '', y) for y in file_list})
     print("Preparing data: ",  years_list)
 
+    # Each file is cleaned once (see 'clean_file'), in parallel, or read from the cache
+    cleaned = dict(zip(file_list, read_clean_files(file_list, max_workers=max_workers)))
+    files_of_year = {y: [cleaned[file] for file in file_list if y in file] for y in years_list}
+
     # Build a dictionary of DataFrames:
     # to each year, it is associated one DataFrame
-    df_dic = {y: pd.DataFrame() for y in years_list}
+    df_dic = {}
 
-    # Dataframe 2017 --> we need 2017 first, since we want to refer to the latest postal codes and areas
-    for file in file_list:
-        if '2017' in file:
-            if df_dic['2017'].size == 0:
-                df_dic['2017'] = pd.read_csv(file, sep=',', skiprows=0, encoding='iso-8859-1')
-            else:
-                # Open the file in a temporary data frame
-                temp = pd.read_csv(file, sep=',', skiprows=0, encoding='iso-8859-1')
-                # Merge the temporary data frame to the main one
-                df_dic['2017'] = df_dic['2017'].join(temp, lsuffix='_caller')
-
-    df_dic['2017'] = drop_and_replace(df_dic['2017'])
-    df_dic['2017'] = postalcode_and_area(df_dic['2017'])
+    # Dataframe 2017 --> we need 2017 first, since we want to refer to the latest postal codes and areas.
+    # The files have the same rows: their columns are put side by side, with one 'Postal code' and one 'Area'
+    first, *others = files_of_year['2017']
+    df_dic['2017'] = pd.concat([first.drop(columns=['Area'])] +
+                               [temp.drop(columns=['Postal code', 'Area']) for temp in others] +
+                               [first[['Area']]], axis=1, sort=False).reindex(first.index)
 
     postalcodes_list = df_dic['2017']['Postal code'].values
 
     years_list.remove('2017')
     # Fill the DataFrames with the data from the correct files
-    for file in file_list:
-        for y in years_list:
-            if df_dic[y].size == 0:
-                df_dic[y]['Postal code'] = df_dic['2017']['Postal code'].copy()
-                df_dic[y]['Area'] = df_dic['2017']['Area'].copy()
-            if y in file:
-                # Open the file in a temporary dataframe
-                temp = pd.read_csv(file, sep=',', skiprows=0, encoding='iso-8859-1')
-                temp = drop_and_replace(temp)
-                temp = postalcode_and_area(temp)
-                temp = data_format(temp)
-                idx = pd.Index(temp['Postal code'].values)
-                old_pc = list(set(idx) - set(postalcodes_list))
-                temp = temp[~temp['Postal code'].isin(old_pc)]
-                df_dic[y] = pd.concat([df_dic[y], temp.copy()], axis=1, sort=False).reindex(df_dic[y].index)
+    for y in years_list:
+        codes_and_areas = df_dic['2017'][['Postal code', 'Area']].copy()
+        temps = [temp[temp['Postal code'].isin(postalcodes_list)] for temp in files_of_year[y]]
+        df_dic[y] = pd.concat([codes_and_areas] + temps, axis=1, sort=False).reindex(codes_and_areas.index)
+    df_dic = {y: df_dic[y] for y in sorted(df_dic)}
 
     for year, dfy in df_dic.items():
         dfy = clean_columns(dfy)
-        dfy.drop(columns=['Postal code area', 'Postialue', 'Area_x', 'Area_y'], inplace=True, errors='ignore')
         dfy = data_format(dfy)
+        df_dic[year] = dfy
         dfy.reset_index(inplace=True)
 
         # Here we add the columns 'Bus stops', 'Sold', 'Rented', 'Population density', 'Surface area', 'Lat', 'Lon'
@@ -339,9 +283,6 @@ def get_all_dataframes():
         new_df = pd.DataFrame({'Surface area': mysurfacelist})
         dfy.update(new_df)
 
-        # Remove the year and extra comma
-        dfy.columns = [re.sub(r", \d{4}\s*$", "", column) for column in dfy.columns]
-
         # Remove extra space before parenthesis
         dfy['Area'] = [re.sub(r"\s(?=\))", "", a) for a in dfy['Area']]
 
@@ -352,6 +293,76 @@ def get_all_dataframes():
     return df_dic, get_common_columns(df_dic)
 
 
+def file_hash(file):
+    """
+    :param file: the path of a raw file
+    :return: str, the sha256 of the content of the file, of CLEAN_CACHE_VERSION and of the version of pandas
+            (the cached data frames are pickled)
+    """
+    sha = hashlib.sha256((CLEAN_CACHE_VERSION + ' ' + pd.__version__ + '\n').encode('utf-8'))
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def clean_file(file):
+    """
+    Read a raw file of Paavo, drop the row of Finland, replace the missing values,
+    split the postal codes and the areas, and convert the values to float.
+    :param file: the path of the .csv file
+    :return: the cleaned data frame (with the index of the rows of the file)
+    """
+    df = pd.read_csv(file, sep=',', skiprows=0, encoding='iso-8859-1')
+    df = drop_and_replace(df)
+    df = postalcode_and_area(df)
+    return data_format(df)
+
+
+def clean_and_store(file, path):
+    """
+    Clean a file with 'clean_file' and save the data frame in the cache.
+    :param file: the path of the .csv file
+    :param path: the path of the entry of the cache, or None
+    :return: the cleaned data frame
+    """
+    df = clean_file(file)
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.part')
+        df.to_pickle(tmp)
+        os.replace(tmp, path)
+    return df
+
+
+def read_clean_files(file_list, max_workers=None, cache=None):
+    """
+    Clean the raw files, reading the ones already cleaned from the cache:
+    when a file is added or changed, only this file is cleaned again.
+    The other files are cleaned in a pool of processes.
+    :param file_list: list of the paths of the .csv files
+    :param max_workers: int, the number of processes (by default the number of processors)
+    :param cache: the folder of the cache (by default CLEAN_CACHE_PATH), False to disable the cache
+    :return: list of the cleaned data frames, in the order of 'file_list'
+    """
+    folder = None if cache is False else Path(cache or CLEAN_CACHE_PATH)
+    frames, todo = {}, []
+    for file in file_list:
+        path = None if folder is None else folder / (file_hash(file) + '.pkl')
+        if path is not None and path.exists():
+            frames[file] = pd.read_pickle(path)
+        else:
+            todo.append((file, path))
+
+    if len(todo) > 0:
+        print("Cleaning", len(todo), "files")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for (file, _), df in zip(todo, executor.map(clean_and_store, *zip(*todo))):
+                frames[file] = df
+
+    return [frames[file] for file in file_list]
+
+
 def get_tsv_files():
     """
     Call get_all_dataframes and save each year on a file
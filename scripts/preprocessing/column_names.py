@@ -0,0 +1,76 @@
+"""
+Normalization of the headers of the Paavo tables in one pass over the names of the columns:
+a header like "Inhabitants, total, 2017 (HE)" becomes "Inhabitants, total" (the code of the table "(AA)"
+and the year with its comma are removed), and only the first column of each name is kept.
+The duplicates are found before the year is removed, so two columns of different tables that only differ by
+the year (e.g. "Inhabitants, total, 2017 (HE)" and "Inhabitants, total, 2017") are both kept.
+The mapping of a header is compiled once and cached by the tuple of its names,
+so that it is reused for every data frame with the same columns.
+"""
+
+import re
+from functools import lru_cache
+
+TABLE_CODE = re.compile(r'\([^)]{2}\)')
+YEAR = re.compile(r', \d{4}\s*$')
+
+
+def normalize_name(name, strip_codes=True, strip_year=True):
+    """
+    :param name: str, the name of a column
+    :param strip_codes: bool, if true remove the pattern (AA)
+    :param strip_year: bool, if true remove the year at the end of the name and the comma before it
+    :return: str, the normalized name
+    """
+    if strip_codes:
+        name = TABLE_CODE.sub('', name)
+    if strip_year:
+        name = YEAR.sub('', name)
+    return name
+
+
+@lru_cache(maxsize=256)
+def compile_mapping(columns, strip_codes=True, strip_year=True, drop=()):
+    """
+    :param columns: tuple of the names of the columns (duplicates allowed)
+    :param strip_codes: bool, see `normalize_name`
+    :param strip_year: bool, see `normalize_name`
+    :param drop: tuple of the names of the columns to remove (without the pattern (AA))
+    :return: tuple of the positions of the columns to keep, and tuple of their new names
+            (the same new name can be used twice, see above)
+    """
+    positions, names = [], []
+    seen = set(drop)
+    for position, name in enumerate(columns):
+        # Duplicates and dropped columns are compared without the pattern (AA) but with the year
+        name = normalize_name(name, strip_codes, strip_year=False)
+        if name not in seen:
+            seen.add(name)
+            positions.append(position)
+            names.append(normalize_name(name, strip_codes=False, strip_year=strip_year))
+    return tuple(positions), tuple(names)
+
+
+def normalize_columns(df, strip_codes=True, strip_year=True, drop=()):
+    """
+    Rename the columns with `normalize_name`, and remove the columns in 'drop'
+    and the columns whose name without the pattern (AA) is already used by a previous column.
+    :param df: the data frame
+    :param strip_codes: bool, see `normalize_name`
+    :param strip_year: bool, see `normalize_name`
+    :param drop: list of the names of the columns to remove (without the pattern (AA))
+    :return: the data frame (a new one if some columns are removed, else 'df' renamed)
+    """
+    positions, names = compile_mapping(tuple(df.columns), strip_codes, strip_year, tuple(drop))
+    if len(positions) < len(df.columns):
+        df = df.take(list(positions), axis=1)
+    df.columns = list(names)
+    return df
+
+
+def drop_duplicate_columns(df):
+    """
+    :param df: the data frame
+    :return: the data frame with only the first column of each name
+    """
+    return normalize_columns(df, strip_codes=False, strip_year=False)
@@ -0,0 +1,107 @@
+"""
+Imputation of the missing values of a data frame with a table of rules: each rule maps a pattern of the names of
+the columns to a strategy, and a column takes the strategy of the first rule whose pattern it contains.
+The strategies are:
+    ('median', None)    the median of the column
+    ('min', cap)        the smallest positive value of the column, at most 'cap' (None for no cap)
+    ('constant', value) the given value
+The columns without a matching rule are not imputed. The fill values of all the columns are computed at once
+on the float matrix of the data frame, and the missing values are replaced with one `fillna`.
+"""
+
+import re
+import warnings
+import numpy as np
+import pandas as pd
+
+STRATEGIES = ['median', 'min', 'constant']
+
+
+class RuleImputer:
+    """
+    Imputer compiled from a list of rules (pattern, strategy, argument), see the strategies above.
+    The plan of a header (the strategy of each column) is computed once and kept in 'plans' for the next
+    data frames with the same columns: an imputer is meant to be created once (e.g. at the level of a module)
+    and reused by all the calls. The rules must not be changed after the creation.
+    """
+
+    def __init__(self, rules):
+        for _, strategy, _ in rules:
+            if strategy not in STRATEGIES:
+                raise ValueError("Unknown strategy: " + str(strategy))
+        self.rules = [(re.compile(pattern), strategy, argument) for pattern, strategy, argument in rules]
+        self.plans = {}
+
+    def rule(self, column):
+        """
+        :param column: str, the name of a column
+        :return: the strategy and the argument of the first matching rule, or (None, None)
+        """
+        for pattern, strategy, argument in self.rules:
+            if pattern.search(column):
+                return strategy, argument
+        return None, None
+
+    def plan(self, columns):
+        """
+        :param columns: tuple of the names of the columns
+        :return: dictionary of the strategies and of the positions of their columns, and array of the arguments
+                of the columns ('cap' of 'min', 'value' of 'constant', NaN otherwise)
+        """
+        if columns not in self.plans:
+            positions = {strategy: [] for strategy in STRATEGIES}
+            arguments = np.full(len(columns), np.nan)
+            for i, column in enumerate(columns):
+                strategy, argument = self.rule(column)
+                if strategy is not None:
+                    positions[strategy].append(i)
+                    arguments[i] = np.nan if argument is None else argument
+            self.plans[columns] = {s: np.array(p, dtype=np.int64) for s, p in positions.items()}, arguments
+        return self.plans[columns]
+
+    def fill_values(self, values, columns):
+        """
+        :param values: 2-D float array, with NaN for the missing values
+        :param columns: tuple of the names of the columns of 'values'
+        :return: array of the fill value of each column (NaN if the column is not imputed or if there is no value
+                to take, e.g. no positive value for 'min')
+        """
+        positions, arguments = self.plan(columns)
+        fill = np.full(len(columns), np.nan)
+        # Only the columns with missing values
+        missing = np.isnan(values).any(axis=0)
+        with warnings.catch_warnings():
+            # All-NaN columns have a NaN median
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            median = positions['median'][missing[positions['median']]]
+            fill[median] = np.nanmedian(values[:, median], axis=0)
+        minimum = positions['min'][missing[positions['min']]]
+        smallest = np.where(values[:, minimum] > 0, values[:, minimum], np.inf).min(axis=0, initial=np.inf)
+        smallest[np.isinf(smallest)] = np.nan
+        # fmin ignores a NaN cap (no cap), minimum keeps a NaN value (no positive value)
+        fill[minimum] = np.where(np.isnan(smallest), np.nan, np.fmin(smallest, arguments[minimum]))
+        constant = positions['constant']
+        fill[constant] = arguments[constant]
+        return fill
+
+    def impute(self, df, columns=None):
+        """
+        Replace the missing values of the columns with the fill values of their rule.
+        :param df: the data frame
+        :param columns: list of the columns to impute (by default the numerical columns)
+        :return: the imputed data frame, and pandas Series of the number of values imputed in each column
+                (only the columns with missing values)
+        """
+        if columns is None:
+            columns = df.select_dtypes(include='number').columns
+        columns = tuple(columns)
+        values = df[list(columns)].to_numpy(dtype=np.float64)
+        fill_values = self.fill_values(values, columns)
+
+        missing = np.isnan(values)
+        counts = pd.Series(np.where(np.isnan(fill_values), 0, missing.sum(axis=0)), index=list(columns))
+        counts = counts[missing.any(axis=0)]
+        to_fill = {column: value for column, value in zip(columns, fill_values) if not np.isnan(value)}
+        if len(to_fill) > 0:
+            df = df.fillna(to_fill)
+        return df, counts
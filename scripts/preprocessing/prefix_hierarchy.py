@@ -0,0 +1,139 @@
+"""
+Imputation along the hierarchy of the postal codes: the first digits of a postal code are the code of a larger area
+(e.g. 00120 is in 001, which is in 00, which is in 0), so a missing value of a postal code can be replaced by the value
+of its nearest ancestor that has one. All the levels are computed with group by on the prefixes and filled with `map`.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def standardize_codes(codes):
+    """
+    :param codes: pandas Series of postal codes (str or int, e.g. 120 or '00120')
+    :return: pandas Series of str, the postal codes with 5 digits
+    """
+    return codes.astype(str).str.zfill(5)
+
+
+def is_missing(values):
+    """The missing values are NaN and 0 (hidden values)"""
+    return values.isna() | (values == 0)
+
+
+def prefix_means(codes, totals, weights, length):
+    """
+    Weighted mean of each prefix of the postal codes.
+    :param codes: pandas Series of str, the postal codes
+    :param totals: pandas Series, the total of each postal code (e.g. mean price x number of sales), NaN counts as 0
+    :param weights: pandas Series, the weight of each postal code (e.g. number of sales), NaN counts as 0
+    :param length: int, the number of digits of the prefixes
+    :return: pandas Series indexed by the prefixes: the sum of the totals divided by the sum of the weights
+            (NaN when the weights sum to 0)
+    """
+    sums = pd.DataFrame({'Total': totals.values, 'Weight': weights.values}).groupby(codes.str[:length].values).sum()
+    return sums['Total'] / sums['Weight']
+
+
+def fill_from_ancestors(values, codes, ancestors, length):
+    """
+    Replace the missing values (NaN or 0) by the value of the ancestor.
+    :param values: pandas Series, the values
+    :param codes: pandas Series of str, the codes of the values (postal codes or prefixes)
+    :param ancestors: pandas Series indexed by the prefixes of 'length' digits
+    :param length: int, the number of digits of the ancestors
+    :return: pandas Series, the values imputed (NaN or 0 where the ancestor is also missing)
+    """
+    return values.where(~is_missing(values), codes.str[:length].map(ancestors))
+
+
+def nearest_ancestor_means(codes, totals, weights, lengths=(3, 2, 1)):
+    """
+    Weighted mean of each prefix of the finest level, or, when it is missing, of its nearest ancestor with a mean.
+    The levels are filled from the coarsest to the finest one.
+    :param codes: pandas Series of str, the postal codes
+    :param totals: pandas Series, the total of each postal code, NaN counts as 0
+    :param weights: pandas Series, the weight of each postal code, NaN counts as 0
+    :param lengths: list of the numbers of digits of the levels
+    :return: pandas Series indexed by the prefixes of max(lengths) digits
+    """
+    means = None
+    previous = None
+    for length in sorted(lengths):
+        level = prefix_means(codes, totals, weights, length)
+        if means is not None:
+            level = fill_from_ancestors(level, level.index.to_series(), means, previous)
+        means, previous = level, length
+    return means
+
+
+def smallest_per_group(groups, values, k):
+    """
+    :param groups: array of int, the group of each row
+    :param values: array, the values of the rows
+    :param k: int
+    :return: array of bool, true for the k smallest values of each group (the first rows first in case of ties,
+            as `nsmallest`)
+    """
+    order = np.lexsort((np.arange(len(groups)), values, groups))
+    sorted_groups = groups[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_groups)) + 1]
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    kept = np.zeros(len(groups), dtype=bool)
+    kept[order] = rank < k
+    return kept
+
+
+def grouped_ols(groups, x, y, n_groups):
+    """
+    Least squares fit of y = intercept + slope * x in every group at once, with sums by group.
+    A group whose x are all equal has no slope: it gets the mean of its y (intercept) and a slope of 0.
+    This is a fix: the old fit with `sm.add_constant` did not add the constant when x was a nonzero constant,
+    and predicted mean(y) / x (e.g. 22 € instead of 1150 €/m2 for a group with a density of 50).
+    :param groups: array of int between 0 and n_groups - 1, the group of each point
+    :param x: array of float
+    :param y: array of float
+    :param n_groups: int
+    :return: arrays of the intercepts, of the slopes and of the numbers of points of the groups
+    """
+    count = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.bincount(groups, weights=x, minlength=n_groups) / count
+        y_mean = np.bincount(groups, weights=y, minlength=n_groups) / count
+        xc, yc = x - x_mean[groups], y - y_mean[groups]
+        sxx = np.bincount(groups, weights=xc * xc, minlength=n_groups)
+        sxy = np.bincount(groups, weights=xc * yc, minlength=n_groups)
+        slope = sxy / sxx
+        intercept = y_mean - slope * x_mean
+        # Constant x: the mean of y, whatever x
+        constant = sxx == 0
+        intercept[constant] = y_mean[constant]
+        slope[constant] = 0.0
+    return intercept, slope, count
+
+
+def impute_with_regression(codes, values, x, length, min_count=7, max_points=15):
+    """
+    Replace the missing values (0) by a linear regression on 'x' in each group of postal codes with the same first
+    'length' digits. The regression of a group uses the 'max_points' smallest values of the group,
+    and only the groups with at least 'min_count' values are imputed. The predictions are truncated to integers.
+    :param codes: pandas Series of str, the postal codes
+    :param values: pandas Series of float, the values (0 if missing)
+    :param x: pandas Series of float, the explanatory variable (e.g. the density of population)
+    :param length: int, the number of digits of the groups
+    :param min_count: int, the minimum number of values of a group
+    :param max_points: int, the maximum number of values used in a regression
+    :return: pandas Series, the values imputed
+    """
+    groups, prefixes = pd.factorize(codes.str[:length])
+    y, x_values = values.to_numpy(dtype=np.float64), x.to_numpy(dtype=np.float64)
+    good = y != 0
+    n_good = np.bincount(groups[good], minlength=len(prefixes))
+
+    points = np.flatnonzero(good)[smallest_per_group(groups[good], y[good], max_points)]
+    intercept, slope, _ = grouped_ols(groups[points], x_values[points], y[points], len(prefixes))
+
+    missing = ~good & (n_good[groups] >= min_count)
+    imputed = y.copy()
+    imputed[missing] = np.trunc(intercept[groups[missing]] + slope[groups[missing]] * x_values[missing])
+    return pd.Series(imputed, index=values.index, name=values.name)
@@ -1,6 +1,68 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
 import pandas as pd
 
+FIXTURES = Path(__file__).parent / 'fixtures'
+# The deployment modules read the final data frame when they are imported
+os.environ['KODIMPI_FINAL_DATAFRAME'] = str(FIXTURES / 'deployment' / 'final_dataframe.tsv')
+
+paavo_query = {"query": [{"code": "Tiedot", "selection": {"filter": "item", "values": ["Pinta_ala", "He_vakiy"]}}],
+               "response": {"format": "csv"}}
+
+
+class FixtureServer:
+    """
+    Local stand-in for a website, serving recorded pages from a thread.
+    'route' maps (path, query parameters) to (status, body), and every request is recorded in 'requests'.
+    The POST requests are passed to 'route' with their body as a third argument.
+    """
+
+    def __init__(self, route):
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                server.requests.append(self.path)
+                status, body = route(url.path, parse_qs(url.query, keep_blank_values=True))
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                server.requests.append(self.path)
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, body = route(url.path, parse_qs(url.query, keep_blank_values=True), data)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
 
 class TestDataframe(unittest.TestCase):
     def test1(self):
@@ -85,5 +147,953 @@ class TestDataframe(unittest.TestCase):
         self.assertEqual(list(df.columns), names)
 
 
+class TestConcurrentScraper(unittest.TestCase):
+    def setUp(self):
+        from scripts.fetching import asuntojen_hintatiedot as ah
+        self.ah = ah
+        self.pages = FIXTURES / 'asuntojen_hintatiedot'
+        self.failures = {'00120': 2, '00666': 100}
+        self.replaced = {}
+
+        def route(path, query):
+            ps = query['ps'][0]
+            if self.failures.get(ps, 0) > 0:
+                self.failures[ps] -= 1
+                return 503, b'Service Unavailable'
+            if ps in self.replaced:
+                return 200, self.replaced[ps]
+            page = self.pages / (('rent_' if 'vuokratiedot' in path else 'sale_') + ps + '.html')
+            return 200, (page if page.exists() else self.pages / 'empty.html').read_bytes()
+
+        self.server = FixtureServer(route)
+        self.urls = ah.sales_url, ah.rent_url
+        ah.sales_url = self.server.url + '/haku/?search=1&l=0&c=&cr=1&ps='
+        ah.rent_url = self.server.url + '/haku/vuokratiedot?c=&ps='
+        self.folder = tempfile.TemporaryDirectory()
+        self.journal_folder = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.journal_folder.name, 'crawl_journal.sqlite')
+        self.archive = os.path.join(self.journal_folder.name, 'raw_archive')
+
+    def tearDown(self):
+        self.ah.sales_url, self.ah.rent_url = self.urls
+        self.server.close()
+        self.folder.cleanup()
+        self.journal_folder.cleanup()
+
+    def test_same_files_as_serial_queries(self):
+        codes = ['00100', '00120', '00130', '04170']
+        for onSale in [True, False]:
+            folder = os.path.join(self.folder.name, str(onSale))
+            with contextlib.redirect_stdout(io.StringIO()):
+                failed = self.ah.all_queries_to_tsv(onSale=onSale, pc_list=codes, housing_folder=folder,
+                                                    max_workers=4, rate=0, backoff=0.01, journal=self.journal,
+                                                    archive=self.archive)
+            self.assertEqual(failed, [])
+            for code in codes:
+                page = self.pages / (('sale_' if onSale else 'rent_') + code + '.html')
+                with contextlib.redirect_stdout(io.StringIO()):
+                    expected = self.ah.parse_table(page.read_bytes() if page.exists() else b'')
+                written = Path(folder) / (code + '.tsv')
+                with io.StringIO() as buffer:
+                    expected.to_csv(buffer, sep='\t', index=False)
+                    self.assertEqual(written.read_text(encoding='utf-8'), buffer.getvalue())
+        # 00120 failed twice with 503 and was retried
+        self.assertEqual(sum('ps=00120' in r for r in self.server.requests), 3 + 1)
+
+    def test_retried_responses_closed(self):
+        from scripts.fetching.http_pool import fetch
+        responses = [mock.Mock(status_code=status, headers={}) for status in [503, 429, 200]]
+        session = mock.Mock()
+        session.request.side_effect = responses
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIs(fetch(session, 'http://localhost/', backoff=0, stream=True), responses[-1])
+        self.assertEqual([r.close.call_count for r in responses], [1, 1, 0])
+        self.assertEqual(session.request.call_count, 3)
+
+    def test_failed_codes_are_not_saved(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = self.ah.all_queries_to_tsv(onSale=True, pc_list=['00666', '00100'],
+                                                housing_folder=self.folder.name, rate=0, backoff=0.01,
+                                                journal=self.journal, archive=self.archive)
+        self.assertEqual(failed, ['00666'])
+        self.assertEqual(sorted(os.listdir(self.folder.name)), ['00100.tsv'])
+        self.assertEqual(sum('ps=00666' in r for r in self.server.requests), 5)
+
+    def test_resume_from_journal(self):
+        from scripts.fetching.crawl_journal import open_journal, summary
+        codes = ['00100', '00666', '04170']
+        kwargs = dict(onSale=False, pc_list=codes, housing_folder=self.folder.name, rate=0, backoff=0.01,
+                      journal=self.journal, archive=self.archive)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.ah.all_queries_to_tsv(**kwargs), ['00666'])
+            # The second run only asks again the postal code that failed
+            self.server.requests.clear()
+            self.assertEqual(self.ah.all_queries_to_tsv(**kwargs), ['00666'])
+            self.assertTrue(all('ps=00666' in r for r in self.server.requests))
+            # After 'max_attempts' runs the postal code is given up
+            self.server.requests.clear()
+            self.assertEqual(self.ah.all_queries_to_tsv(max_attempts=2, **kwargs), [])
+            self.assertEqual(self.server.requests, [])
+            # A new crawl downloads everything again
+            self.failures['00666'] = 0
+            self.assertEqual(self.ah.all_queries_to_tsv(new_crawl=True, **kwargs), [])
+        self.assertEqual(len(self.server.requests), 3)
+        conn = open_journal(self.journal)
+        report = summary(conn, 'rent')['rent']
+        conn.close()
+        self.assertEqual((report['done'], report['failed']), (3, 0))
+
+    def test_missing_files_and_given_up_codes_fetched_again(self):
+        codes = ['00100', '00666', '04170']
+        kwargs = dict(onSale=False, pc_list=codes, housing_folder=self.folder.name, rate=0, backoff=0.01,
+                      journal=self.journal, archive=self.archive, max_attempts=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.ah.all_queries_to_tsv(**kwargs), ['00666'])
+            # The file of a postal code done in the journal is deleted
+            os.remove(os.path.join(self.folder.name, '04170.tsv'))
+            self.server.requests.clear()
+            self.assertEqual(self.ah.all_queries_to_tsv(**kwargs), [])
+            self.assertEqual(len(self.server.requests), 1)
+            self.assertIn('ps=04170', self.server.requests[0])
+            self.assertTrue(os.path.exists(os.path.join(self.folder.name, '04170.tsv')))
+            # The postal code given up is tried again only when asked, without downloading the others
+            self.failures['00666'] = 0
+            self.server.requests.clear()
+            self.assertEqual(self.ah.all_queries_to_tsv(retry_failed=True, **kwargs), [])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIn('ps=00666', self.server.requests[0])
+        self.assertEqual(sorted(os.listdir(self.folder.name)), ['00100.tsv', '00666.tsv', '04170.tsv'])
+
+    def test_unchanged_page_saved_again_when_cleaned(self):
+        codes = ['00100', '04170']
+        kwargs = dict(onSale=False, pc_list=codes, housing_folder=self.folder.name, rate=0, backoff=0.01,
+                      journal=self.journal, archive=self.archive)
+        file = Path(self.folder.name) / '00100.tsv'
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.ah.all_queries_to_tsv(**kwargs)
+            raw = file.read_text(encoding='utf-8')
+            # Same pages, but the tables are cleaned this time
+            self.ah.all_queries_to_tsv(new_crawl=True, and_clean=True, **kwargs)
+            cleaned = file.read_text(encoding='utf-8')
+            self.assertNotEqual(cleaned, raw)
+            self.assertEqual(list(pd.read_csv(file, sep='\t')['Unnamed']), ['1h', '2h', '3h+', 'Kaikki', 'Lkm'])
+            os.utime(file, (0, 0))
+            self.ah.all_queries_to_tsv(new_crawl=True, and_clean=True, **kwargs)
+            self.assertEqual(file.stat().st_mtime, 0)
+            self.ah.all_queries_to_tsv(new_crawl=True, **kwargs)
+        self.assertEqual(file.read_text(encoding='utf-8'), raw)
+
+    def test_reparse_from_archive(self):
+        codes = ['00100', '00130', '04170']
+        kwargs = dict(onSale=False, pc_list=codes, housing_folder=self.folder.name, rate=0, backoff=0.01,
+                      journal=self.journal, archive=self.archive)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.ah.all_queries_to_tsv(**kwargs)
+            # The same pages downloaded again are saved only once
+            self.ah.all_queries_to_tsv(new_crawl=True, **kwargs)
+        objects = list(Path(self.archive).glob('objects/*/*.html.gz'))
+        self.assertEqual(len(objects), 3)
+
+        scraped = {code: (Path(self.folder.name) / (code + '.tsv')).read_text(encoding='utf-8') for code in codes}
+        with tempfile.TemporaryDirectory() as folder:
+            with contextlib.redirect_stdout(io.StringIO()):
+                failed = self.ah.reparse_from_archive(onSale=False, housing_folder=folder, archive=self.archive,
+                                                      and_clean=False, processes=2)
+            self.assertEqual(failed, [])
+            for code in codes:
+                self.assertEqual((Path(folder) / (code + '.tsv')).read_text(encoding='utf-8'), scraped[code])
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.ah.reparse_from_archive(onSale=False, housing_folder=folder, archive=self.archive, processes=2)
+            cleaned = pd.read_csv(Path(folder) / '00100.tsv', sep='\t')
+        self.assertEqual(list(cleaned['Unnamed']), ['1h', '2h', '3h+', 'Kaikki', 'Lkm'])
+
+    def test_refresh_rewrites_only_changed_tables(self):
+        codes = ['00100', '00130', '04170']
+        changelog = os.path.join(self.journal_folder.name, 'changelog.tsv')
+        kwargs = dict(onSale=False, pc_list=codes, housing_folder=self.folder.name, rate=0, backoff=0.01,
+                      journal=self.journal, archive=self.archive, changelog=changelog)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.ah.refresh_prices(**kwargs), (codes, []))
+        files = {code: Path(self.folder.name) / (code + '.tsv') for code in codes}
+        for file in files.values():
+            os.utime(file, (0, 0))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.ah.refresh_prices(**kwargs), ([], []))
+        self.assertTrue(all(file.stat().st_mtime == 0 for file in files.values()))
+
+        # A new page with the table of 00100 is different only outside the table
+        page = (self.pages / 'rent_00100.html').read_bytes()
+        self.replaced['00100'] = page.replace(b'<title>', b'<title>New ')
+        self.replaced['04170'] = page
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.ah.refresh_prices(**kwargs), (['04170'], []))
+        self.assertEqual([file.stat().st_mtime == 0 for file in files.values()], [True, True, False])
+        self.assertEqual(files['04170'].read_text(encoding='utf-8'), files['00100'].read_text(encoding='utf-8'))
+
+        log = pd.read_csv(changelog, sep='\t', dtype=str)
+        self.assertEqual(list(log['postal_code']), codes + ['04170'])
+        self.assertEqual(list(log['change']), ['new', 'new', 'new', 'changed'])
+
+
+class TestPxWebClient(unittest.TestCase):
+    def setUp(self):
+        self.tables = FIXTURES / 'pxweb'
+        self.failures = {'paavo_2_ko_2017.px': 2}
+
+        def route(path, query, body=None):
+            parts = path.strip('/').split('/')[5:]
+            if parts and self.failures.get(parts[-1], 0) > 0:
+                self.failures[parts[-1]] -= 1
+                return 429, b'Too Many Requests'
+            if body is None:
+                return 200, (self.tables / ((parts[0] if parts else 'root') + '.json')).read_bytes()
+            self.assertEqual(json.loads(body), {"query": [], "response": {"format": "csv"}})
+            return 200, (self.tables / parts[1].replace('.px', '.csv')).read_bytes()
+
+        self.server = FixtureServer(route)
+        self.base_url = self.server.url + '/PXWeb/api/v1/en/Postinumeroalueittainen_avoin_tieto/'
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.close()
+        self.folder.cleanup()
+
+    def test_download_all(self):
+        from scripts.fetching import pxweb_client
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = pxweb_client.download_all(self.folder.name, self.base_url, max_workers=4, backoff=0.01)
+        self.assertEqual(failed, [])
+        expected = {'Buildings_and_dwellings_2017.csv': 'paavo_1_ra_2017.csv',
+                    'Educational_structure_2017.csv': 'paavo_2_ko_2017.csv',
+                    'Buildings_and_dwellings_2018.csv': 'paavo_1_ra_2018.csv'}
+        raw = Path(self.folder.name) / 'paavo_raw'
+        self.assertEqual(sorted(os.listdir(raw)), sorted(expected))
+        for name, fixture in expected.items():
+            self.assertEqual((raw / name).read_bytes(), (self.tables / fixture).read_bytes())
+        # 3 listings, 3 tables, and 2 retries of the table answering 429
+        self.assertEqual(len(self.server.requests), 8)
+
+    def test_request_budget(self):
+        from scripts.fetching.http_pool import RequestBudget
+        budget = RequestBudget(3, 0.2)
+        start = time.monotonic()
+        for _ in range(7):
+            budget.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+
+class TestPxWebCache(unittest.TestCase):
+    def setUp(self):
+        from scripts.fetching import fetch_from_paavo, pxweb_cache
+        self.paavo, self.cache = fetch_from_paavo, pxweb_cache
+        table = (FIXTURES / 'pxweb' / 'paavo_1_ra_2017.csv').read_bytes()
+        self.server = FixtureServer(lambda path, query, body=None: (200, table))
+        self.url = self.server.url + '/PXWeb/api/v1/en/Postinumeroalueittainen_avoin_tieto/2017/paavo_1_ra_2017.px'
+        self.folder = tempfile.TemporaryDirectory()
+        self.defaults = pxweb_cache.CACHE_PATH, pxweb_cache.MODE, pxweb_cache.TTL
+        pxweb_cache.CACHE_PATH, pxweb_cache.MODE, pxweb_cache.TTL = Path(self.folder.name), 'use', None
+
+    def tearDown(self):
+        self.cache.CACHE_PATH, self.cache.MODE, self.cache.TTL = self.defaults
+        self.server.close()
+        self.folder.cleanup()
+
+    def fetch(self, url=None, query=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.paavo.fetch_dataframe(url or self.url, query or paavo_query)
+
+    def test_cache_modes(self):
+        df = self.fetch()
+        self.assertEqual(df.shape, (5, 9))
+        pd.testing.assert_frame_equal(self.fetch(), df)
+        self.assertEqual(len(self.server.requests), 1)
+        # The same query with the keys in another order is the same entry
+        self.fetch(query={"response": {"format": "csv"}, "query": paavo_query["query"]})
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.cache.MODE = 'refresh'
+        pd.testing.assert_frame_equal(self.fetch(), df)
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.cache.MODE = 'use'
+        self.cache.TTL = 60
+        entry = self.cache.entry_path(self.url, paavo_query)
+        os.utime(entry, (time.time() - 120, time.time() - 120))
+        self.cache.MODE = 'offline'
+        pd.testing.assert_frame_equal(self.fetch(), df)
+        self.assertTrue(self.fetch(url=self.url + '/other').empty)
+        self.assertEqual(len(self.server.requests), 2)
+        self.cache.MODE = 'use'
+        self.fetch()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_entry_extension(self):
+        from scripts.fetching.jsonstat import with_selection
+        self.assertEqual(self.cache.entry_path(self.url, paavo_query).name[-7:], '.csv.gz')
+        for response_format in ['json-stat', 'json-stat2']:
+            entry = self.cache.entry_path(self.url, with_selection(paavo_query, response_format, Vuosi=[2017]))
+            self.assertEqual(entry.name[-8:], '.json.gz')
+        self.assertEqual(self.cache.entry_path(self.url, {"query": []}).name[-7:], '.csv.gz')
+
+    def test_fetch_table(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            table = self.paavo.fetch_table(self.url, paavo_query)
+            cached = self.paavo.fetch_table(self.url, paavo_query)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(cached.equals(table))
+        df = table.to_pandas()
+        expected = pd.read_csv(FIXTURES / 'pxweb' / 'paavo_1_ra_2017.csv', encoding='iso-8859-1',
+                               na_values=['..', '.'], keep_default_na=False)
+        self.assertEqual(list(df.columns), ['Postal code', 'Area'] + list(expected.columns[1:]))
+        self.assertEqual(list(df['Postal code']), [None, '00100', '00120', '00130', '00140'])
+        self.assertEqual(df['Area'][2], 'Punavuori   (Helsinki )')
+        pd.testing.assert_frame_equal(df.iloc[:, 2:], expected.iloc[:, 1:].astype(float))
+
+    def test_fetch_table_offline_miss(self):
+        self.cache.MODE = 'offline'
+        entry = self.cache.entry_path(self.url, paavo_query)
+        with self.assertRaises(self.cache.CacheMiss) as raised:
+            self.paavo.fetch_table(self.url, paavo_query)
+        self.assertIn(self.url, str(raised.exception))
+        self.assertIn(str(entry), str(raised.exception))
+        self.assertEqual(len(self.server.requests), 0)
+
+
+class TestJsonStat(unittest.TestCase):
+    def test_decode_versions(self):
+        from scripts.fetching.jsonstat import decode, with_selection
+        dimension = {'Postinumeroalue': {'category': {'index': {'00100': 0, '00120': 1},
+                                                      'label': {'00100': '00100 Helsinki', '00120': '00120 Punavuori'}}},
+                     'Tiedot': {'category': {'index': ['He_vakiy', 'Pinta_ala']}},
+                     'Vuosi': {'category': {'index': {'2016': 0, '2017': 1, '2018': 2}}}}
+        value = [1, 2, 3, 4, 5, 6, 7, None, 9, 10, 11, 12]
+        v2 = {'version': '2.0', 'class': 'dataset', 'id': ['Postinumeroalue', 'Tiedot', 'Vuosi'], 'size': [2, 2, 3],
+              'dimension': dimension, 'value': value, 'status': {'7': '..'}}
+        v1 = {'dataset': {'dimension': dict(dimension, id=v2['id'], size=v2['size']),
+                          'value': {str(i): v for i, v in enumerate(value) if v is not None}}}
+        for cube in [decode(v2), decode(v1)]:
+            self.assertEqual(cube.values.shape, (2, 2, 3))
+            self.assertEqual(cube.codes['Tiedot'], ['He_vakiy', 'Pinta_ala'])
+            self.assertEqual(cube.labels['Postinumeroalue'][1], '00120 Punavuori')
+            self.assertEqual(cube.values[1, 0, 2], 9)
+            self.assertTrue(np.isnan(cube.values[1, 0, 1]))
+            sub = cube.select(Tiedot='He_vakiy', Vuosi=['2018', '2016'])
+            self.assertEqual(sub.dimensions, ['Postinumeroalue', 'Vuosi'])
+            np.testing.assert_array_equal(sub.values, [[3, 1], [9, 7]])
+            df = cube.to_frame(['Postinumeroalue', 'Vuosi'])
+            self.assertEqual(df.loc[('00120', '2017'), 'Pinta_ala'], 11)
+        self.assertEqual(decode(v2).status, {7: '..'})
+
+        query = with_selection({"query": [{"code": "Vuosi", "selection": {"filter": "item", "values": ["2015"]}}],
+                                "response": {"format": "csv"}}, Vuosi=[2016, 2017])
+        self.assertEqual(query, {"query": [{"code": "Vuosi", "selection": {"filter": "item",
+                                                                           "values": ["2016", "2017"]}}],
+                                 "response": {"format": "json-stat2"}})
+
+
+class TestDensityExtrapolation(unittest.TestCase):
+    def test_same_as_regression_per_row(self):
+        from sklearn.linear_model import LinearRegression
+        from scripts.fetching.fetch_from_paavo import extrapolate_density
+        years = np.array([[2014], [2015], [2016], [2017]])
+        densities = np.array([[1.0, 2.0, 3.0, 4.0],     # line, prediction 0
+                              [1.0, 1.2, 1.1, 9.0],     # negative with 4 years, positive with 3
+                              [1.0, 3.0, 5.0, 9.0],     # negative down to 2 years: first density
+                              [np.nan, 2.0, np.nan, 1.0],
+                              [np.nan, 5.0, np.nan, np.nan],
+                              [np.nan, np.nan, np.nan, np.nan],
+                              [0.0, 0.0, 0.0, 0.0]])
+        expected = []
+        for y in densities:
+            valid_years, y = years[y >= 0], y[y >= 0]
+            prediction = -1.0
+            while len(y) > 1 and prediction < 0:
+                prediction = LinearRegression().fit(valid_years, y).predict([[2013]])[0]
+                if prediction < 0:
+                    y, valid_years = y[:-1], valid_years[:-1]
+            expected.append(prediction if len(y) > 1 else y[0] if len(y) == 1 else np.nan)
+        np.testing.assert_allclose(extrapolate_density(densities, years.ravel(), 2013), expected,
+                                   rtol=1e-9, atol=1e-12)
+
+
+class TestPaavoHousing(unittest.TestCase):
+    def test_quarters_joined_on_postal_codes(self):
+        from scripts.fetching import fetch_from_paavo, paavo_queries, pxweb_cache
+        # Not sorted, and read as integers from the file
+        codes = ['33720', '00120', '00100', '02150', '00200', '33100']
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as folder:
+            pd.DataFrame({'Postal code': codes}).to_csv(os.path.join(folder, 'codes.tsv'), sep='\t', index=False)
+            density = pd.DataFrame({'Postal code': codes})
+            for year in range(2013, 2018):
+                density['Density (' + str(year) + ')'] = rng.uniform(10, 5000, len(codes))
+            density.to_csv(os.path.join(folder, 'density.tsv'), sep='\t', index=False)
+            tables = {}
+            for year in range(2005, 2018):
+                for quarter in range(5):
+                    # Each quarter has some of the postal codes, in another order
+                    sub = sorted(rng.choice(codes, 4, replace=False), reverse=bool(quarter % 2))
+                    mean = rng.integers(800, 6000, len(sub)).astype(object)
+                    mean[0] = '.'
+                    tables[year, quarter] = pd.DataFrame({'Postal code': [int(c) for c in sub], 'Mean': mean,
+                                                          'Number': rng.integers(1, 60, len(sub))})
+                    pxweb_cache.store(paavo_queries.housing_url, fetch_from_paavo.housing_quarter_query(year, quarter),
+                                      tables[year, quarter].to_csv(index=False).encode('iso-8859-1'), cache=folder)
+            with mock.patch.multiple(pxweb_cache, CACHE_PATH=Path(folder), MODE='offline'), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                fetch_from_paavo.fetch_paavo_housing(folder, os.path.join(folder, 'codes.tsv'),
+                                                     os.path.join(folder, 'density.tsv'), max_workers=2)
+            quarterly = pd.read_csv(os.path.join(folder, 'paavo_housing_data_quarterly.tsv'), sep='\t',
+                                    dtype={'Postal code': str}).set_index('Postal code')
+            yearly = pd.read_csv(os.path.join(folder, 'paavo_housing_data_yearly.tsv'), sep='\t',
+                                 dtype={'Postal code': str}).set_index('Postal code')
+            postal_code = pd.DataFrame({'Postal code': codes})
+            standardized = fetch_from_paavo.postal_standardize(density)
+
+        self.assertEqual(list(quarterly.index), codes)
+        self.assertEqual(list(yearly.index), codes)
+        self.assertEqual(quarterly.shape, (6, 52))
+        self.assertEqual(list(yearly.columns), ['Housing price (' + str(year) + ')' for year in range(2005, 2018)])
+        for (year, quarter), table in tables.items():
+            expected = fetch_from_paavo.housing_quarter((year, quarter, table, postal_code, standardized))
+            self.assertEqual(list(expected.index), codes)
+            column = quarterly[expected.name] if quarter > 0 else yearly[expected.name]
+            np.testing.assert_array_equal(column.to_numpy(dtype=np.float64), expected.to_numpy(dtype=np.float64))
+            # The prices given are kept for their postal codes
+            for code, mean in zip(table['Postal code'], table['Mean']):
+                if mean != '.':
+                    self.assertEqual(column[f"{code:05d}"], mean)
+
+
+class TestPrefixHierarchy(unittest.TestCase):
+    def test_nearest_ancestor(self):
+        from scripts.preprocessing import prefix_hierarchy as ph
+        df = pd.DataFrame({'Postal code': ph.standardize_codes(pd.Series([100, 120, 200, 1000, 2000, 10000, 99990])),
+                           'Mean': [1000, 0, np.nan, 3000, 0, 0, np.nan],
+                           'Number': [2, 3, np.nan, 1, 4, 5, np.nan]})
+        self.assertEqual(list(df['Postal code']), ['00100', '00120', '00200', '01000', '02000', '10000', '99990'])
+        df['Total value'] = df['Mean'] * df['Number']
+        df.loc[ph.is_missing(df['Mean']), 'Number'] = 0
+        means = ph.nearest_ancestor_means(df['Postal code'], df['Total value'], df['Number'], lengths=(3, 2, 1))
+        # '0': 5000 / 3, '00': 1000, '01': 3000, '02' from '0', '1' and '9' without any price
+        pd.testing.assert_series_equal(means, pd.Series([1000, 1000, 3000, 5000 / 3, np.nan, np.nan],
+                                                        index=['001', '002', '010', '020', '100', '999']))
+        means = means.fillna(0).astype(int)
+        imputed = ph.fill_from_ancestors(df['Mean'], df['Postal code'], means, 3)
+        self.assertEqual(list(imputed), [1000, 1000, 1000, 3000, 1666, 0, 0])
+
+    def test_impute_with_regression(self):
+        from scripts.preprocessing import prefix_hierarchy as ph
+        # '001': 16 prices on the line 1000 + 10 x and an outlier left out by the 15 smallest, 2 missing
+        # '002': only 6 prices, not imputed
+        codes = ['001' + str(i).zfill(2) for i in range(19)] + ['002' + str(i).zfill(2) for i in range(7)]
+        density = list(range(16)) + [3.0, 2.55, 7.0] + list(range(7))
+        mean = [1000 + 10 * x for x in range(15)] + [99999, 0, 0, 1500] + [2000] * 6 + [0]
+        df = pd.DataFrame({'Postal code': codes, 'Mean': np.array(mean, dtype=float), 'Density': density})
+        imputed = ph.impute_with_regression(df['Postal code'], df['Mean'], df['Density'], 3)
+        self.assertEqual(list(imputed[16:19]), [1030, 1025, 1500])
+        self.assertEqual(imputed.iloc[-1], 0)
+        pd.testing.assert_series_equal(imputed.drop([16, 17]), df['Mean'].drop([16, 17]))
+
+        # '003': 7 prices with the same density, the missing one gets their mean whatever its density
+        df = pd.DataFrame({'Postal code': ['003' + str(i).zfill(2) for i in range(9)],
+                           'Mean': [1000.0, 1050, 1100, 1150, 1200, 1250, 1300, 0, 0],
+                           'Density': [50.0] * 7 + [80.0, 0.0]})
+        imputed = ph.impute_with_regression(df['Postal code'], df['Mean'], df['Density'], 3)
+        self.assertEqual(list(imputed[7:]), [1150, 1150])
+        # Also when the constant density is 0
+        df['Density'] = 0.0
+        imputed = ph.impute_with_regression(df['Postal code'], df['Mean'], df['Density'], 3)
+        self.assertEqual(list(imputed[7:]), [1150, 1150])
+
+
+class TestYearlyDataframes(unittest.TestCase):
+    def test_clean_cache(self):
+        from scripts.modeling.yearly_dataframes import clean_file, read_clean_files
+        raw = Path('data/paavo/paavo_raw')
+        names = ['Educational_structure_2012.csv', 'Educational_structure_2013.csv', 'Main_type_of_activity_2012.csv']
+        with tempfile.TemporaryDirectory() as folder:
+            for name in names:
+                (Path(folder) / name).write_bytes((raw / name).read_bytes())
+            files = [os.path.join(folder, name) for name in names]
+            cache = os.path.join(folder, 'cache')
+            for file_list, cleaned in [(files[:2], 'Cleaning 2 files'), (files, 'Cleaning 1 files'), (files, '')]:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    frames = read_clean_files(file_list, max_workers=1, cache=cache)
+                self.assertEqual(output.getvalue().strip(), cleaned)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for file, df in zip(files, frames):
+                    pd.testing.assert_frame_equal(df, clean_file(file))
+
+    def test_normalize_columns(self):
+        from scripts.preprocessing.column_names import compile_mapping, normalize_columns
+        # The two 'Inhabitants, total' come from different tables and are both kept, 'Females' of (TE) is dropped
+        columns = ['Postal code', 'Inhabitants, total, 2017 (HE)', 'Females, 2017 (HE)', 'Postal code area',
+                   'Inhabitants, total, 2017', 'Employment rate %, 2017 (PT)', 'Females, 2017 (TE)']
+        df = pd.DataFrame([list(range(len(columns)))], columns=columns)
+        hits = compile_mapping.cache_info().hits
+        for _ in range(2):
+            normalized = normalize_columns(df.copy(), drop=['Postal code area'])
+            self.assertEqual(list(normalized.columns),
+                             ['Postal code', 'Inhabitants, total', 'Females', 'Inhabitants, total', 'Employment rate %'])
+            self.assertEqual(list(normalized.iloc[0]), [0, 1, 2, 4, 5])
+        self.assertEqual(compile_mapping.cache_info().hits, hits + 1)
+
+    def test_rule_imputer(self):
+        from scripts.preprocessing.imputation import RuleImputer
+        imputer = RuleImputer([('rate', 'median', None), ('Empty', 'constant', -1), ('', 'min', 15)])
+        df = pd.DataFrame({'Area': ['a', 'b', 'c', 'd'],
+                           'Employment rate': [50, np.nan, 70, 100],
+                           'Males': [0, 9, np.nan, 100],
+                           'Females': [np.nan, 20, 30, np.nan],
+                           'Zeros': [0, 0, np.nan, 0],
+                           'Empty': [np.nan] * 4,
+                           'Full': [1.0, 2, 3, 4]})
+        imputed, counts = imputer.impute(df)
+        self.assertEqual(list(imputed['Employment rate']), [50, 70, 70, 100])
+        self.assertEqual(list(imputed['Males']), [0, 9, 9, 100])
+        self.assertEqual(list(imputed['Females']), [15, 20, 30, 15])
+        self.assertEqual(imputed['Zeros'].isna().sum(), 1)
+        self.assertEqual(list(imputed['Empty']), [-1] * 4)
+        pd.testing.assert_frame_equal(imputed[['Area', 'Full']], df[['Area', 'Full']])
+        self.assertEqual(counts.to_dict(), {'Employment rate': 1, 'Males': 1, 'Females': 2, 'Zeros': 0, 'Empty': 4})
+        self.assertEqual(len(imputer.plans), 1)
+
+
+class TestHtmlTable(unittest.TestCase):
+    def test_same_as_read_html(self):
+        from scripts.fetching.html_table import read_table
+        pages = [page.read_bytes() for page in sorted((FIXTURES / 'asuntojen_hintatiedot').glob('*.html'))]
+        pages.append('<html><head><meta charset="utf-8"></head><body><table id="other"><tr><td>1</td></tr></table>'
+                     '<table id="mainTable"><tr><th>Ä  b</th><th>c</th></tr>'
+                     '<tr><td>1,000</td><td rowspan="2">x</td></tr><tr><td>2.5</td></tr><tr><td>-</td></tr>'
+                     '<tfoot><tr><td colspan="2">f</td></tr></tfoot></table></body></html>'.encode('utf-8'))
+        for page in pages:
+            try:
+                expected = pd.read_html(io.BytesIO(page), attrs={'id': 'mainTable'}, flavor='lxml',
+                                        encoding='utf-8')[0]
+            except ValueError:
+                expected = pd.DataFrame()
+            pd.testing.assert_frame_equal(read_table(page), expected)
+
+
+class TestPriceStore(unittest.TestCase):
+    def test_store_matches_tsv_files(self):
+        from scripts.fetching.asuntojen_hintatiedot import parse_table, clean_sale, clean_rent
+        from scripts.fetching.price_store import build_price_store, load_sales, load_rents
+        pages = FIXTURES / 'asuntojen_hintatiedot'
+        cleaned = {}
+        with tempfile.TemporaryDirectory() as folder:
+            for kind in ['sale', 'rent']:
+                os.makedirs(os.path.join(folder, kind))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    df = parse_table((pages / (kind + '_00100.html')).read_bytes())
+                # The files are saved by the scraper and then cleaned by 'clean(andSave=True)'
+                df = pd.read_csv(io.StringIO(df.to_csv(sep='\t', index=False)), sep='\t')
+                df = cleaned[kind] = clean_sale(df) if kind == 'sale' else clean_rent(df)
+                # 00200 has no data, only the header
+                for code, table in [('00100', df), ('00200', df.iloc[:0])]:
+                    table.to_csv(os.path.join(folder, kind, code + '.tsv'), sep='\t', index=False, encoding='utf-8')
+            with contextlib.redirect_stdout(io.StringIO()):
+                build_price_store(os.path.join(folder, 'sale'), os.path.join(folder, 'rent'), folder)
+            sales = load_sales(store_folder=folder, sale_folder=os.path.join(folder, 'sale'))
+            rents = load_rents(['00100'], store_folder=folder, rent_folder=os.path.join(folder, 'rent'))
+
+            # A .tsv file written after the store: the store is built again
+            cleaned['sale'].to_csv(os.path.join(folder, 'sale', '00200.tsv'), sep='\t', index=False, encoding='utf-8')
+            written = os.stat(os.path.join(folder, 'sale', '00200.tsv')).st_mtime
+            os.utime(os.path.join(folder, 'sales.parquet'), (written - 10, written - 10))
+            with contextlib.redirect_stdout(io.StringIO()):
+                updated = load_sales(store_folder=folder, sale_folder=os.path.join(folder, 'sale'))
+            self.assertEqual(list(updated['Postal code'].value_counts().sort_index()), [len(sales)] * 2)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                load_sales(store_folder=folder, sale_folder=os.path.join(folder, 'sale'))
+            self.assertEqual(output.getvalue(), '')
+
+        self.assertEqual(set(sales['Postal code']), {'00100'})
+        self.assertEqual(list(sales['Rv']), [int(v) for v in cleaned['sale']['Rv']])
+        self.assertTrue(pd.api.types.is_integer_dtype(sales['Rv']))
+        self.assertEqual(list(rents['Unnamed']), ['1h', '2h', '3h+', 'Kaikki', 'Lkm'])
+        self.assertTrue(pd.api.types.is_float_dtype(rents['Keskivuokra ARA-vuokra']))
+
+    def test_average_prices_same_as_per_file(self):
+        import shutil
+        import numpy as np
+        from scripts.fetching.asuntojen_hintatiedot import pc_list, sold_avg, rent_avg
+        from scripts.fetching.price_store import build_price_store, average_prices
+        codes = list(pc_list[::100])
+        with tempfile.TemporaryDirectory() as folder:
+            for kind in ['sale', 'rent']:
+                os.makedirs(os.path.join(folder, kind))
+                for code in codes:
+                    shutil.copy(os.path.join('data/house_price/asuntojen_hintatiedot_' + kind, code + '.tsv'),
+                                os.path.join(folder, kind))
+            with contextlib.redirect_stdout(io.StringIO()):
+                build_price_store(os.path.join(folder, 'sale'), os.path.join(folder, 'rent'), folder)
+            prices = average_prices(codes + ['99999'], store_folder=folder)
+
+            expected = {'Sell price': [], 'Rent price with ARA': [], 'Rent price without ARA': []}
+            for code in codes:
+                sale = pd.read_csv(os.path.join(folder, 'sale', code + '.tsv'), sep='\t', encoding='iso-8859-1')
+                rent = pd.read_csv(os.path.join(folder, 'rent', code + '.tsv'), sep='\t', encoding='iso-8859-1')
+                expected['Sell price'].append(sold_avg(sale))
+                expected['Rent price with ARA'].append(rent_avg(rent.copy(), withARA=True))
+                expected['Rent price without ARA'].append(rent_avg(rent.copy(), withARA=False))
+        for column, values in expected.items():
+            values = np.array([np.nan if v is None else v for v in values] + [np.nan], dtype=np.float64)
+            np.testing.assert_array_equal(prices[column].values, values)
+
+
+class TestPriceDistribution(unittest.TestCase):
+    def test_merged_digests_give_the_quantiles(self):
+        import numpy as np
+        from scripts.modeling.price_distribution import TDigest, build_digests, rollup, summary
+        values = np.random.default_rng(0).lognormal(8, 0.5, 100000)
+        whole = TDigest()
+        whole.update(values)
+        parts = []
+        for chunk in np.array_split(values, 40):
+            parts.append(TDigest())
+            parts[-1].update(chunk)
+        merged = parts[0]
+        for part in parts[1:]:
+            merged = merged.merge(part)
+        self.assertEqual(merged.count(), len(values))
+        for q in [0.1, 0.5, 0.9]:
+            for digest in [whole, merged, TDigest.from_dict(merged.to_dict())]:
+                self.assertAlmostEqual(digest.quantile(q) / np.quantile(values, q), 1, delta=0.01)
+
+        sales = pd.DataFrame({'Postal code': ['00100', '00100', '00100', '00120', '00200'],
+                              'Huoneisto': ['1h, kt', '2h,k,s', '3-4h+k', 'Yksiö', 'autopaikka'],
+                              'Rv': [1950, 1950, 2010, 1985, 2000],
+                              'm21': [5000, 4000, 6000, 7000, 100]})
+        digests = build_digests(sales)
+        self.assertEqual(sorted(digests), [('00100', '1h', '-1959'), ('00100', '2h', '-1959'),
+                                           ('00100', '3h+', '2000-'), ('00120', '1h', '1980-1999'),
+                                           ('00200', 'other', '2000-')])
+        areas = summary(rollup(digests, digits=3, by_rooms=False, by_built=False))
+        self.assertEqual(list(areas['Postal code']), ['001', '002'])
+        self.assertEqual(list(areas['Count']), [4, 1])
+        self.assertEqual(list(areas['Median']), [5500, 100])
+
+
+class TestProfiling(unittest.TestCase):
+    def test_disabled_returns_the_function(self):
+        from scripts.deployment import profiling
+
+        def callback(x):
+            return x + 1
+        with mock.patch.object(profiling, 'PROFILE_EVERY', 0):
+            self.assertIs(profiling.profiled(callback), callback)
+
+    def test_one_in_n_calls_profiled_and_rotated(self):
+        from scripts.deployment import profiling
+
+        def callback(x):
+            return x + 1
+        with tempfile.TemporaryDirectory() as folder, \
+                mock.patch.multiple(profiling, PROFILE_EVERY=3, PROFILE_DIR=Path(folder), PROFILE_KEEP=2):
+            wrapped = profiling.profiled(callback)
+            self.assertIsNot(wrapped, callback)
+            results = []
+            for i in range(6):
+                results.append(wrapped(i))
+                # Distinct timestamps in the file names
+                time.sleep(0.01)
+            self.assertEqual(results, [1, 2, 3, 4, 5, 6])
+            # Calls 3 and 6 are profiled
+            profiles = profiling.list_profiles()
+            self.assertEqual(len(profiles), 2)
+            self.assertEqual({p['callback'] for p in profiles}, {'callback'})
+
+            for i in range(3):
+                wrapped(i)
+                time.sleep(0.01)
+            # Call 9 is profiled and the oldest file is removed
+            newest = profiling.list_profiles()
+            self.assertEqual(len(os.listdir(folder)), 2)
+            self.assertEqual(newest[1], profiles[0])
+            self.assertNotIn(profiles[1]['file'], os.listdir(folder))
+
+
+class TestLocationSearch(unittest.TestCase):
+    names = {'00100': 'Helsinki keskusta - Etu-Töölö', '00250': 'Taka-Töölö', '02150': 'Otaniemi',
+             '00260': 'Keski-Töölö', '33720': 'Hervanta', '00180': 'Kamppi-Ruoholahti'}
+
+    def test_normalize(self):
+        from scripts.deployment.location_search import normalize
+        self.assertEqual(normalize('  Etu-TÖÖLÖ  (Helsinki) '), 'etu toolo helsinki')
+        self.assertEqual(normalize('Åland'), 'aland')
+        self.assertEqual(normalize(' \t '), '')
+
+    def test_prefix_lookup(self):
+        from scripts.deployment.location_search import build_prefix_index, search_prefix
+        index = build_prefix_index(self.names)
+        self.assertEqual(search_prefix(index, '0015'), [])
+        self.assertEqual(search_prefix(index, '002'), ['00250', '00260'])
+        # Any word of the name, without the case and the accents
+        self.assertEqual(search_prefix(index, 'TÖÖ'), ['00100', '00250', '00260'])
+        self.assertEqual(search_prefix(index, 'etu-töölö'), ['00100'])
+        self.assertEqual(search_prefix(index, 'ruoho'), ['00180'])
+        self.assertEqual(search_prefix(index, 'toolo', limit=2), ['00100', '00250'])
+        self.assertEqual(len(search_prefix(index, '0', limit=3)), 3)
+
+    def test_empty_query(self):
+        from scripts.deployment.location_search import build_prefix_index, search_prefix
+        index = build_prefix_index(self.names)
+        for query in ['', '   ', ' - ']:
+            self.assertEqual(search_prefix(index, query), [])
+
+    def test_trigram_ranking(self):
+        from scripts.deployment.location_search import trigrams, build_trigram_index, search_trigram
+        self.assertEqual(trigrams('Töö'), {'  t', ' to', 'too', 'oo '})
+        self.assertEqual(trigrams('TÖÖ!'), trigrams('töö'))
+        index = build_trigram_index([('02150', 'Otaniemi (Espoo)'), ('33720', 'Hervanta (Tampere)'),
+                                     ('00250', 'Taka-Töölö (Helsinki)'), ('00260', 'Keski-Töölö (Helsinki)')])
+        # Typo tolerant, without the case and the accents
+        results = search_trigram(index, 'hervnata')
+        self.assertEqual(results[0][:2], ('33720', 'Hervanta (Tampere)'))
+        self.assertEqual([code for code, _, _ in search_trigram(index, 'TAKA TOOLO')][:2], ['00250', '00260'])
+        # The municipality in parentheses is indexed too
+        self.assertEqual({code for code, _, _ in search_trigram(index, 'helsinki', limit=2)}, {'00250', '00260'})
+        # Dice coefficient: 2 * shared / (trigrams of the query + trigrams of the name)
+        code, name, score = search_trigram(index, 'Otaniemi (Espoo)', limit=1)[0]
+        self.assertEqual((code, score), ('02150', 1.0))
+        scores = [score for _, _, score in search_trigram(index, 'toolo', limit=10)]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertTrue(all(0 < score < 1 for score in scores))
+        self.assertEqual(len(search_trigram(index, 'helsinki', limit=1)), 1)
+        self.assertEqual(search_trigram(index, 'xyz'), [])
+
+
+class TestAreaApi(unittest.TestCase):
+    def setUp(self):
+        from flask import Flask
+        from scripts.deployment.area_api import register_area_api
+        server = Flask(__name__)
+        register_area_api(server)
+        self.client = server.test_client()
+
+    def test_area(self):
+        response = self.client.get('/api/area/02150')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=3600, stale-while-revalidate=86400')
+        area = json.loads(response.get_data())
+        self.assertEqual((area['postal_code'], area['name'], area['tax']), ('02150', 'Otaniemi', 18.0))
+        self.assertEqual(area['transportation'], {'bus': 25, 'train': 0, 'tram': 0, 'metro': 2, 'ferry': 0})
+        # No sales: the price 0 is null
+        self.assertIsNone(json.loads(self.client.get('/api/area/40740').get_data())['sell_price'])
+
+        areas = json.loads(self.client.get('/api/area?codes=02150, 40740,99999').get_data())
+        self.assertEqual(list(areas), ['02150', '40740', '99999'])
+        self.assertEqual(areas['02150'], area)
+        self.assertIsNone(areas['99999'])
+        self.assertEqual(len(json.loads(self.client.get('/api/area').get_data())), 8)
+        codes = ",".join(f"{i:05d}" for i in range(201))
+        self.assertEqual(self.client.get('/api/area?codes=' + codes).status_code, 400)
+
+    def test_unknown_code(self):
+        response = self.client.get('/api/area/99999')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.get_data()), {'error': 'Unknown postal code: 99999'})
+
+    def test_etag_and_gzip(self):
+        import gzip
+        plain = self.client.get('/api/area/02150')
+        etag = plain.headers['ETag']
+        response = self.client.get('/api/area/02150', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.client.get('/api/area/02150', headers={'If-None-Match': '"other"'}).status_code, 200)
+
+        compressed = self.client.get('/api/area/02150', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(compressed.status_code, 200)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(compressed.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+        # The two encodings have their own ETag
+        self.assertNotEqual(compressed.headers['ETag'], etag)
+        response = self.client.get('/api/area/02150', headers={'Accept-Encoding': 'gzip',
+                                                                'If-None-Match': compressed.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/api/area/02150', headers={'If-None-Match': compressed.headers['ETag']})
+                         .status_code, 200)
+
+
+class TestRecommendApi(unittest.TestCase):
+    query = {'income': 30000, 'age': 30, 'location': '02150', 'occupation': 'Education',
+             'household_type': 2, 'selection_radio': 'nochange'}
+
+    def setUp(self):
+        from flask import Flask
+        from scripts.deployment.recommend_api import register_recommend_api
+        server = Flask(__name__)
+        register_recommend_api(server)
+        self.client = server.test_client()
+
+    def post(self, body):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.client.post('/api/recommend', data=body, content_type='application/json')
+
+    def test_sanitize_input(self):
+        from scripts.deployment.reference_function import sanitize_input
+        valid = tuple(self.query.values())
+        self.assertEqual(sanitize_input(*valid), valid)
+        self.assertEqual(sanitize_input(30000.5, 30.6, '02150', 'Student', '5 or more', 'change'),
+                         (30000.5, 31, '02150', 'Student', '5 or more', 'change'))
+        for income in [None, -1, 0, '30000', True, [30000]]:
+            self.assertEqual(sanitize_input(income, *valid[1:])[0], 10000)
+        for age in [None, 0, -5, 120, 1000, '30', False, {'age': 30}]:
+            self.assertEqual(sanitize_input(valid[0], age, *valid[2:])[1], 22)
+        for location in [None, '', '99999', 2150, ' 02150']:
+            self.assertEqual(sanitize_input(*valid[:2], location, *valid[3:])[2], '00930')
+        for occupation in [None, '', 'education', 'Astronaut', 3]:
+            self.assertEqual(sanitize_input(*valid[:3], occupation, *valid[4:])[3], 'Student')
+        for household_type in [None, 0, 6, '2', 'many']:
+            self.assertEqual(sanitize_input(*valid[:4], household_type, valid[5])[4], 1)
+        for selection_radio in [None, '', 'CHANGE', 1]:
+            self.assertEqual(sanitize_input(*valid[:5], selection_radio)[5], 'whatever')
+
+    def test_recommend(self):
+        response = self.post(json.dumps(dict(self.query, top_k=3)))
+        self.assertEqual(response.status_code, 200)
+        answer = json.loads(response.get_data())
+        self.assertEqual(answer['input'], self.query)
+        self.assertEqual(len(answer['alternatives']), 3)
+        self.assertEqual(answer['postal_code'], answer['alternatives'][0]['postal_code'])
+        self.assertNotEqual(answer['postal_code'], '02150')
+        self.assertEqual(len(answer['radar']['current']), len(answer['radar']['categories']))
+
+        # Out of range or malformed fields are replaced with the defaults
+        response = self.post(json.dumps([{'income': -100, 'age': 200, 'location': '99999', 'occupation': 'Astronaut',
+                                          'household_type': 'many', 'selection_radio': 'far', 'top_k': '3'}, {}]))
+        self.assertEqual(response.status_code, 200)
+        answers = json.loads(response.get_data())
+        self.assertEqual(len(answers), 2)
+        for answer in answers:
+            self.assertEqual(answer['input'], {'income': 10000, 'age': 22, 'location': '00930', 'occupation': 'Student',
+                                               'household_type': 1, 'selection_radio': 'whatever'})
+            self.assertEqual(len(answer['alternatives']), 1)
+        # JSON true is not a number of alternatives
+        answers = json.loads(self.post(json.dumps([dict(self.query, top_k=True), dict(self.query, top_k=False)]))
+                             .get_data())
+        self.assertEqual([len(answer['alternatives']) for answer in answers], [1, 1])
+
+    def test_degraded_answer(self):
+        from scripts.deployment import recommend_api
+        self.assertFalse(json.loads(self.post(json.dumps(self.query)).get_data())['degraded'])
+        with mock.patch.object(recommend_api, 'get_recommendation', return_value=([('00100', 1.5)], True)):
+            answer = json.loads(self.post(json.dumps(self.query)).get_data())
+        self.assertTrue(answer['degraded'])
+        self.assertEqual(answer['input'], self.query)
+        self.assertEqual(answer['postal_code'], '00100')
+
+    def test_overloaded_app_never_shows_another_answer(self):
+        from scripts.deployment import admission
+        from scripts.deployment.recommend_api import get_recommendation
+        from scripts.deployment.reference_function import sanitize_input
+        query = dict(self.query, income=41000, selection_radio='whatever')
+        other = dict(query, income=12000, age=70, occupation='Student', household_type=1)
+        first = json.loads(self.post(json.dumps(query)).get_data())
+        release = threading.Event()
+        with mock.patch.multiple(admission, MAX_CONCURRENT=1, MAX_QUEUED=0):
+            thread = threading.Thread(target=admission.run_once, args=(('busy',), lambda: release.wait(10)))
+            thread.start()
+            try:
+                while admission.get_metrics()['running'] == 0:
+                    time.sleep(0.001)
+                # The API answers with the recommendation of the same location, and says so
+                answer = json.loads(self.post(json.dumps(other)).get_data())
+                self.assertTrue(answer['degraded'])
+                self.assertEqual(answer['alternatives'], first['alternatives'])
+                # The "Recommend" button of the app (change_focus) shows the busy message instead
+                with self.assertRaises(admission.Overloaded):
+                    get_recommendation(*sanitize_input(*other.values()), fallback=False)
+            finally:
+                release.set()
+                thread.join()
+
+    def test_invalid_body(self):
+        for body in [b'{"income": ', b'', b'NaN', b'"02150"', b'42', b'[{"age": 30}, 2]', b'[[]]',
+                     json.dumps([self.query] * 51).encode()]:
+            response = self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn('error', json.loads(response.get_data()))
+
+
+class TestAdmission(unittest.TestCase):
+    def wait_for(self, condition):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def test_identical_requests_coalesced(self):
+        from scripts.deployment import admission
+        before = admission.get_metrics()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(10)
+            return ['00100']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(admission.run_once(('coalesced', 1), compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # The first request computes, the four others wait for its answer
+        self.wait_for(lambda: admission.get_metrics()['coalesced'] - before['coalesced'] == 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        after = admission.get_metrics()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [(['00100'], False)] * 5)
+        self.assertEqual(after['computed'] - before['computed'], 1)
+        self.assertEqual(after['requests'] - before['requests'], 5)
+        # The answer is cached
+        self.assertEqual(admission.run_once(('coalesced', 1), compute), (['00100'], False))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(admission.get_metrics()['cached'] - after['cached'], 1)
+
+    def test_overloaded_degraded_or_rejected(self):
+        from scripts.deployment import admission
+        release = threading.Event()
+        self.assertEqual(admission.run_once(('overloaded', 1), lambda: 'A', fallback_key='location'), ('A', False))
+        before = admission.get_metrics()
+        with mock.patch.multiple(admission, MAX_CONCURRENT=1, MAX_QUEUED=0):
+            thread = threading.Thread(target=admission.run_once, args=(('overloaded', 2), lambda: release.wait(10)))
+            thread.start()
+            try:
+                self.wait_for(lambda: admission.get_metrics()['running'] == 1)
+                # The answer of a similar request
+                self.assertEqual(admission.run_once(('overloaded', 3), lambda: 'B', fallback_key='location'),
+                                 ('A', True))
+                with self.assertRaises(admission.Overloaded):
+                    admission.run_once(('overloaded', 4), lambda: 'C', fallback_key='other location')
+                with self.assertRaises(admission.Overloaded):
+                    admission.run_once(('overloaded', 5), lambda: 'D')
+                # The cached answers are still served
+                self.assertEqual(admission.run_once(('overloaded', 1), lambda: 'E'), ('A', False))
+            finally:
+                release.set()
+                thread.join()
+
+        after = admission.get_metrics()
+        self.assertEqual(after['degraded'] - before['degraded'], 1)
+        self.assertEqual(after['rejected'] - before['rejected'], 2)
+        self.assertEqual(after['computed'] - before['computed'], 1)
+        self.assertEqual((after['running'], after['queued']), (0, 0))
+
+
 if __name__ == '__main__':
     unittest.main()